@@ -1,30 +1,102 @@
 
+import argparse
 import csv
 import json
 import logging
+import dataclasses
+import multiprocessing
+import multiprocessing.synchronize
+import signal
+import threading
 import time
 from pathlib import Path
 from datetime import datetime as dt
+from typing import Callable
 
 from component.commercial_bike import CommercialBikeClient
 from component.database import Database
-from model.bike_api import Bike, BikeCSVSerializer
+from component.database_writer import DatabaseWriter
+from component.discovery_cache import DiscoveryCache
+from component.http_recorder import RecordingHttpSession
+from component.http_session import HttpSession
+from component.metrics import MetricsServer, metrics, record_cycle_metrics
+from component.pipeline import TRACKED_BIKE_FIELDS, CollectorPipeline
+from component.profiling import CycleProfiler
+from component.raw_archive import UNCHANGED, RawResponseArchive
+from component.scanner import StationScanner
+from component.scheduler import AdaptivePollScheduler
+from component.snapshot_diff import SnapshotDiff
+from component.spatial_index import StationIndex
+from component.supervisor import CityConfig, CityReader, CitySupervisor
+from model.bike_api import Bike, BikeBatch, BikeCSVSerializer
 from model.station_api import Station, StationCSVSerializer
 
+try:
+    # Optional, needs numpy
+    from component.availability import AvailabilityRingBuffer, stations_capacity
+except ImportError:
+    AvailabilityRingBuffer = None
+
 log = logging.getLogger(__name__)
 
 class VilloTrackerApp:
     BRUSSELS_WEBSITE = "https://www.villo.be"
     LYON_WEBSITE = "https://velov.grandlyon.com"
 
-    def __init__(self):
+    # The cities which can be collected at the same time, each in its own process, with its own database
+    CITIES = {
+        "brussels": CityConfig(name="brussels", baseurl=BRUSSELS_WEBSITE, db_file_name="commercial_bike.db"),
+        "lyon": CityConfig(name="lyon", baseurl=LYON_WEBSITE, db_file_name="commercial_bike_lyon.db"),
+    }
+
+    # Tune these to what the operator tolerates
+    SCAN_MAX_WORKERS = 8
+    SCAN_REQUESTS_PER_SECOND = 5.0
+    # Max number of stations to fetch the bikes of, per scan (when they have to be fetched one by one)
+    SCAN_BUDGET = 120
+
+    def __init__(
+            self,
+            baseurl: str = BRUSSELS_WEBSITE,
+            db_file_name: str | None = None,
+            requests_per_second: float = SCAN_REQUESTS_PER_SECOND,
+            cache: DiscoveryCache | None = None,
+            session: HttpSession | None = None,
+            profiler: CycleProfiler | None = None,
+            archive: bool = True,
+    ):
 
+        self.db = Database(db_file_name)
+        # The raw responses of the API, next to the database
+        self.archive = RawResponseArchive(self.db.get_db_path().with_suffix(".archive")) if archive else None
         # TODO use a rondom user agent at every requests, to try and blur our marks on their webservers (to prevent fail2ban / blocking)
-        self.api_client = CommercialBikeClient(self.BRUSSELS_WEBSITE)
-        self.db = Database()
+        self.api_client = CommercialBikeClient(baseurl, session=session, cache=cache, archive=self.archive)
+        # All the bikes evolutions are saved by a dedicated thread, by batches
+        self.db_writer = DatabaseWriter(self.db.file_name)
+        self.snapshot_diff = SnapshotDiff.from_database(self.db)
+        self.scanner = StationScanner(
+            # The stations whose response did not change are not parsed, nor diffed
+            fetch_bikes=lambda number: self.api_client.get_bikes_at_station(number, skip_unchanged=True),
+            max_workers=self.SCAN_MAX_WORKERS,
+            requests_per_second=requests_per_second,
+            fetch_bikes_by_station=lambda numbers: self.api_client.get_bikes_by_station(numbers, skip_unchanged=True),
+        )
+        self.scheduler = AdaptivePollScheduler()
+        self.station_index = StationIndex.from_database(self.db)
+        # The availabilities of the stations at each poll, next to the database
+        self.availability = None
+        if AvailabilityRingBuffer is not None:
+            max_ordinal = max((station["rowid"] for station in self.db.find_all_stations()), default=0)
+            self.availability = AvailabilityRingBuffer(
+                self.db.get_db_path().with_suffix(".availability"), max_stations=stations_capacity(max_ordinal + 1))
+        # Profiles the cycles asked by VILLO_PROFILE (or SIGUSR1, once its handler is installed)
+        self.profiler = profiler or CycleProfiler.from_env()
+        self._cycles = 0
 
-    def _init_stations_db(self):
-        stations = [Station.from_dict(station) for station in self.api_client.get_stations()]
+    def _init_stations_db(self) -> list[Station]:
+        raw_stations = self.api_client.get_stations()
+        with metrics.timer("decode_seconds", model="station"):
+            stations = [Station.from_dict(station) for station in raw_stations]
         stations_to_save = [{
             "number": st.number,
             "name": st.name,
@@ -36,25 +108,97 @@ class VilloTrackerApp:
             for st in stations
         ]
         self.db.save_stations(stations=list(stations_to_save))
+        internal_station_ids = {station["number"]: station["rowid"] for station in self.db.find_all_stations()}
+        self._on_stations(stations, internal_station_ids)
+        return stations
+
+    def _on_stations(self, stations: list[Station], internal_station_ids: dict[int, int]):
+        """Keeps up to date what follows the polls of the stations"""
+        self.station_index.sync_stations(stations, internal_station_ids)
+        self.station_index.update_availabilities(stations, internal_station_ids)
+        if self.availability is not None:
+            self.availability.append_stations(stations, internal_station_ids)
 
-    def _init_bikes_evolution_db(self):
-        for station in self.db.find_all_stations():
-            log.info("Scanning station %s", station["number"])
-            api_station_id = station["number"]
-            internal_station_id = station["rowid"]  # SQLite rowid -- the primary key in SQLite of our table
-            bikes = [Bike.from_dict(bike) for bike in self.api_client.get_bikes_at_station(station_id=api_station_id)]
+    def _init_bikes_evolution_db(self, stations: list[Station]) -> int:
+        # SQLite rowid -- the primary key in SQLite of our table
+        internal_station_ids = {station["number"]: station["rowid"] for station in self.db.find_all_stations()}
+        stations_by_number = {station.number: station for station in stations}
+        if self.scanner.bulk_available:
+            # A single request for all the stations, no need to choose
+            station_numbers = list(stations_by_number)
+        else:
+            station_numbers = self.scheduler.select(stations, budget=self.SCAN_BUDGET)
+        log.info("Scanning count=%d stations", len(station_numbers))
+        evolutions_count = 0
+        # The fetches are done concurrently, but the writes are done here, in the thread owning the DB connection
+        for api_station_id, raw_bikes in self.scanner.scan_all(station_numbers):
+            if raw_bikes is None:
+                continue
+            if raw_bikes is UNCHANGED:
+                self.scheduler.record_fetch(stations_by_number[api_station_id], 0)
+                continue
+            with metrics.timer("decode_seconds", model="bike_batch"):
+                bikes = BikeBatch.from_dicts(raw_bikes, TRACKED_BIKE_FIELDS)
             log.debug("Found count=%d bikes at station=%s", len(bikes), api_station_id)
-            # Considering all the bikes as IN for initialization
-            now = dt.now()
-            bikes_evolutions = [{
-                "at": now,
-                "station_id": internal_station_id,
-                "bike_id": bi.id,
-                "action": "I",  # I for IN, O for OUT
-            } for bi in bikes]
-            self.db.save_bikes_evolutions(list(bikes_evolutions))
-            log.debug("Sleeping a bit to prevent being blocked")
-            time.sleep(1)
+            # Only the real arrivals and departures since the previous scan are saved
+            bikes_evolutions = self.snapshot_diff.diff(
+                station_id=internal_station_ids[api_station_id],
+                bike_ids=bikes.column('id'),
+                at=dt.now(),
+            )
+            self.scheduler.record_fetch(stations_by_number[api_station_id], len(bikes_evolutions))
+            if bikes_evolutions:
+                self.db_writer.save_bikes_evolutions(bikes_evolutions)
+                evolutions_count += len(bikes_evolutions)
+        self.db_writer.flush()
+        return evolutions_count
+
+    def run_cycle(self) -> dict:
+        """One scan of the city: its stations, then the bikes at these stations. Returns some stats about it."""
+        started_at = time.monotonic()
+        self._cycles += 1
+        self.profiler.enter(self._cycles)
+        try:
+            stations = self._init_stations_db()
+            evolutions_count = self._init_bikes_evolution_db(stations)
+        except BaseException:
+            self.profiler.abort(self._cycles)
+            raise
+        stats = {
+            "cycle": self._cycles,
+            "stations": len(stations),
+            "evolutions": evolutions_count,
+            "cycle_duration": time.monotonic() - started_at,
+        }
+        record_cycle_metrics(stats)
+        self.profiler.finish(self._cycles, stats)
+        return stats
+
+    def make_pipeline(self, scan_interval: float = 60.0, progress_path: Path | None = None,
+                      on_cycle: Callable[[dict], None] | None = None) -> CollectorPipeline:
+        """To scan the city continuously, see `CollectorPipeline.run`"""
+        return CollectorPipeline(
+            fetch_stations=self.api_client.get_stations,
+            scanner=self.scanner,
+            db_writer=self.db_writer,
+            snapshot_diff=self.snapshot_diff,
+            scheduler=self.scheduler,
+            scan_budget=self.SCAN_BUDGET,
+            scan_interval=scan_interval,
+            progress_path=progress_path,
+            on_cycle=on_cycle,
+            on_stations=self._on_stations,
+            profiler=self.profiler,
+        )
+
+    def close(self):
+        if self.availability is not None:
+            self.availability.flush()
+        self.db_writer.close()
+        self.api_client.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.db.close()
 
     def _debug_one_shot_csv(self):
         raw_stations = self.api_client.get_stations()
@@ -81,11 +225,141 @@ class VilloTrackerApp:
                 bike_writer.writerow(BikeCSVSerializer.get_row(bike))
 
 
+def run_city(city: CityConfig, reports: multiprocessing.Queue, stop: multiprocessing.synchronize.Event):
+    """Worker process of a city, see `CitySupervisor`"""
+    # The supervisor tells us when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # SIGUSR1 is forwarded by the supervisor, to profile the next cycles: blocked until handled, see `CitySupervisor`
+    profiler = CycleProfiler.from_env(city.name)
+    profiler.install_signal_handler()
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+    metrics_server = None
+    if city.metrics_port is not None or city.metrics_json is not None:
+        metrics.enable()
+    if city.metrics_port is not None:
+        metrics_server = MetricsServer(city.metrics_port).start()
+
+    def on_cycle(stats: dict):
+        reports.put({"city": city.name, "reported_at": time.time(), **stats})
+        if city.metrics_json is not None:
+            metrics.dump_json(city.metrics_json)
+
+    app = VilloTrackerApp(
+        baseurl=city.baseurl,
+        db_file_name=city.db_file_name,
+        requests_per_second=city.requests_per_second,
+        # One cache file per city, not to share a file between processes
+        cache=DiscoveryCache(Path(f"~/output/discovery_cache_{city.name}.json").expanduser()),
+        profiler=profiler,
+    )
+    pipeline = app.make_pipeline(
+        scan_interval=city.scan_interval,
+        progress_path=Path(f"~/output/pipeline_progress_{city.name}.json").expanduser(),
+        on_cycle=on_cycle,
+    )
+
+    def wait_for_stop():
+        stop.wait()
+        pipeline.stop()
+
+    threading.Thread(target=wait_for_stop, name="stop-waiter", daemon=True).start()
+    try:
+        pipeline.run()
+    finally:
+        app.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+def run_cities(cities: list[CityConfig]):
+    supervisor = CitySupervisor(cities, worker=run_city)
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.request_stop())
+    signal.signal(signal.SIGINT, lambda *_: supervisor.request_stop())
+    signal.signal(signal.SIGUSR1, lambda *_: supervisor.signal_workers(signal.SIGUSR1))
+    supervisor.run()
+    reader = CityReader(cities)
+    try:
+        for city, stations in reader.find_all_stations().items():
+            log.info("Collected count=%d stations for city=%s", len(stations), city)
+    finally:
+        reader.close()
+
+
 if __name__ == "__main__":
-    app = VilloTrackerApp()
-    app._init_stations_db()
-    app._init_bikes_evolution_db()
-    app._debug_one_shot_csv()
+    parser = argparse.ArgumentParser(description="Tracks the bikes of JCDecaux bike sharing systems, at the bike level.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Continuously collect Brussels, until SIGTERM (SIGUSR1 profiles the next cycles, see "
+                             "`component.profiling`)")
+    parser.add_argument("--cities", nargs="+", choices=sorted(VilloTrackerApp.CITIES),
+                        help="Continuously collect these cities, each one in its own process")
+    parser.add_argument("--baseurl", default=VilloTrackerApp.BRUSSELS_WEBSITE,
+                        help="Website to collect, e.g. the one of `python -m utils.fake_api_server`")
+    parser.add_argument("--db-file-name", default=None,
+                        help="Name of the database file in ~/output/ (default: commercial_bike.db)")
+    parser.add_argument("--record", type=Path, default=None,
+                        help="Records the HTTP exchanges in this directory, to be replayed by `utils.fake_api_server`")
+    parser.add_argument("--no-archive", action="store_true",
+                        help="Does not archive the raw responses of the API (in ~/output/<db file name>.archive/)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serves the metrics at http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json. "
+                             "With --cities, each city gets the next port")
+    parser.add_argument("--metrics-json", type=Path, default=None,
+                        help="Dumps the metrics as JSON in this file after each scan cycle. With --cities, each city "
+                             "dumps its own, suffixed by its name (by default with --metrics-port: "
+                             "~/output/metrics_{city}.json)")
+    args = parser.parse_args()
+
+    metrics_server = None
+    if args.metrics_port is not None or args.metrics_json is not None:
+        metrics.enable()
+    if args.metrics_port is not None and not args.cities:
+        metrics_server = MetricsServer(args.metrics_port).start()
+
+    def dump_metrics(stats: dict | None = None):
+        if args.metrics_json is not None:
+            metrics.dump_json(args.metrics_json)
+
+    def make_app() -> VilloTrackerApp:
+        return VilloTrackerApp(
+            baseurl=args.baseurl,
+            db_file_name=args.db_file_name,
+            session=RecordingHttpSession(args.record) if args.record else None,
+            archive=not args.no_archive,
+        )
+
+    if args.cities:
+        cities = [VilloTrackerApp.CITIES[name] for name in args.cities]
+        # The metrics of each city are in its own worker process, hence on its own port, and in its own file
+        if args.metrics_port is not None:
+            cities = [dataclasses.replace(city, metrics_port=args.metrics_port + index) for index, city in enumerate(cities)]
+        if args.metrics_json is not None:
+            cities = [dataclasses.replace(
+                city, metrics_json=args.metrics_json.with_name(f"{args.metrics_json.stem}_{city.name}{args.metrics_json.suffix}"),
+            ) for city in cities]
+        elif args.metrics_port is not None:
+            cities = [dataclasses.replace(
+                city, metrics_json=Path(f"~/output/metrics_{city.name}.json").expanduser(),
+            ) for city in cities]
+        run_cities(cities)
+    elif args.daemon:
+        app = make_app()
+        app.profiler.install_signal_handler()
+        pipeline = app.make_pipeline(on_cycle=dump_metrics)
+        signal.signal(signal.SIGTERM, lambda *_: pipeline.stop())
+        signal.signal(signal.SIGINT, lambda *_: pipeline.stop())
+        try:
+            pipeline.run()
+        finally:
+            app.close()
+    else:
+        app = make_app()
+        app.run_cycle()
+        app._debug_one_shot_csv()
+        app.close()
+        dump_metrics()
+    if metrics_server is not None:
+        metrics_server.close()
 
     # TODO
     #    * Create an SQLite DB
@@ -0,0 +1,269 @@
+"""
+City-wide availability time series: the availabilities of all the stations, at each poll of the stations, as
+fixed-layout arrays in a memory-mapped ring buffer on disk.
+
+Each poll is a frame of shape (max_stations, len(AVAILABILITY_FIELDS)), of int16, indexed by the ordinal of the
+stations: their `stations.rowid` (the same as `bikes_evolution.station_id`), which never changes. A station absent
+from a poll has MISSING counts. Each frame costs max_stations * 7 * 2 bytes (14KB for 1024 stations), and the
+queries run over whole arrays.
+
+`max_stations` is sized from the stations known at creation, with some headroom, and grown (all the frames copied
+into a larger file) when a station with a greater ordinal shows up.
+"""
+import datetime
+import json
+import logging
+import os
+import pathlib
+from typing import Iterable
+
+import numpy as np
+
+from model.station_api import Station
+
+log = logging.getLogger(__name__)
+
+# The counts of `Station.totalStands` kept in each frame, in this order
+AVAILABILITY_FIELDS = (
+    "bikes",
+    "electricalBikes",
+    "electricalInternalBatteryBikes",
+    "electricalRemovableBatteryBikes",
+    "mechanicalBikes",
+    "stands",
+    "capacity",
+)
+FIELD_INDEXES = {name: index for index, name in enumerate(AVAILABILITY_FIELDS)}
+
+COUNT_DTYPE = np.int16
+MISSING = -1
+
+# Frames copied at once when growing max_stations
+GROW_CHUNK_SLOTS = 1024
+
+
+def stations_capacity(ordinals: int) -> int:
+    """The max_stations giving room to the given count of ordinals and a quarter more, in a multiple of 64"""
+    return (ordinals + ordinals // 4 + 64) // 64 * 64
+
+
+class StationSnapshotFrame:
+    """The availabilities of all the stations at one poll, see the module documentation"""
+    __slots__ = ("at", "counts")
+
+    def __init__(self, at: int, counts: np.ndarray) -> None:
+        # Epoch seconds
+        self.at = at
+        self.counts = counts
+
+    @classmethod
+    def from_stations(
+            cls,
+            stations: Iterable[Station],
+            ordinals: dict[int, int],
+            max_stations: int,
+            at: datetime.datetime | None = None,
+    ) -> 'StationSnapshotFrame':
+        """`ordinals` are the ordinals of the stations (i.e. their `stations.rowid`) by station number"""
+        counts = np.full((max_stations, len(AVAILABILITY_FIELDS)), MISSING, dtype=COUNT_DTYPE)
+        rows, values, left_out = [], [], []
+        for station in stations:
+            ordinal = ordinals.get(station.number)
+            if ordinal is None or ordinal >= max_stations:
+                left_out.append(station.number)
+                continue
+            availabilities = station.totalStands.availabilities
+            rows.append(ordinal)
+            values.append([
+                MISSING if value is None else value
+                for value in (
+                    availabilities.bikes,
+                    availabilities.electricalBikes,
+                    availabilities.electricalInternalBatteryBikes,
+                    availabilities.electricalRemovableBatteryBikes,
+                    availabilities.mechanicalBikes,
+                    availabilities.stands,
+                    station.totalStands.capacity,
+                )
+            ])
+        if rows:
+            counts[rows] = np.asarray(values, dtype=COUNT_DTYPE)
+        if left_out:
+            log.warning("No room for count=%d stations in frames of max_stations=%d, e.g. station=%s",
+                        len(left_out), max_stations, left_out[0])
+        return cls(int((at or datetime.datetime.now()).timestamp()), counts)
+
+    def field(self, name: str) -> np.ndarray:
+        """The given count of all the stations, by ordinal"""
+        return self.counts[:, FIELD_INDEXES[name]]
+
+    def present(self) -> np.ndarray:
+        """Mask of the stations in this poll"""
+        return self.counts[:, FIELD_INDEXES["capacity"]] != MISSING
+
+
+class AvailabilityRingBuffer:
+    """
+    The latest `slots` frames, memory-mapped from the files of the `path` directory. Once full, each new frame
+    replaces the oldest one.
+
+    The slots and fields are fixed at creation, opening the files with others fails. `max_stations` is a minimum:
+    the frames are grown to it if smaller, see `grow`.
+    """
+
+    def __init__(self, path: pathlib.Path, slots: int = 7 * 24 * 60, max_stations: int = 1024) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        layout_path = path / "layout.json"
+        if layout_path.exists():
+            existing_layout = json.loads(layout_path.read_text())
+            if (existing_layout["slots"], existing_layout["fields"]) != (slots, list(AVAILABILITY_FIELDS)):
+                raise ValueError(f"The availability frames at path={path} have another layout={existing_layout}")
+            self.max_stations = existing_layout["max_stations"]
+        else:
+            self.max_stations = max_stations
+        self.slots = slots
+        self._write_layout()
+
+        # Sparse files: the disk space is only taken by the slots written
+        self.times = self._open(path / "times.i8", np.int64, (slots,))
+        self.counts = self._open_counts(self.max_stations)
+        # Left by a grow interrupted before its end
+        for stale_path in path.glob("counts-*.i2"):
+            if stale_path != self._counts_path(self.max_stations):
+                stale_path.unlink()
+        # The slot of the next frame: after the most recent one
+        self._next_slot = int(np.argmax(self.times)) + 1 if self.times.any() else 0
+        self.grow(max_stations)
+
+    @staticmethod
+    def _open(path: pathlib.Path, dtype: type, shape: tuple[int, ...]) -> np.memmap:
+        return np.memmap(path, dtype=dtype, mode="r+" if path.exists() else "w+", shape=shape)
+
+    def _counts_path(self, max_stations: int) -> pathlib.Path:
+        return self.path / f"counts-{max_stations}.i2"
+
+    def _open_counts(self, max_stations: int) -> np.memmap:
+        return self._open(self._counts_path(max_stations), COUNT_DTYPE,
+                          (self.slots, max_stations, len(AVAILABILITY_FIELDS)))
+
+    def _write_layout(self) -> None:
+        """Atomically: the layout names the counts file in use"""
+        layout = {"slots": self.slots, "max_stations": self.max_stations, "fields": list(AVAILABILITY_FIELDS)}
+        tmp_path = self.path / "layout.json.tmp"
+        tmp_path.write_text(json.dumps(layout))
+        os.replace(tmp_path, self.path / "layout.json")
+
+    def grow(self, max_stations: int) -> None:
+        """Makes room in all the frames for the ordinals below `max_stations`, the stations added being MISSING"""
+        if max_stations <= self.max_stations:
+            return
+        log.info("Growing the availability frames from max_stations=%d to max_stations=%d",
+                 self.max_stations, max_stations)
+        old_max_stations, old_counts = self.max_stations, self.counts
+        new_path = self._counts_path(max_stations)
+        if new_path.exists():
+            new_path.unlink()
+        counts = self._open_counts(max_stations)
+        written = np.flatnonzero(self.times > 0)
+        for start in range(0, len(written), GROW_CHUNK_SLOTS):
+            slots = written[start:start + GROW_CHUNK_SLOTS]
+            counts[slots, :old_max_stations] = old_counts[slots]
+            counts[slots, old_max_stations:] = MISSING
+        counts.flush()
+        # The new file is only used once the layout names it
+        self.counts, self.max_stations = counts, max_stations
+        self._write_layout()
+        del old_counts
+        self._counts_path(old_max_stations).unlink()
+
+    def append(self, frame: StationSnapshotFrame) -> None:
+        slot = self._next_slot % self.slots
+        # The counts first: a frame is only visible once its time is written
+        self.counts[slot] = frame.counts
+        self.times[slot] = frame.at
+        self._next_slot = slot + 1
+
+    def append_stations(self, stations: list[Station], ordinals: dict[int, int]) -> None:
+        """Appends the frame of the given poll of the stations, see `StationSnapshotFrame.from_stations`"""
+        max_ordinal = max((ordinals.get(station.number, -1) for station in stations), default=-1)
+        if max_ordinal >= self.max_stations:
+            self.grow(stations_capacity(max_ordinal + 1))
+        self.append(StationSnapshotFrame.from_stations(stations, ordinals, self.max_stations))
+
+    def flush(self) -> None:
+        self.counts.flush()
+        self.times.flush()
+
+    def _slots_between(self, since: datetime.datetime | None, until: datetime.datetime | None) -> np.ndarray:
+        """The slots of the frames in the given time range, in chronological order"""
+        mask = self.times > 0
+        if since is not None:
+            mask &= self.times >= int(since.timestamp())
+        if until is not None:
+            mask &= self.times <= int(until.timestamp())
+        slots = np.flatnonzero(mask)
+        return slots[np.argsort(self.times[slots], kind="stable")]
+
+    def frame_at(self, at: datetime.datetime) -> StationSnapshotFrame | None:
+        """The latest frame at the given time, if any"""
+        slots = self._slots_between(None, at)
+        if not len(slots):
+            return None
+        slot = slots[-1]
+        return StationSnapshotFrame(int(self.times[slot]), np.array(self.counts[slot]))
+
+    def empty_stations(self, at: datetime.datetime) -> np.ndarray:
+        """The ordinals of the stations without any bike at the given time"""
+        frame = self.frame_at(at)
+        if frame is None:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(frame.present() & (frame.field("bikes") == 0))
+
+    def full_stations(self, at: datetime.datetime) -> np.ndarray:
+        """The ordinals of the stations without any free stand at the given time"""
+        frame = self.frame_at(at)
+        if frame is None:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(frame.present() & (frame.field("stands") == 0))
+
+    def city_totals(
+            self,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the times of the frames in the given range, and the totals of each field over all the stations at
+        these times, of shape (frames, len(AVAILABILITY_FIELDS)). The missing counts are not added up.
+        """
+        slots = self._slots_between(since, until)
+        counts = self.counts[slots]
+        totals = np.where(counts == MISSING, 0, counts).sum(axis=1, dtype=np.int64)
+        return self.times[slots].copy(), totals
+
+    def rolling_occupancy(
+            self,
+            window: int,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the times of the frames in the given range, and the occupancy of each station (bikes / capacity)
+        averaged over the last `window` frames, of shape (frames, max_stations). NaN where there is no data.
+        """
+        slots = self._slots_between(since, until)
+        bikes = self.counts[slots, :, FIELD_INDEXES["bikes"]].astype(np.float64)
+        capacity = self.counts[slots, :, FIELD_INDEXES["capacity"]].astype(np.float64)
+        known = (bikes != MISSING) & (capacity > 0)
+        occupancy = np.where(known, bikes / np.where(known, capacity, 1), 0.0)
+
+        # Rolling sums as differences of cumulative sums, counting the known values only
+        zeros = np.zeros((1, self.max_stations))
+        sums = np.concatenate([zeros, np.cumsum(occupancy, axis=0)])
+        counts = np.concatenate([zeros, np.cumsum(known, axis=0)])
+        starts = np.maximum(np.arange(1, len(slots) + 1) - window, 0)
+        window_sums = sums[1:] - sums[starts]
+        window_counts = counts[1:] - counts[starts]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rolling = np.where(window_counts > 0, window_sums / window_counts, np.nan)
+        return self.times[slots].copy(), rolling
@@ -0,0 +1,127 @@
+"""
+Periodic checkpoints of the bikes at each station, to rebuild the state of a station at any point in time without
+replaying its whole history.
+
+A checkpoint holds the full set of bikes at a station right after one of its bikes evolutions. The state at a
+time T is the latest checkpoint before T, plus the few bikes evolutions between this checkpoint and T.
+"""
+import array
+import logging
+import sqlite3
+from typing import Iterable
+
+log = logging.getLogger(__name__)
+
+# A bike evolution, as stored in bikes_evolution: (at, station_id, action)
+EncodedEvolution = tuple[int, int, int]
+
+# Packed bikes.id of the bikes in a checkpoint: 4 bytes per bike
+BIKE_IDS_TYPECODE = "i"
+
+# No bound on epoch seconds
+END_OF_TIME = 2 ** 62
+
+# The queries of `station_state_at`, with (station_id, at) and (station_id, last_at, at, last_rowid)
+LATEST_CHECKPOINT_QUERY = """
+    SELECT at, last_rowid, bike_ids
+    FROM station_checkpoints
+    WHERE station_id = ? AND at <= ?
+    ORDER BY at DESC, last_rowid DESC
+    LIMIT 1
+"""
+EVOLUTIONS_SINCE_CHECKPOINT_QUERY = """
+    SELECT rowid, at, bike_id, action
+    FROM bikes_evolution
+    WHERE station_id = ? AND at >= ? AND at <= ? AND rowid > ?
+    ORDER BY at, rowid
+"""
+
+
+def _pack(bike_ids: Iterable[int]) -> bytes:
+    return array.array(BIKE_IDS_TYPECODE, sorted(bike_ids)).tobytes()
+
+
+def _unpack(packed: bytes) -> set[int]:
+    bike_ids = array.array(BIKE_IDS_TYPECODE)
+    bike_ids.frombytes(packed)
+    return set(bike_ids)
+
+
+def station_state_at(cursor: sqlite3.Cursor, station_id: int, at: int = END_OF_TIME) -> tuple[set[int], int, int]:
+    """
+    Returns the bikes (bikes.id) at the given station at the given time (epoch seconds, included),
+    along with the time and the rowid of the latest bike evolution taken into account.
+    """
+    checkpoint = cursor.execute(LATEST_CHECKPOINT_QUERY, (station_id, at)).fetchone()
+    bike_ids, last_at, last_rowid = (_unpack(checkpoint[2]), checkpoint[0], checkpoint[1]) if checkpoint else (set(), 0, 0)
+
+    for rowid, evolution_at, bike_id, action in cursor.execute(
+            EVOLUTIONS_SINCE_CHECKPOINT_QUERY, (station_id, last_at, at, last_rowid)
+    ):
+        if action:
+            bike_ids.add(bike_id)
+        else:
+            bike_ids.discard(bike_id)
+        last_at, last_rowid = evolution_at, rowid
+    return bike_ids, last_at, last_rowid
+
+
+class StationCheckpointer:
+    """
+    Writes a checkpoint of a station once `every_events` bikes evolutions happened there since its latest
+    checkpoint, or once its latest checkpoint is older than `every_seconds` (as soon as a new evolution happens).
+    """
+
+    def __init__(self, every_events: int = 500, every_seconds: int = 3600) -> None:
+        self.every_events = every_events
+        self.every_seconds = every_seconds
+        # station_id -> [count of evolutions since the latest checkpoint, time of the latest checkpoint]
+        self._progress: dict[int, list[int]] = {}
+
+    def _load_progress(self, cursor: sqlite3.Cursor, station_id: int) -> list[int]:
+        # Bounded by `every_events`, except for a station never checkpointed before
+        checkpoint = cursor.execute(
+            """
+            SELECT at, last_rowid
+            FROM station_checkpoints
+            WHERE station_id = ?
+            ORDER BY at DESC, last_rowid DESC
+            LIMIT 1
+            """, (station_id,)
+        ).fetchone()
+        last_at, last_rowid = tuple(checkpoint) if checkpoint else (0, 0)
+        count = cursor.execute(
+            "SELECT count(*) FROM bikes_evolution WHERE station_id = ? AND at >= ? AND rowid > ?",
+            (station_id, last_at, last_rowid),
+        ).fetchone()[0]
+        progress = self._progress[station_id] = [count, last_at]
+        return progress
+
+    def write_checkpoint(self, cursor: sqlite3.Cursor, station_id: int) -> None:
+        bike_ids, last_at, last_rowid = station_state_at(cursor, station_id)
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO station_checkpoints (station_id, at, last_rowid, bike_ids)
+            VALUES (?, ?, ?, ?)
+            """, (station_id, last_at, last_rowid, _pack(bike_ids))
+        )
+        self._progress[station_id] = [0, last_at]
+        log.debug("Checkpointed count=%d bikes at station=%s", len(bike_ids), station_id)
+
+    def after_save(self, cursor: sqlite3.Cursor, evolutions: Iterable[EncodedEvolution]) -> None:
+        """To be called once the given bikes evolutions are saved, in the same transaction"""
+        latest_at_by_station: dict[int, int] = {}
+        count_by_station: dict[int, int] = {}
+        for at, station_id, _ in evolutions:
+            latest_at_by_station[station_id] = max(at, latest_at_by_station.get(station_id, 0))
+            count_by_station[station_id] = count_by_station.get(station_id, 0) + 1
+
+        for station_id, latest_at in latest_at_by_station.items():
+            progress = self._progress.get(station_id)
+            if progress is None:
+                # Loaded after the insert, so the count already includes the new evolutions
+                progress = self._load_progress(cursor, station_id)
+            else:
+                progress[0] += count_by_station[station_id]
+            if progress[0] >= self.every_events or latest_at - progress[1] >= self.every_seconds:
+                self.write_checkpoint(cursor, station_id)
@@ -1,11 +1,22 @@
 import base64
+import codecs
 import datetime
 import json
 import logging
-import urllib.request, urllib.parse
+import urllib.parse
 import re
+import threading
+import urllib.error
 import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
+from typing import Callable, Iterable, NamedTuple, TypeVar
+
+from component.discovery_cache import DiscoveryCache
+from component.http_session import HttpResponse, HttpSession, json_dumps_canonical
+from component.metrics import metrics
+from component.raw_archive import UNCHANGED, RawResponseArchive
+from model.bike_api import BikeBatch
 
 COMPACT_LOG_FORMAT = '%(asctime)s.%(msecs)03d [%(levelname)s] %(name)s - %(message)s'
 logging.basicConfig(level="DEBUG", format=COMPACT_LOG_FORMAT, datefmt="%H:%M:%S")
@@ -27,6 +38,18 @@ JS_OBJ_FIELDS_RE = re.compile(
 CONTRACT_RE = re.compile(r',contract:{(.*?)}')
 STATIONS_RE = re.compile(r'stations:{(.*?)}')
 
+# The JS objects we are looking for are short, a match can never be longer than this (in characters).
+# It is the amount of text kept between two buffers of a streamed JS chunk, for a match to span both of them.
+MAX_JS_OBJ_MATCH_LENGTH = 64 * 1024
+
+# How many JS chunks are downloaded at the same time during the discovery
+DISCOVERY_MAX_WORKERS = 8
+
+# Cached access tokens expiring sooner than this are not reused
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+T = TypeVar("T")
+
 
 class OAuth2Token:
     def __init__(
@@ -86,75 +109,154 @@ def search_config_in_js(
     return js_variables
 
 
+class StreamingJsConfigScanner:
+    """
+    Searches the given regexes in a JavaScript content received piece by piece, keeping the first match of each.
+
+    The end of the text received so far is kept between two calls of `feed`, so that a match spanning over
+    two pieces is still found (as long as it is shorter than `MAX_JS_OBJ_MATCH_LENGTH`).
+    """
+
+    def __init__(self, patterns: dict[str, re.Pattern]) -> None:
+        self.patterns = patterns
+        self.matches: dict[str, str] = {}
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer = ""
+
+    @property
+    def done(self) -> bool:
+        return len(self.matches) == len(self.patterns)
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += self._decoder.decode(data)
+        for name, pattern in self.patterns.items():
+            if name in self.matches:
+                continue
+            match = pattern.search(self._buffer)
+            if match:
+                self.matches[name] = match.group(0)
+        self._buffer = self._buffer[-MAX_JS_OBJ_MATCH_LENGTH:]
+
+
 class CommercialBikeAuthComponent:
-    def __init__(self, baseurl: str):
+    def __init__(self, baseurl: str, session: HttpSession | None = None, cache: DiscoveryCache | None = None):
         self.baseurl = baseurl
+        self.session = session or HttpSession()
+        self.cache = cache or DiscoveryCache()
 
         self.api_contract_info: dict[str, str] = {}
         self.api_stations_info: dict[str, str] = {}
 
-    def _get_website_content_at_path(self, path: str) -> str:
-        url = urllib.parse.urljoin(self.baseurl, path)
-        log.debug(f"Downloading url=%s", url)
+    def _get_mapping_page(self, etag: str | None = None) -> HttpResponse:
+        url = urllib.parse.urljoin(self.baseurl, "/fr/mapping")
         try:
-            with urllib.request.urlopen(url) as response:
-                byte_content = response.read()
-            log.debug(f"Downloaded count=%s bytes from url=%s", len(byte_content), url)
-            return byte_content.decode('utf-8')
+            return self.session.get(url, headers={"If-None-Match": etag} if etag else None)
         except Exception as e:
             raise RuntimeError(f"Failed to download {url}: {e}")
 
-    def _get_oauth2_details(self) -> dict[str, str]:
-        content = self._get_website_content_at_path("/fr/mapping")
-        log.debug("Content downloaded successfully")
+    def _scan_chunk(self, chunk: str, found: threading.Event) -> dict[str, dict[str, str]] | None:
+        """
+        Streams the given JS chunk, looking for the OAuth2, contract and stations configurations.
+        Gives up as soon as `found` is set, i.e. when another chunk already yielded them.
+        """
+        url = urllib.parse.urljoin(self.baseurl, chunk)
+        scanner = StreamingJsConfigScanner({"oauth2": OAUTH2_RE, "contract": CONTRACT_RE, "stations": STATIONS_RE})
+        stream = self.session.stream(url)
+        try:
+            for data in stream:
+                if found.is_set():
+                    log.debug("Configurations already found, cancelling the download of chunk=%s", chunk)
+                    return None
+                scanner.feed(data)
+                if scanner.done:
+                    break
+        finally:
+            # Drops the connection if the chunk was not fully downloaded
+            stream.close()
+
+        if "oauth2" not in scanner.matches:
+            log.info(f"No OAuth2 details found in chunk=%s. Continuing to the next chunk.", chunk)
+            return None
+        configs = {
+            name: search_config_in_js(matched_js, re_pattern_name=scanner.patterns[name], re_pattern_content=JS_OBJ_FIELDS_RE)
+            for name, matched_js in scanner.matches.items()
+        }
+        if not {"authHost", "env", "clientCode", "clientKey"}.issubset(configs["oauth2"].keys()):
+            log.info("Incomplete OAuth2 details found in the raw JavaScript object. Continuing to search in the next chunk.")
+            return None
+        if not scanner.done:
+            log.info("No contract or stations details found next to the OAuth2 details in chunk=%s. "
+                     "Continuing to search in the next chunk.", chunk)
+            return None
+        return configs
+
+    def _get_oauth2_details(self, content: str) -> dict[str, str]:
         # Looking to find all the JS chunks present in the page
         chunks = CHUNK_PATH_RE.findall(content)
         if not chunks:
             raise RuntimeError("No JavaScript chunks found in the page content.")
         log.debug(f"Found {len(chunks)} JavaScript chunks: {chunks}")
 
-        oauth2_details, chunk_content = {}, None
-        while chunks:
-            chunk = chunks.pop()
-            log.debug(f"Processing chunk=%s", chunk)
-            chunk_content = self._get_website_content_at_path(chunk)
-            oauth2_details = search_config_in_js(
-                chunk_content,
-                re_pattern_name=OAUTH2_RE,
-                re_pattern_content=JS_OBJ_FIELDS_RE
-            )
-            if not oauth2_details:
-                log.info(f"No OAuth2 details found in chunk=%s. Continuing to the next chunk.", chunk)
-                continue
-
-            if not {"authHost", "env", "clientCode", "clientKey"}.issubset(oauth2_details.keys()):
-                log.info("Incomplete OAuth2 details found in the raw JavaScript object. Continuing to search in the next chunk.")
-                oauth2_details = {}  # Invalid details, so we delete the dict to avoid confusion.
-                continue
-            # If we reach here, we have found the OAuth2 details in one of the chunks.
-            break
-
-        if not oauth2_details:
+        # All the chunks are scanned at the same time, the first one having all the details wins, and the
+        # download of the other ones is cancelled. The last chunks (the most likely to have the details) go first.
+        configs: dict[str, dict[str, str]] | None = None
+        found = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=DISCOVERY_MAX_WORKERS, thread_name_prefix="discovery")
+        try:
+            futures = {executor.submit(self._scan_chunk, chunk, found): chunk for chunk in reversed(chunks)}
+            for future in as_completed(futures):
+                try:
+                    configs = future.result()
+                except Exception:
+                    log.exception("Failed to scan chunk=%s", futures[future])
+                    continue
+                if configs:
+                    log.debug("Found all the details in chunk=%s", futures[future])
+                    found.set()
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if not configs:
             raise RuntimeError("No OAuth2 details found in the raw JavaScript object. "
                                "You have to update the detection logic in this script to match the current website structure.")
-        log.info(f"Extracted OAuth2 details: {oauth2_details}")
+        log.info(f"Extracted OAuth2 details: {configs['oauth2']}")
 
         # We also extract the contract details from the same JS object.
         # WARNING: THIS IS EXTREMELY WEAK, as it relies on the specific structure of the JS code.
-        self.api_contract_info = search_config_in_js(
-            chunk_content,  # Latest chunk content
-            re_pattern_name=CONTRACT_RE,
-            re_pattern_content=JS_OBJ_FIELDS_RE
-        )
-        self.api_stations_info = search_config_in_js(
-            chunk_content,  # Latest chunk content
-            re_pattern_name=STATIONS_RE,
-            re_pattern_content=JS_OBJ_FIELDS_RE
+        self.api_contract_info = configs["contract"]
+        self.api_stations_info = configs["stations"]
+        return configs["oauth2"]
+
+    def _discover(self, mapping_page: HttpResponse | None = None) -> dict[str, str]:
+        """Runs the full discovery of the website configuration, and saves it in the cache."""
+        mapping_page = mapping_page or self._get_mapping_page()
+        log.debug("Content downloaded successfully")
+        oauth2_details = self._get_oauth2_details(mapping_page.text())
+        self.cache.update(
+            self.baseurl,
+            oauth2=oauth2_details,
+            contract=self.api_contract_info,
+            stations=self.api_stations_info,
+            etag=mapping_page.headers.get("ETag"),
+            validated_at=datetime.datetime.now(datetime.timezone.utc).timestamp(),
+            tokens=None,
         )
         return oauth2_details
 
-    def get_oauth2_tokens(self) -> OAuth2Token:
-        oauth2_details = self._get_oauth2_details()
+    def _save_tokens(self, oauth2_tokens: OAuth2Token) -> OAuth2Token:
+        self.cache.update(self.baseurl, tokens={
+            "auth_host": oauth2_tokens.auth_host,
+            "access_token": oauth2_tokens.access_token,
+            "refresh_token": oauth2_tokens.refresh_token,
+        })
+        return oauth2_tokens
+
+    def forget_oauth2_tokens(self) -> None:
+        """Forgets the cached tokens (e.g. rejected ones), while keeping the cached discovery."""
+        self.cache.update(self.baseurl, tokens=None)
+
+    def _get_client_tokens(self, oauth2_details: dict[str, str]) -> OAuth2Token:
         # Do a POST request to the OAuth2 endpoint to get the client token (access token)
 
         url = oauth2_details["authHost"] + "/environments/" + oauth2_details["env"] + "/client_tokens"
@@ -163,28 +265,69 @@ class CommercialBikeAuthComponent:
             "key": oauth2_details["clientKey"]
         }
         log.debug(f"POSTing to url=%s with body=%s", url, post_body)
-        request = urllib.request.Request(
-            url=url,
-            data=json.dumps(post_body).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        with urllib.request.urlopen(request, timeout=10) as response:  # 10 seconds timeout
-            response_data = response.read()
-        # log.debug(f"Response received with body=%s", response_data)
+        response = self.session.post_json(url, post_body, timeout=10)  # 10 seconds timeout
+        # log.debug(f"Response received with body=%s", response.body)
         log.debug("Got in response headers=%s", response.headers)
-        client_tokens = json.loads(response_data)
+        client_tokens = response.json()
         log.info(f"Received the following client_tokens=%s", client_tokens)
         if not client_tokens:
             raise RuntimeError("No access token found in the response. You have to update the detection logic "
                                "in this script to match the current website structure.")
-        return OAuth2Token(
+        return self._save_tokens(OAuth2Token(
             auth_host=oauth2_details["authHost"],
             access_token=client_tokens['accessToken'],
             refresh_token=client_tokens['refreshToken'],
-        )
+        ))
 
-    @classmethod
-    def refresh_oauth2_tokens(cls, oauth2_tokens: OAuth2Token) -> OAuth2Token:
+    def _get_cached_entry(self) -> dict | None:
+        """
+        Returns the cached discovery of this website, if still valid, revalidating it if stale.
+        Loads the cached contract and stations configurations.
+        """
+        entry = self.cache.get(self.baseurl)
+        if not entry or not entry.get("oauth2"):
+            return None
+        if not self.cache.is_fresh(entry):
+            if not entry.get("etag"):
+                log.info("Cached discovery is stale, and cannot be revalidated")
+                return None
+            mapping_page = self._get_mapping_page(etag=entry["etag"])
+            if mapping_page.status != 304:
+                log.info("The website changed since the cached discovery, discovering it again")
+                self._discover(mapping_page)
+                return self.cache.get(self.baseurl)
+            log.debug("Cached discovery revalidated with etag=%s", entry["etag"])
+            self.cache.update(self.baseurl, validated_at=datetime.datetime.now(datetime.timezone.utc).timestamp())
+        self.api_contract_info = entry["contract"]
+        self.api_stations_info = entry["stations"]
+        return entry
+
+    def get_oauth2_tokens(self, force_discovery: bool = False) -> OAuth2Token:
+        """
+        Returns usable OAuth2 tokens, reusing the cached discovery and tokens when possible.
+        With `force_discovery`, the cache is ignored and the website is discovered again.
+        """
+        entry = None if force_discovery else self._get_cached_entry()
+        if entry is None:
+            return self._get_client_tokens(self._discover())
+
+        if entry.get("tokens"):
+            oauth2_tokens = OAuth2Token(**entry["tokens"])
+            if oauth2_tokens.expires_at > datetime.datetime.now(datetime.timezone.utc) + TOKEN_EXPIRY_MARGIN:
+                log.info("Reusing the cached access token")
+                return oauth2_tokens
+            try:
+                return self.refresh_oauth2_tokens(oauth2_tokens)
+            except urllib.error.HTTPError as e:
+                log.info("Failed to refresh the cached tokens with status=%s, creating new ones", e.code)
+        try:
+            return self._get_client_tokens(entry["oauth2"])
+        except urllib.error.HTTPError as e:
+            log.warning("Cached OAuth2 details rejected with status=%s, discovering them again", e.code)
+            self.cache.invalidate(self.baseurl)
+            return self.get_oauth2_tokens(force_discovery=True)
+
+    def refresh_oauth2_tokens(self, oauth2_tokens: OAuth2Token) -> OAuth2Token:
         # Do a POST request to the OAuth2 endpoint to refresh the client token (access token)
 
         url = oauth2_tokens.auth_host + "/access_tokens"
@@ -192,50 +335,164 @@ class CommercialBikeAuthComponent:
             "refreshToken": oauth2_tokens.refresh_token
         }
         log.debug(f"POSTing to url=%s with body=%s", url, post_body)
-        request = urllib.request.Request(
-            url=url,
-            data=json.dumps(post_body).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        with urllib.request.urlopen(request, timeout=10) as response:
-            response_data = response.read()
-            # log.debug(f"Response received with body=%s", response_data)
-            log.debug("Got in response headers=%s", response.headers)
-        client_tokens = json.loads(response_data)
+        response = self.session.post_json(url, post_body, timeout=10)
+        # log.debug(f"Response received with body=%s", response.body)
+        log.debug("Got in response headers=%s", response.headers)
+        client_tokens = response.json()
         log.info(f"Received the following refreshed client_tokens=%s", client_tokens)
         if not client_tokens:
             raise RuntimeError("No access token found in the response. You have to update the detection logic "
                                "in this script to match the current website structure.")
-        return OAuth2Token(
+        return self._save_tokens(OAuth2Token(
             auth_host=oauth2_tokens.auth_host,
             refresh_token=oauth2_tokens.refresh_token,
             # New access token
             access_token=client_tokens['accessToken'],
-        )
+        ))
 
 
+class _CurrentTokens(NamedTuple):
+    tokens: OAuth2Token
+    authorization_header: str
+    expires_at: datetime.datetime
 
-class CommercialBikeClient:
-    def __init__(self, baseurl: str):
-        self.auth = CommercialBikeAuthComponent(baseurl)
 
-        # Internal cache, not to be used directly.
-        self._cached_oauth2_tokens = self.auth.get_oauth2_tokens()
+class TokenManager:
+    """
+    Keeps the OAuth2 tokens valid, refreshing them ahead of their expiry, in a background thread.
+
+    The current tokens are swapped as a whole (a single reference assignment), so that they can be read without
+    any lock on the request path. Refreshes are single-flight: concurrent callers asking for a refresh share the
+    result of the one in progress, instead of each doing their own.
+    """
+
+    def __init__(
+            self,
+            auth: CommercialBikeAuthComponent,
+            refresh_ahead: datetime.timedelta = datetime.timedelta(minutes=30),
+            retry_delay: datetime.timedelta = datetime.timedelta(seconds=30),
+    ) -> None:
+        self.auth = auth
+        # Tokens are valid for around 2h
+        self.refresh_ahead = refresh_ahead
+        self.retry_delay = retry_delay
+        self.refresh_count = 0
+
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._current = self._wrap(auth.get_oauth2_tokens())
+        self._thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _wrap(tokens: OAuth2Token) -> _CurrentTokens:
+        return _CurrentTokens(tokens, f"Taknv1 {tokens.access_token}", tokens.expires_at)
+
+    @property
+    def tokens(self) -> OAuth2Token:
+        return self._current.tokens
+
+    def authorization_header(self) -> str:
+        current = self._current
+        if current.expires_at <= datetime.datetime.now(datetime.timezone.utc):
+            # Only when the background refresh could not keep up (e.g. the machine was suspended)
+            log.warning("Access token expired, refreshing it on the request path")
+            current = self._wrap(self.refresh(rejected=current.tokens))
+        return current.authorization_header
+
+    def refresh(self, rejected: OAuth2Token | None = None, force_discovery: bool = False) -> OAuth2Token:
+        """
+        Refreshes the tokens, and returns the new ones.
+
+        With `rejected`, the refresh is skipped if the current tokens are no longer the rejected ones, i.e. when
+        another caller refreshed them in the meantime. With `force_discovery`, the website is discovered again.
+        """
+        with self._refresh_lock:
+            current = self._current.tokens
+            if rejected is not None and current is not rejected:
+                return current
+
+            if force_discovery:
+                new_tokens = self.auth.get_oauth2_tokens(force_discovery=True)
+            else:
+                try:
+                    new_tokens = self.auth.refresh_oauth2_tokens(current)
+                except urllib.error.HTTPError as e:
+                    log.warning("Refresh token rejected with status=%s, getting new tokens", e.code)
+                    self.auth.forget_oauth2_tokens()
+                    new_tokens = self.auth.get_oauth2_tokens()
+            self._current = self._wrap(new_tokens)
+            self.refresh_count += 1
+            metrics.inc("token_refreshes_total")
+            log.info("Access token refreshed, now expiring at %s", self._current.expires_at)
+            return new_tokens
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            current = self._current
+            refresh_in = current.expires_at - self.refresh_ahead - datetime.datetime.now(datetime.timezone.utc)
+            if refresh_in.total_seconds() > 0:
+                # Waking up regularly, in case the tokens were replaced in the meantime
+                self._stop.wait(min(refresh_in.total_seconds(), 60))
+                continue
+            try:
+                self.refresh(rejected=current.tokens)
+            except Exception:
+                log.exception("Failed to refresh the access token, retrying in %s", self.retry_delay)
+                self._stop.wait(self.retry_delay.total_seconds())
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+class CommercialBikeClient:
+    def __init__(
+            self,
+            baseurl: str,
+            session: HttpSession | None = None,
+            cache: DiscoveryCache | None = None,
+            archive: RawResponseArchive | None = None,
+    ):
+        # The same keep-alive connections are shared by the authentication and the API calls
+        self.session = session or HttpSession()
+        self.auth = CommercialBikeAuthComponent(baseurl, session=self.session, cache=cache)
+        self.token_manager = TokenManager(self.auth)
+        # Where the raw responses of the API are archived, if anywhere
+        self.archive = archive
 
     def api_authorization_header(self) -> str:
         """
         Returns the authorization header to be used in API requests.
         """
-        if self._cached_oauth2_tokens.expires_at < datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=30):
-            # Tokens are valid for around 2h
-            log.info("Access token is expired or about to expire, refreshing it.")
-            self._cached_oauth2_tokens = self.auth.refresh_oauth2_tokens(self._cached_oauth2_tokens)
-        return f"Taknv1 {self._cached_oauth2_tokens.access_token}"
+        return self.token_manager.authorization_header()
+
+    def _with_rediscovery(self, api_call: Callable[[], T]) -> T:
+        """
+        Runs the given API call, and if it is rejected as unauthorized, discovers the website configuration
+        again (the cached one no longer works) before retrying it once.
+        """
+        used_tokens = self.token_manager.tokens
+        try:
+            return api_call()
+        except urllib.error.HTTPError as e:
+            if e.code != 401:
+                raise
+            log.warning("API call rejected as unauthorized, discovering the website configuration again")
+            self.token_manager.refresh(rejected=used_tokens, force_discovery=True)
+            return api_call()
+
+    def close(self) -> None:
+        self.token_manager.close()
+        self.session.close()
 
     def get_stations(self) -> list[dict[str, str]]:
         """
         Returns the stations information from the API.
         """
+        return self._with_rediscovery(self._get_stations)
+
+    def _get_stations(self) -> list[dict[str, str]]:
         # Call to GET self.auth.api_station['url'] to get the stations information with QS `apiKey` and `contract` set
         url = self.auth.api_stations_info['url']
         params = {
@@ -243,38 +500,102 @@ class CommercialBikeClient:
             'contract': self.auth.api_contract_info['name']
         }
         log.debug(f"GETing url=%s with params=%s", url, params)
-        request = urllib.request.Request(
-            url=url + '?' + urllib.parse.urlencode(params),
-            headers={'Authorization': self.api_authorization_header()}
-        )
-        with urllib.request.urlopen(request, timeout=10) as response:
-            response_data = response.read()
-            # log.debug(f"Response received with body=%s", response_data)
-            log.debug("Got in response headers=%s", response.headers)
-        stations_info = json.loads(response_data)
+        with metrics.timer("api_request_seconds", endpoint="stations", station=""):
+            response = self.session.get(url, params=params, headers={'Authorization': self.api_authorization_header()})
+        metrics.inc("api_response_bytes_total", len(response.body), endpoint="stations")
+        # log.debug(f"Response received with body=%s", response.body)
+        log.debug("Got in response headers=%s", response.headers)
+        with metrics.timer("decode_seconds", model="stations_json"):
+            stations_info = response.json()
+        if self.archive is not None:
+            # Station by station, as the availabilities of some of them change at every poll
+            for station in stations_info:
+                self.archive.store("stations", station.get('number'), json_dumps_canonical(station))
         return stations_info
 
-    def get_bikes_at_station(self, station_id: str) -> list[dict[str, str]]:
+    def _get_bikes(self, params: dict[str, str], timeout: int = 10) -> HttpResponse:
+        # Call to GET self.auth.api_station['url'] with QS `apiKey` and `contract` set
+        url = urllib.parse.urljoin(self.token_manager.tokens.auth_host, f"/contracts/{self.auth.api_contract_info['name']}/bikes")
+        log.debug(f"GETing url=%s with params=%s", url, params)
+        # The whole contract when without a station
+        station = params.get('stationNumber', "")
+        with metrics.timer("api_request_seconds", endpoint="bikes", station=station):
+            response = self.session.get(
+                url,
+                params=params,
+                headers={
+                    'Authorization': self.api_authorization_header(),
+                    "Accept": "application/vnd.bikes.v4+json"
+                },
+                timeout=timeout,
+            )
+        metrics.inc("api_response_bytes_total", len(response.body), endpoint="bikes")
+        # log.debug(f"Response received with body=%s", response.body)
+        log.debug("Got in response headers=%s", response.headers)
+        return response
+
+    @staticmethod
+    def _decode_bikes(response: HttpResponse) -> list[dict[str, str]]:
+        with metrics.timer("decode_seconds", model="bikes_json"):
+            return response.json()
+
+    def get_bikes_at_station(
+            self,
+            station_id: str,
+            fields: tuple[str, ...] | None = None,
+            skip_unchanged: bool = False,
+    ) -> list[dict[str, str]] | BikeBatch | str:
         """
         Returns the bikes information at a specific station.
+
+        With `fields`, returns only these fields of the bikes, see `BikeBatch`. With `skip_unchanged` (and an
+        archive), returns `UNCHANGED` when the response is the same as at the previous fetch of this station.
         """
-        # Call to GET self.auth.api_station['url'] with QS `apiKey` and `contract` set
-        url = urllib.parse.urljoin(self._cached_oauth2_tokens.auth_host, f"/contracts/{self.auth.api_contract_info['name']}/bikes")
-        params = {
-            'stationNumber': station_id
-        }
-        log.debug(f"GETing url=%s with params=%s", url, params)
-        request = urllib.request.Request(
-            url=url + '?' + urllib.parse.urlencode(params),
-            headers={
-                'Authorization': self.api_authorization_header(),
-                "Accept": "application/vnd.bikes.v4+json"
-            }
-        )
-        with urllib.request.urlopen(request, timeout=10) as response:
-            response_data = response.read()
-            # log.debug(f"Response received with body=%s", response_data)
-            log.debug("Got in response headers=%s", response.headers)
-        bikes_info = json.loads(response_data)
-        return bikes_info
+        response = self._with_rediscovery(lambda: self._get_bikes({'stationNumber': station_id}))
+        if self.archive is not None:
+            changed = self.archive.store("bikes", int(station_id), response.body)
+            if skip_unchanged and not changed:
+                return UNCHANGED
+        bikes_info = self._decode_bikes(response)
+        if fields is None:
+            return bikes_info
+        with metrics.timer("decode_seconds", model="bike_batch"):
+            return BikeBatch.from_dicts(bikes_info, fields)
+
+    def get_bikes_by_station(
+            self,
+            station_numbers: Iterable[int] | None = None,
+            fields: tuple[str, ...] | None = None,
+            skip_unchanged: bool = False,
+    ) -> dict[int, list[dict[str, str]] | BikeBatch | str]:
+        """
+        Returns the bikes information of the whole contract, in a single request, grouped by station number.
+        The given `station_numbers` absent from the response are included, without any bike (unless the response
+        has no bike at all, then it is returned as is). With `fields`, returns only these fields of the bikes of
+        each station, see `BikeBatch`. With `skip_unchanged` (and an archive), a station is `UNCHANGED` when its
+        bikes are the same as at its previous fetch.
 
+        Raises `urllib.error.HTTPError` if the API refuses to list the bikes without a station number.
+        """
+        response = self._with_rediscovery(lambda: self._get_bikes({}, timeout=60))  # The whole contract is a much bigger response
+        bikes_by_station: dict[int, list[dict[str, str]]] = {}
+        for bike in self._decode_bikes(response):
+            bikes_by_station.setdefault(bike.get('stationNumber'), []).append(bike)
+        log.debug("Got the bikes of count=%d stations in a single request", len(bikes_by_station))
+        if bikes_by_station and station_numbers is not None:
+            # Emptied since their previous fetch: archived as such, for their next bikes to be a change
+            for number in station_numbers:
+                bikes_by_station.setdefault(number, [])
+        unchanged: set[int] = set()
+        if self.archive is not None:
+            # Station by station, as a single bike moving anywhere changes the whole response. In a canonical form
+            # (the bikes by id, their keys sorted), not to depend on the order of the response.
+            for number, bikes in bikes_by_station.items():
+                payload = json_dumps_canonical(sorted(bikes, key=lambda bike: str(bike.get('id'))))
+                if not self.archive.store("bikes", number, payload) and skip_unchanged:
+                    unchanged.add(number)
+        with metrics.timer("decode_seconds", model="bike_batch"):
+            return {
+                number: UNCHANGED if number in unchanged else bikes if fields is None else BikeBatch.from_dicts(bikes, fields)
+                for number, bikes in bikes_by_station.items()
+            }
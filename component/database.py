@@ -1,8 +1,20 @@
+import datetime
 import logging
 import os
 import sqlite3
 import pathlib
-from typing import Any
+from typing import Any, Iterable
+
+from component.checkpoints import (
+    END_OF_TIME,
+    EVOLUTIONS_SINCE_CHECKPOINT_QUERY,
+    LATEST_CHECKPOINT_QUERY,
+    StationCheckpointer,
+    station_state_at,
+)
+from component.metrics import metrics
+from component.rollups import apply_to_rollups, rebuild_rollups
+from component.trips import TripBuilder
 
 log = logging.getLogger(__name__)
 
@@ -16,6 +28,162 @@ if sqlite3.sqlite_version_info < (3, 35):
     raise RuntimeError("sqlite3 version must be >=3.35.0")
 
 
+# The successive changes of the schema, once the tables are created. Each migration is a list of statements,
+# run in a single transaction. The number of migrations applied to a database is its `PRAGMA user_version`.
+# NEVER edit a migration once released, add a new one instead.
+MIGRATIONS: list[list[str]] = [
+    # 1: indexes for the per-station, per-bike and time-window lookups. The first two are covering indexes,
+    # i.e. the lookups are answered from the index alone, without reading the table.
+    [
+        "CREATE INDEX IF NOT EXISTS bikes_evolution_station_id_at ON bikes_evolution (station_id, at, bike_id, action)",
+        "CREATE INDEX IF NOT EXISTS bikes_evolution_bike_id_at ON bikes_evolution (bike_id, at, station_id, action)",
+        "CREATE INDEX IF NOT EXISTS bikes_evolution_at ON bikes_evolution (at)",
+    ],
+    # 2: compact storage of bikes_evolution: the bike UUIDs are interned in the `bikes` table, `at` is stored as
+    # integer epoch seconds, and `action` as an integer (see ACTION_CODES). The rowids are kept as-is.
+    [
+        """
+        CREATE TABLE bikes
+        (
+            id   INTEGER PRIMARY KEY,  -- the internal id of the bike, used in bikes_evolution.bike_id
+            uuid TEXT NOT NULL UNIQUE  -- the UUID of the bike, as given by the API
+        )
+        """,
+        "INSERT INTO bikes (uuid) SELECT bike_id FROM bikes_evolution GROUP BY bike_id ORDER BY min(rowid)",
+        """
+        CREATE TABLE bikes_evolution_compact
+        (
+            at         INTEGER NOT NULL,                            -- epoch, in seconds
+            station_id INTEGER NOT NULL REFERENCES stations (rowid), -- the internal id of the station (NOT THE API number of this station) -- i.e. the stations.rowid value !!!
+            bike_id    INTEGER NOT NULL REFERENCES bikes (id),       -- the internal id of the bike (NOT ITS UUID) -- i.e. the bikes.id value !!!
+            action     INTEGER NOT NULL                             -- 1 for IN, and 0 for OUT: what this bike did at this station
+        )
+        """,
+        # The ISO dates were written from local naive datetimes: 'utc' converts them from local time to UTC
+        """
+        INSERT INTO bikes_evolution_compact (rowid, at, station_id, bike_id, action)
+        SELECT e.rowid, CAST(strftime('%s', e.at, 'utc') AS INTEGER), e.station_id, b.id, e.action = 'I'
+        FROM bikes_evolution e
+                 JOIN bikes b ON b.uuid = e.bike_id
+        """,
+        "DROP TABLE bikes_evolution",
+        "ALTER TABLE bikes_evolution_compact RENAME TO bikes_evolution",
+        "CREATE INDEX bikes_evolution_station_id_at ON bikes_evolution (station_id, at, bike_id, action)",
+        "CREATE INDEX bikes_evolution_bike_id_at ON bikes_evolution (bike_id, at, station_id, action)",
+        "CREATE INDEX bikes_evolution_at ON bikes_evolution (at)",
+    ],
+    # 3: per-station occupancy rollups, see component/rollups.py. Existing databases have to be backfilled
+    # with `python -m utils.rebuild_rollups`.
+    [
+        """
+        CREATE TABLE station_occupancy
+        (
+            station_id INTEGER PRIMARY KEY REFERENCES stations (rowid),
+            bikes      INTEGER NOT NULL, -- the number of bikes at the station, after the latest evolution rolled up
+            last_at    INTEGER NOT NULL  -- epoch, in seconds, of the latest evolution rolled up
+        )
+        """,
+        """
+        CREATE TABLE station_rollups
+        (
+            resolution INTEGER NOT NULL,                            -- length of the bucket, in seconds
+            station_id INTEGER NOT NULL REFERENCES stations (rowid),
+            bucket     INTEGER NOT NULL,                            -- epoch, in seconds, of the start of the bucket
+            arrivals   INTEGER NOT NULL,                            -- count of IN during the bucket
+            departures INTEGER NOT NULL,                            -- count of OUT during the bucket
+            min_bikes  INTEGER NOT NULL,                            -- min count of bikes after an evolution of the bucket
+            max_bikes  INTEGER NOT NULL,                            -- max count of bikes after an evolution of the bucket
+            last_bikes INTEGER NOT NULL,                            -- count of bikes at the end of the bucket
+            PRIMARY KEY (resolution, station_id, bucket)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 4: periodic checkpoints of the bikes at each station, see component/checkpoints.py
+    [
+        """
+        CREATE TABLE station_checkpoints
+        (
+            station_id INTEGER NOT NULL REFERENCES stations (rowid),
+            at         INTEGER NOT NULL, -- epoch, in seconds, of the latest bike evolution included
+            last_rowid INTEGER NOT NULL, -- bikes_evolution.rowid of the latest bike evolution included
+            bike_ids   BLOB    NOT NULL, -- the bikes.id of the bikes at the station, packed as 32-bit integers
+            PRIMARY KEY (station_id, at, last_rowid)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 5: trips of the bikes, see component/trips.py. The index on `at` gets `action`, as the trips are built from
+    # the bikes evolutions in (at, action, rowid) order.
+    [
+        "DROP INDEX bikes_evolution_at",
+        "CREATE INDEX bikes_evolution_at_action ON bikes_evolution (at, action)",
+        """
+        CREATE TABLE trips
+        (
+            bike_id          INTEGER NOT NULL REFERENCES bikes (id),
+            start_station_id INTEGER NOT NULL REFERENCES stations (rowid),
+            start_at         INTEGER NOT NULL, -- epoch, in seconds, of the OUT
+            end_station_id   INTEGER NOT NULL REFERENCES stations (rowid),
+            end_at           INTEGER NOT NULL, -- epoch, in seconds, of the IN
+            duration         INTEGER NOT NULL  -- in seconds
+        )
+        """,
+        "CREATE INDEX trips_start_at ON trips (start_at)",
+        """
+        CREATE TABLE trips_open_departures
+        (
+            bike_id    INTEGER PRIMARY KEY REFERENCES bikes (id),
+            station_id INTEGER NOT NULL REFERENCES stations (rowid),
+            at         INTEGER NOT NULL -- epoch, in seconds, of the OUT
+        )
+        """,
+        """
+        CREATE TABLE trips_progress -- a single row: the latest bike evolution taken into account
+        (
+            last_at     INTEGER NOT NULL,
+            last_action INTEGER NOT NULL,
+            last_rowid  INTEGER NOT NULL
+        )
+        """,
+    ],
+    # 6: the arrivals detected before their departure, not matched yet, see component/trips.py
+    [
+        """
+        CREATE TABLE trips_unmatched_arrivals
+        (
+            bike_id    INTEGER PRIMARY KEY REFERENCES bikes (id),
+            station_id INTEGER NOT NULL REFERENCES stations (rowid),
+            at         INTEGER NOT NULL -- epoch, in seconds, of the IN
+        )
+        """,
+    ],
+]
+
+# How `bikes_evolution.action` is stored: I for IN, and O for OUT
+ACTION_CODES = {"I": 1, "O": 0}
+ACTIONS_BY_CODE = {code: action for action, code in ACTION_CODES.items()}
+
+
+def to_epoch(at: datetime.datetime) -> int:
+    return int(at.timestamp())
+
+
+def from_epoch(at: int) -> datetime.datetime:
+    # Naive local datetimes, same as the ones given to `save_bikes_evolutions`
+    return datetime.datetime.fromtimestamp(at)
+
+
+def _time_range_clause(since: datetime.datetime | None, until: datetime.datetime | None) -> tuple[str, dict[str, Any]]:
+    """SQL condition (and its parameters) selecting `since <= at < until`, a missing bound being open."""
+    clauses, params = [], {}
+    if since is not None:
+        clauses.append("e.at >= :since")
+        params["since"] = to_epoch(since)
+    if until is not None:
+        clauses.append("e.at < :until")
+        params["until"] = to_epoch(until)
+    return " AND ".join(clauses) or "1", params
+
+
 class Database:
     def __init__(self, file_name: str | None = None) -> None:
         self.file_name = file_name or "commercial_bike.db"
@@ -26,6 +194,10 @@ class Database:
             self._create_tables()
         self.connection = self.get_connection()
         self.cursor = self.connection.cursor()
+        self._migrate()
+        # Cache of the bikes UUIDs already interned, i.e. bikes.uuid -> bikes.id
+        self._bike_ids: dict[str, int] = {}
+        self.checkpointer = StationCheckpointer()
 
     def get_db_path(self) -> pathlib.Path:
         return (OUTPUT_PATH / self.file_name).resolve()
@@ -36,9 +208,24 @@ class Database:
         log.debug("Connecting to database at path=%s", resolved_path)
         connection = sqlite3.connect(resolved_path)
         connection.row_factory = sqlite3.Row  # Results will be returned as dictionaries (ish)
+        # WAL: readers do not block the writer (and vice versa), and a commit appends to the WAL file, instead of
+        # rewriting the pages in place. With synchronous=NORMAL, we only fsync at checkpoints, not at each commit:
+        # a power loss can lose the latest commits, but never corrupts the database.
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA cache_size = -65536")  # Negative means KiB, i.e. 64 MiB
+        connection.execute("PRAGMA temp_store = MEMORY")
         return connection
 
+    def close(self) -> None:
+        self.connection.close()
+
+    def commit(self) -> None:
+        with metrics.timer("db_commit_seconds"):
+            self.connection.commit()
+
     def _create_tables(self):
+        """Creates the initial schema, which is then brought up to date by the MIGRATIONS"""
         connection = self.get_connection()
         connection.execute("""
                            CREATE TABLE stations
@@ -62,20 +249,75 @@ class Database:
                                action     TEXT      NOT NULL                           -- I or O (I for IN, and O for OUT): what this bike did at this statio
                            )
                            """)
-        # TODO maybe create an index on bikes_evolution.station_id to make retrieval faster??
-
         connection.commit()
         connection.close()
 
-    def save_stations(self, stations: list[dict[str, Any]]) -> None:
+    def get_schema_version(self) -> int:
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate(self) -> None:
+        """Applies the migrations not applied yet to this database, in order."""
+        if self.get_schema_version() >= len(MIGRATIONS):
+            return
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            if self.get_schema_version() >= version:
+                continue
+            # IMMEDIATE: takes the write lock right away, as another process may be migrating the same database
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.get_schema_version() >= version:
+                    self.connection.rollback()
+                    continue
+                log.info("Migrating database at path=%s to version=%d", self.get_db_path(), version)
+                for statement in statements:
+                    self.connection.execute(statement)
+                # PRAGMA does not support bound parameters
+                self.connection.execute(f"PRAGMA user_version = {version:d}")
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        self.verify_query_plans()
+
+    def explain_query_plan(self, query: str, params: dict[str, Any] | tuple = ()) -> list[str]:
+        """Returns the details of each step of the query plan SQLite chose for the given query."""
+        return [row["detail"] for row in self.connection.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+    def verify_query_plans(self) -> None:
+        """
+        Checks that the lookups of bikes evolutions are answered with their index, and not by scanning the table
+        (nor by searching another index, e.g. the one on `at` over the whole history). Raises `RuntimeError`
+        otherwise, e.g. when an index is missing.
+        """
+        until = datetime.datetime.now()
+        since = until - datetime.timedelta(days=1)
+        for name, (query, params), index in [
+            ("by_station_id", self._bikes_evolutions_by_station_id_query(0, since, until), "bikes_evolution_station_id_at"),
+            ("by_bike_id", self._bikes_evolutions_by_bike_id_query("", since, until), "bikes_evolution_bike_id_at"),
+            ("between", self._bikes_evolutions_between_query(since, until), "bikes_evolution_at_action"),
+            ("latest_checkpoint", (LATEST_CHECKPOINT_QUERY, (0, END_OF_TIME)), "PRIMARY KEY"),
+            ("since_checkpoint", (EVOLUTIONS_SINCE_CHECKPOINT_QUERY, (0, 0, END_OF_TIME, 0)), "bikes_evolution_station_id_at"),
+        ]:
+            plan = self.explain_query_plan(query, params)
+            if any(step.startswith("SCAN") for step in plan) or not any(index in step for step in plan):
+                raise RuntimeError(f"The query plan of lookup={name} does not use index={index}: {plan}")
+
+    def save_stations(self, stations: list[dict[str, Any]], commit: bool = True) -> None:
         # RETURNING require sqlite3>=3.35.0
         # https://stackoverflow.com/a/60045014
         self.cursor.executemany(
             """
             INSERT INTO stations (number, name, address, latitude, longitude, total_stand_capacity)
             VALUES (:number, :name, :address, :latitude, :longitude, :total_stand_capacity)
+            ON CONFLICT (number) DO UPDATE SET name                 = excluded.name,
+                                               address              = excluded.address,
+                                               latitude             = excluded.latitude,
+                                               longitude            = excluded.longitude,
+                                               total_stand_capacity = excluded.total_stand_capacity
             """, stations)
-        self.connection.commit()
+        metrics.inc("db_rows_written_total", len(stations), table="stations")
+        if commit:
+            self.commit()
 
     def find_all_stations(self) -> list[dict[str, Any]]:
         return self.cursor.execute(
@@ -86,18 +328,205 @@ class Database:
         ).fetchall()
 
     def find_all_bikes_evolutions_by_station_id(self, station_id: int) -> list[dict[str, Any]]:
-        """Return all bikes evolutions by station id, as a list of dicts (more like a list of sqlite3.Row)"""
-        return self.cursor.execute(
-            """SELECT at, station_id, bike_id, action
-               FROM bikes_evolution
-               WHERE station_id = :station_id
-            """, (station_id,)
-        ).fetchall()
+        """Return all bikes evolutions by station id, as a list of dicts"""
+        return self.find_bikes_evolutions_by_station_id(station_id)
+
+    @staticmethod
+    def _bikes_evolutions_by_station_id_query(
+            station_id: int,
+            since: datetime.datetime | None,
+            until: datetime.datetime | None,
+    ) -> tuple[str, dict[str, Any]]:
+        time_range, params = _time_range_clause(since, until)
+        return f"""SELECT e.at, e.station_id, b.uuid AS bike_id, e.action
+                   FROM bikes_evolution e
+                            JOIN bikes b ON b.id = e.bike_id
+                   WHERE e.station_id = :station_id AND {time_range}
+                   ORDER BY e.at
+                """, {"station_id": station_id, **params}
+
+    def find_bikes_evolutions_by_station_id(
+            self,
+            station_id: int,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> list[dict[str, Any]]:
+        """Return the bikes evolutions at the given station, in `[since, until)`, ordered by time"""
+        return self._decode_bikes_evolutions(
+            self.cursor.execute(*self._bikes_evolutions_by_station_id_query(station_id, since, until))
+        )
+
+    @staticmethod
+    def _bikes_evolutions_by_bike_id_query(
+            bike_id: str,
+            since: datetime.datetime | None,
+            until: datetime.datetime | None,
+    ) -> tuple[str, dict[str, Any]]:
+        time_range, params = _time_range_clause(since, until)
+        return f"""SELECT e.at, e.station_id, b.uuid AS bike_id, e.action
+                   FROM bikes_evolution e
+                            JOIN bikes b ON b.id = e.bike_id
+                   WHERE b.uuid = :bike_id AND {time_range}
+                   ORDER BY e.at
+                """, {"bike_id": bike_id, **params}
+
+    def find_bikes_evolutions_by_bike_id(
+            self,
+            bike_id: str,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> list[dict[str, Any]]:
+        """Return the history of the given bike, in `[since, until)`, ordered by time"""
+        return self._decode_bikes_evolutions(
+            self.cursor.execute(*self._bikes_evolutions_by_bike_id_query(bike_id, since, until))
+        )
+
+    @staticmethod
+    def _bikes_evolutions_between_query(
+            since: datetime.datetime,
+            until: datetime.datetime,
+    ) -> tuple[str, dict[str, Any]]:
+        time_range, params = _time_range_clause(since, until)
+        return f"""SELECT e.at, e.station_id, b.uuid AS bike_id, e.action
+                   FROM bikes_evolution e
+                            JOIN bikes b ON b.id = e.bike_id
+                   WHERE {time_range}
+                   ORDER BY e.at
+                """, params
+
+    def find_bikes_evolutions_between(
+            self,
+            since: datetime.datetime,
+            until: datetime.datetime,
+    ) -> list[dict[str, Any]]:
+        """Return the bikes evolutions of all the stations in `[since, until)`, ordered by time"""
+        return self._decode_bikes_evolutions(self.cursor.execute(*self._bikes_evolutions_between_query(since, until)))
+
+    @staticmethod
+    def _decode_bikes_evolutions(rows: Iterable[sqlite3.Row]) -> list[dict[str, Any]]:
+        """Converts bikes evolutions back from their compact storage (see MIGRATIONS)"""
+        return [{
+            "at": from_epoch(row["at"]),
+            "station_id": row["station_id"],
+            "bike_id": row["bike_id"],
+            "action": ACTIONS_BY_CODE[row["action"]],
+        } for row in rows]
 
-    def save_bikes_evolutions(self, bike_evolutions: list[dict[str, Any]]) -> None:
+    def get_bike_ids(self, uuids: Iterable[str]) -> dict[str, int]:
+        """Returns the internal id of each of the given bike UUIDs, interning the ones never seen before"""
+        for uuid in uuids:
+            if uuid not in self._bike_ids:
+                # The no-op update makes RETURNING give the id of an already existing bike too
+                self._bike_ids[uuid] = self.cursor.execute(
+                    """
+                    INSERT INTO bikes (uuid) VALUES (:uuid)
+                    ON CONFLICT (uuid) DO UPDATE SET uuid = excluded.uuid
+                    RETURNING id
+                    """, {"uuid": uuid}
+                ).fetchone()[0]
+        return self._bike_ids
+
+    def save_bikes_evolutions(self, bike_evolutions: list[dict[str, Any]], commit: bool = True) -> None:
+        bike_ids = self.get_bike_ids(evolution["bike_id"] for evolution in bike_evolutions)
+        rows = [(
+            to_epoch(evolution["at"]),
+            evolution["station_id"],
+            bike_ids[evolution["bike_id"]],
+            ACTION_CODES[evolution["action"]],
+        ) for evolution in bike_evolutions]
         self.cursor.executemany(
             """
             INSERT INTO bikes_evolution (at, station_id, bike_id, action)
-            VALUES (:at, :station_id, :bike_id, :action)
-            """, bike_evolutions)
-        self.connection.commit()
+            VALUES (?, ?, ?, ?)
+            """, rows)
+        # Same transaction: the rollups are always in sync with the bikes evolutions
+        encoded_evolutions = [(at, station_id, action) for at, station_id, _, action in rows]
+        apply_to_rollups(self.cursor, encoded_evolutions)
+        self.checkpointer.after_save(self.cursor, encoded_evolutions)
+        metrics.inc("db_rows_written_total", len(rows), table="bikes_evolution")
+        if commit:
+            self.commit()
+
+    def find_station_occupancy(
+            self,
+            station_id: int,
+            resolution: int,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> list[dict[str, Any]]:
+        """
+        Return the occupancy rollups of the given station, at the given resolution (in seconds, one of
+        ROLLUP_RESOLUTIONS), for the buckets starting in `[since, until)`, ordered by time
+        """
+        params = {
+            "station_id": station_id,
+            "resolution": resolution,
+            "since": to_epoch(since) if since else 0,
+            "until": to_epoch(until) if until else 2 ** 62,
+        }
+        return [{
+            **dict(row),
+            "bucket": from_epoch(row["bucket"]),
+        } for row in self.cursor.execute(
+            """SELECT bucket, station_id, arrivals, departures, min_bikes, max_bikes, last_bikes
+               FROM station_rollups
+               WHERE resolution = :resolution AND station_id = :station_id
+                 AND bucket >= :since AND bucket < :until
+               ORDER BY bucket
+            """, params
+        )]
+
+    def rebuild_rollups(self) -> int:
+        """Rebuild the occupancy rollups from the whole history, see `component.rollups.rebuild_rollups`"""
+        return rebuild_rollups(self.connection)
+
+    def _get_bike_uuids(self, bike_ids: Iterable[int]) -> dict[int, str]:
+        bike_ids = list(bike_ids)
+        uuids: dict[int, str] = {}
+        # Chunks, to stay below the max number of parameters of a query
+        for i in range(0, len(bike_ids), 10_000):
+            chunk = bike_ids[i:i + 10_000]
+            uuids.update(self.cursor.execute(
+                f"SELECT id, uuid FROM bikes WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        return uuids
+
+    def find_bikes_at_station(self, station_id: int, at: datetime.datetime) -> set[str]:
+        """Return the UUIDs of the bikes docked at the given station at the given time"""
+        bike_ids, _, _ = station_state_at(self.cursor, station_id, to_epoch(at))
+        return set(self._get_bike_uuids(bike_ids).values())
+
+    def find_bikes_at_all_stations(self, at: datetime.datetime | None = None) -> dict[int, set[str]]:
+        """
+        Return the UUIDs of the bikes docked at each station (by stations.rowid) at the given time (by default, after
+        the latest bike evolution saved)
+        """
+        at_epoch = END_OF_TIME if at is None else to_epoch(at)
+        bike_ids_by_station = {
+            station["rowid"]: station_state_at(self.cursor, station["rowid"], at_epoch)[0]
+            for station in self.find_all_stations()
+        }
+        uuids = self._get_bike_uuids(set().union(*bike_ids_by_station.values()))
+        return {
+            station_id: {uuids[bike_id] for bike_id in bike_ids}
+            for station_id, bike_ids in bike_ids_by_station.items()
+        }
+
+    def build_trips(self) -> int:
+        """Build the trips from the bikes evolutions saved since the previous build, see `component.trips`"""
+        return TripBuilder(self.connection).run()
+
+    def find_trips_between(self, since: datetime.datetime, until: datetime.datetime) -> list[dict[str, Any]]:
+        """Return the trips started in `[since, until)`, ordered by start time"""
+        return [{
+            **dict(row),
+            "start_at": from_epoch(row["start_at"]),
+            "end_at": from_epoch(row["end_at"]),
+        } for row in self.cursor.execute(
+            """SELECT b.uuid AS bike_id, t.start_station_id, t.start_at, t.end_station_id, t.end_at, t.duration
+               FROM trips t
+                        JOIN bikes b ON b.id = t.bike_id
+               WHERE t.start_at >= :since AND t.start_at < :until
+               ORDER BY t.start_at
+            """, {"since": to_epoch(since), "until": to_epoch(until)}
+        )]
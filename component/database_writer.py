@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any
+
+from component.database import Database
+
+log = logging.getLogger(__name__)
+
+# Markers put in the queue, next to the rows to save
+_FLUSH = "flush"
+_CLOSE = "close"
+
+
+class DatabaseWriter:
+    """
+    Saves rows in the database from a single, dedicated, writer thread, so that the producers never wait on the disk.
+
+    The producers put the rows to save in a bounded queue (blocking when the writer cannot keep up). The writer
+    thread drains this queue, and commits the rows by batches: once `batch_size` rows are pending, or once the
+    oldest pending row has been waiting for `batch_interval` seconds.
+
+    The writer has its own connection to the database, as SQLite connections cannot be shared between threads.
+    """
+
+    def __init__(
+            self,
+            file_name: str | None = None,
+            max_queue_size: int = 1000,
+            batch_size: int = 10_000,
+            batch_interval: float = 1.0,
+    ) -> None:
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._queue: queue.Queue[tuple[str, Any]] = queue.Queue(maxsize=max_queue_size)
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+        self._thread.start()
+
+    def _put(self, kind: str, payload: Any) -> None:
+        if self._error is not None:
+            raise RuntimeError("The database writer failed, see the cause") from self._error
+        while True:
+            if not self._thread.is_alive():
+                raise RuntimeError("The database writer is closed") from self._error
+            try:
+                # Waiting for free space in the queue, but never forever if the writer thread dies
+                self._queue.put((kind, payload), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def save_stations(self, stations: list[dict[str, Any]]) -> None:
+        self._put("stations", stations)
+
+    def save_bikes_evolutions(self, bike_evolutions: list[dict[str, Any]]) -> None:
+        self._put("bikes_evolutions", bike_evolutions)
+
+    def flush(self) -> None:
+        """Blocks until all the rows put so far are committed in the database."""
+        done = threading.Event()
+        self._put(_FLUSH, done)
+        # Checking regularly, the writer thread may have died while we were waiting
+        while not done.wait(timeout=1):
+            if not self._thread.is_alive():
+                break
+        if self._error is not None:
+            raise RuntimeError("The database writer failed, see the cause") from self._error
+
+    def close(self) -> None:
+        """Commits all the rows put so far, and stops the writer thread."""
+        if self._error is None and self._thread.is_alive():
+            try:
+                self._put(_CLOSE, None)
+            except RuntimeError:
+                # The writer thread died meanwhile, its error (if any) is raised below
+                pass
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError("The database writer failed, see the cause") from self._error
+
+    def _run(self) -> None:
+        db = Database(self.file_name)
+        pending_rows, oldest_pending_at = 0, 0.0
+        try:
+            while True:
+                timeout = None
+                if pending_rows:
+                    timeout = max(0.0, oldest_pending_at + self.batch_interval - time.monotonic())
+                try:
+                    kind, payload = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    kind, payload = _FLUSH, None
+
+                if kind == "stations":
+                    db.save_stations(payload, commit=False)
+                elif kind == "bikes_evolutions":
+                    db.save_bikes_evolutions(payload, commit=False)
+                if kind in ("stations", "bikes_evolutions"):
+                    if not pending_rows:
+                        oldest_pending_at = time.monotonic()
+                    pending_rows += len(payload)
+                    if pending_rows < self.batch_size:
+                        continue
+
+                if pending_rows:
+                    started_at = time.monotonic()
+                    db.commit()
+                    log.debug("Committed count=%d rows in %.3fs", pending_rows, time.monotonic() - started_at)
+                    pending_rows = 0
+                if kind == _FLUSH and payload is not None:
+                    payload.set()
+                elif kind == _CLOSE:
+                    return
+        except BaseException as e:
+            log.exception("The database writer failed")
+            self._error = e
+        finally:
+            db.close()
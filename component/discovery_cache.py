@@ -0,0 +1,71 @@
+import datetime
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Any
+
+from component.database import OUTPUT_PATH
+
+log = logging.getLogger(__name__)
+
+
+class DiscoveryCache:
+    """
+    On-disk cache of what the discovery of a website found (OAuth2, contract and stations configurations),
+    and of the latest OAuth2 tokens, keyed by the base URL of the website.
+
+    An entry is considered fresh for `ttl` after its last validation. Once stale, it has to be revalidated
+    (e.g. with the ETag of the page it was discovered from) before being used again.
+    """
+
+    def __init__(
+            self,
+            path: pathlib.Path | None = None,
+            ttl: datetime.timedelta = datetime.timedelta(hours=24),
+    ) -> None:
+        self.path = path or OUTPUT_PATH / "discovery_cache.json"
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Ignoring the corrupted discovery cache at path=%s", self.path)
+            return {}
+
+    def _dump(self, entries: dict[str, dict[str, Any]]) -> None:
+        os.makedirs(self.path.parent, exist_ok=True)
+        # Atomic replace, so that a concurrent reader never sees a half written file
+        tmp_path = self.path.with_suffix(".tmp")
+        # The cache holds the OAuth2 tokens, hence only readable by us
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(entries, tmp_file)
+        os.replace(tmp_path, self.path)
+
+    def get(self, baseurl: str) -> dict[str, Any] | None:
+        with self._lock:
+            return self._load().get(baseurl)
+
+    def is_fresh(self, entry: dict[str, Any]) -> bool:
+        validated_at = datetime.datetime.fromtimestamp(entry["validated_at"], tz=datetime.timezone.utc)
+        return datetime.datetime.now(datetime.timezone.utc) < validated_at + self.ttl
+
+    def update(self, baseurl: str, **values: Any) -> None:
+        """Updates (or creates) the entry of the given base URL with the given values."""
+        with self._lock:
+            entries = self._load()
+            entries.setdefault(baseurl, {}).update(values)
+            self._dump(entries)
+
+    def invalidate(self, baseurl: str) -> None:
+        with self._lock:
+            entries = self._load()
+            if entries.pop(baseurl, None) is not None:
+                log.info("Invalidated the discovery cache of baseurl=%s", baseurl)
+                self._dump(entries)
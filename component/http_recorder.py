@@ -0,0 +1,86 @@
+import itertools
+import json
+import logging
+import os
+import pathlib
+import threading
+import urllib.parse
+from typing import Iterator
+
+from component.http_session import HttpResponse, HttpSession
+
+log = logging.getLogger(__name__)
+
+# Response headers not worth replaying: they describe the transfer, not the content
+TRANSFER_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+class RecordingHttpSession(HttpSession):
+    """
+    `HttpSession` writing each exchange it completes into a fixture file of the `path` directory, to be replayed
+    later by `utils.fake_api_server --replay`.
+
+    The responses cut short by the client are recorded as far as they were read, and the 304 ones are not
+    recorded, as the replay answers the revalidations by itself. The request headers are not recorded, so that the
+    fixtures hold no Authorization header, but the responses (e.g. the tokens) are, hence the files are only
+    readable by us.
+    """
+
+    def __init__(self, path: pathlib.Path, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # Continues the numbering of the fixtures already there
+        self._sequence = itertools.count(len(list(path.glob("*.json"))) + 1)
+        self._lock = threading.Lock()
+
+    def _record(self, method: str, url: str, response: HttpResponse, body: bytes, truncated: bool = False) -> None:
+        exchange = {
+            "method": method,
+            "url": url,
+            "status": response.status,
+            "truncated": truncated,
+            "headers": {
+                name: value for name, value in response.headers.items() if name.lower() not in TRANSFER_HEADERS
+            },
+        }
+        try:
+            exchange["body"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            exchange["body_hex"] = body.hex()
+        with self._lock:
+            sequence = next(self._sequence)
+        slug = urllib.parse.urlsplit(url).path.strip("/").replace("/", "_")[:60] or "root"
+        file_path = self.path / f"{sequence:06d}-{method}-{slug}.json"
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fixture_file:
+            json.dump(exchange, fixture_file, indent=1)
+        log.debug("Recorded the exchange with url=%s in path=%s", url, file_path)
+
+    def _stream(
+            self,
+            method: str,
+            url: str,
+            headers: dict[str, str],
+            data: bytes | None,
+            timeout: float | None,
+    ) -> Iterator[HttpResponse | bytes]:
+        stream = super()._stream(method, url, headers, data, timeout)
+        try:
+            response = next(stream)
+            yield response
+            chunks = []
+            try:
+                for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                # Cut short by the client (e.g. a JS chunk, once the configurations were found in it): what it read
+                # is all it needs to replay
+                if response.status != 304:
+                    self._record(method, url, response, b"".join(chunks), truncated=True)
+                raise
+            if response.status != 304:
+                self._record(method, url, response, b"".join(chunks))
+        finally:
+            stream.close()
@@ -0,0 +1,282 @@
+import http.client
+import io
+import json
+import logging
+import queue
+import threading
+import urllib.error
+import urllib.parse
+import zlib
+from typing import Any, Iterator
+
+try:
+    # Optional, decodes the (large) bikes responses several times faster
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+
+# Errors happening when reusing a keep-alive connection that the server already closed on its side
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+# The requests sent again on such an error: the server may have processed the first one (e.g. a token request)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+def json_loads(data: bytes | str) -> Any:
+    """`json.loads`, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps_canonical(data: Any) -> bytes:
+    """The same data always gives the same bytes (keys sorted), using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class HttpResponse:
+    def __init__(self, url: str, status: int, reason: str, headers: http.client.HTTPMessage, body: bytes) -> None:
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Any:
+        return json_loads(self.body)
+
+    def text(self) -> str:
+        return self.body.decode('utf-8')
+
+
+class _HostPool:
+    """The keep-alive connections to a single host, with at most `max_connections` opened at the same time."""
+
+    def __init__(self, scheme: str, netloc: str, max_connections: int, timeout: float) -> None:
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self._idle: queue.LifoQueue[http.client.HTTPConnection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        log.debug("Opening a new connection to %s://%s", self.scheme, self.netloc)
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def acquire(self, reuse: bool = True) -> tuple[http.client.HTTPConnection, bool]:
+        """Returns a connection (a new one unless `reuse`), and whether it is a reused one."""
+        self._slots.acquire()
+        if reuse:
+            try:
+                return self._idle.get_nowait(), True
+            except queue.Empty:
+                pass
+        return self._new_connection(), False
+
+    def release(self, connection: http.client.HTTPConnection, reusable: bool) -> None:
+        if reusable:
+            # Back to the timeout of the pool, whatever the one of the latest request
+            connection.timeout = self.timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(self.timeout)
+            self._idle.put(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _decompressor(content_encoding: str | None):
+    if content_encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        return zlib.decompressobj()
+    return None
+
+
+class HttpSession:
+    """
+    Minimal HTTP client, based on the standard library only, keeping the connections alive between requests
+    (one pool of connections per host), and asking for gzip-compressed responses.
+
+    Responses with a status >= 400 raise `urllib.error.HTTPError`, same as `urllib.request.urlopen`.
+    """
+
+    def __init__(
+            self,
+            max_connections_per_host: int = 16,
+            timeout: float = 10,
+            headers: dict[str, str] | None = None,
+    ) -> None:
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.headers = {
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+            **(headers or {}),
+        }
+        self._pools: dict[tuple[str, str], _HostPool] = {}
+        self._pools_lock = threading.Lock()
+
+    def _get_pool(self, scheme: str, netloc: str) -> _HostPool:
+        with self._pools_lock:
+            pool = self._pools.get((scheme, netloc))
+            if pool is None:
+                pool = _HostPool(scheme, netloc, self.max_connections_per_host, self.timeout)
+                self._pools[(scheme, netloc)] = pool
+            return pool
+
+    def _stream(
+            self,
+            method: str,
+            url: str,
+            headers: dict[str, str],
+            data: bytes | None,
+            timeout: float | None,
+    ) -> Iterator[HttpResponse | bytes]:
+        """
+        Sends the request, then yields the response (with an empty body), followed by the decompressed chunks
+        of its body. The connection is given back to its pool once the body has been fully read.
+        """
+        parsed = urllib.parse.urlsplit(url)
+        pool = self._get_pool(parsed.scheme, parsed.netloc)
+        path = urllib.parse.urlunsplit(("", "", parsed.path or "/", parsed.query, ""))
+
+        # A kept-alive connection may have been closed by the server meanwhile, and only the idempotent requests
+        # can be sent again then
+        idempotent = method in IDEMPOTENT_METHODS
+        connection, reused = pool.acquire(reuse=idempotent)
+        reusable = False
+        try:
+            if timeout is not None:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, body=data, headers={**self.headers, **headers})
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not reused or not idempotent:
+                    raise
+                log.debug("Kept-alive connection to %s was closed by the server, reconnecting", parsed.netloc)
+                connection.close()
+                connection.request(method, path, body=data, headers={**self.headers, **headers})
+                response = connection.getresponse()
+
+            yield HttpResponse(url, response.status, response.reason, response.headers, b"")
+
+            decompressor = _decompressor(response.headers.get("Content-Encoding"))
+            while chunk := response.read1(READ_CHUNK_SIZE):
+                yield decompressor.decompress(chunk) if decompressor else chunk
+            if decompressor:
+                yield decompressor.flush()
+            # Body fully read: marks the response as done, so that the connection can send the next request
+            response.close()
+            reusable = not response.will_close
+        finally:
+            pool.release(connection, reusable)
+
+    def request(
+            self,
+            method: str,
+            url: str,
+            headers: dict[str, str] | None = None,
+            data: bytes | None = None,
+            timeout: float | None = None,
+    ) -> HttpResponse:
+        for _ in range(MAX_REDIRECTS + 1):
+            log.debug("%s url=%s", method, url)
+            stream = self._stream(method, url, headers or {}, data, timeout)
+            response = next(stream)
+            response.body = b"".join(stream)
+            log.debug("Got status=%s with count=%d bytes from url=%s", response.status, len(response.body), url)
+
+            if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                if response.status == 303:
+                    method, data = "GET", None
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                             io.BytesIO(response.body))
+            return response
+        raise RuntimeError(f"Too many redirects for url={url}")
+
+    def stream(
+            self,
+            url: str,
+            headers: dict[str, str] | None = None,
+            timeout: float | None = None,
+    ) -> Iterator[bytes]:
+        """
+        GETs the given URL, yielding the decompressed chunks of the body as soon as they are received.
+        Closing the iterator before the end of the body drops the connection, and so, stops the download.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            log.debug("Streaming url=%s", url)
+            stream = self._stream("GET", url, headers or {}, None, timeout)
+            response = next(stream)
+            if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+                stream.close()
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                             io.BytesIO(b"".join(stream)))
+            try:
+                yield from stream
+            finally:
+                stream.close()
+            return
+        raise RuntimeError(f"Too many redirects for url={url}")
+
+    def get(
+            self,
+            url: str,
+            params: dict[str, Any] | None = None,
+            headers: dict[str, str] | None = None,
+            timeout: float | None = None,
+    ) -> HttpResponse:
+        if params:
+            url = url + '?' + urllib.parse.urlencode(params)
+        return self.request("GET", url, headers=headers, timeout=timeout)
+
+    def post_json(
+            self,
+            url: str,
+            body: Any,
+            headers: dict[str, str] | None = None,
+            timeout: float | None = None,
+    ) -> HttpResponse:
+        return self.request(
+            "POST",
+            url,
+            headers={'Content-Type': 'application/json', **(headers or {})},
+            data=json.dumps(body).encode('utf-8'),
+            timeout=timeout,
+        )
+
+    def close(self) -> None:
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
@@ -0,0 +1,238 @@
+"""
+In-process metrics of the collector: counters and latency histograms, labelled (e.g. by endpoint and station), and
+exposed in the Prometheus text format and as JSON.
+
+The metrics are off by default: until `metrics.enable()` is called, recording one is a single attribute check, and
+`metrics.timer(...)` returns a shared no-op context manager.
+"""
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Any, Iterator
+
+log = logging.getLogger(__name__)
+
+PREFIX = "villo_"
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HELP = {
+    "api_request_seconds": "Latency of the API requests, by endpoint and station",
+    "api_response_bytes_total": "Bytes of the API responses (decompressed), by endpoint",
+    "decode_seconds": "Time to decode the API responses into models, by model",
+    "db_rows_written_total": "Rows written in the database, by table",
+    "db_commit_seconds": "Duration of the commits of the database",
+    "token_refreshes_total": "Refreshes of the OAuth2 access token",
+    "scan_cycle_seconds": "Duration of the scan cycles",
+    "scan_cycle_stations_total": "Stations fetched by the scan cycles",
+    "scan_cycle_evolutions_total": "Bikes evolutions found by the scan cycles",
+    "raw_archive_responses_total": "Responses archived, by endpoint and whether they changed",
+    "raw_archive_bytes_total": "Bytes (compressed) appended to the raw responses archive",
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # Not cumulative: counts[i] is the number of values in ]buckets[i-1], buckets[i]], the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> Iterator[tuple[str, int]]:
+        total = 0
+        for bound, count in zip((*map(repr, self.buckets), "+Inf"), self.counts):
+            total += count
+            yield bound, total
+
+
+class _NullTimer:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info: Any) -> None:
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    """The counters and histograms of the process, see the module documentation"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._histograms: dict[str, dict[Labels, Histogram]] = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = tuple((label, str(label_value)) for label, label_value in labels.items())
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = tuple((label, str(label_value)) for label, label_value in labels.items())
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def _timer(self, name: str, labels: dict[str, Any]) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timer(self, name: str, **labels: Any) -> contextlib.AbstractContextManager:
+        """Context manager observing its duration in the given histogram"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(name, labels)
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(labels), "value": value} for labels, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(histogram.cumulative_counts()),
+                    } for labels, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = PREFIX + name
+                lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                full_name = PREFIX + name
+                lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for labels, histogram in series.items():
+                    for bound, count in histogram.cumulative_counts():
+                        bucket_labels = _format_labels(labels, 'le="' + bound + '"')
+                        lines.append(f"{full_name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path: pathlib.Path) -> None:
+        """Writes the metrics as JSON in the given file, atomically"""
+        os.makedirs(path.parent, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump({"at": time.time(), **self.to_dict()}, tmp_file, indent=1)
+        os.replace(tmp_path, path)
+
+
+# The metrics of this process
+metrics = Metrics()
+
+
+def record_cycle_metrics(stats: dict[str, Any]) -> None:
+    """Records the stats of a scan cycle, as returned by `VilloTrackerApp.run_cycle` or `CollectorPipeline`"""
+    metrics.observe("scan_cycle_seconds", stats["cycle_duration"])
+    metrics.inc("scan_cycle_stations_total", stats["stations"])
+    metrics.inc("scan_cycle_evolutions_total", stats["evolutions"])
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    server: 'MetricsServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug("Metrics request: " + format, *args)
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            body, content_type = self.server.metrics.to_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(self.server.metrics.to_dict()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serves the metrics at `/metrics` (Prometheus text) and `/metrics.json`, from a background thread"""
+    daemon_threads = True
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Metrics = metrics) -> None:
+        super().__init__((host, port), _MetricsHandler)
+        self.metrics = registry
+        self._thread = threading.Thread(target=self.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self) -> 'MetricsServer':
+        self._thread.start()
+        log.info("Serving the metrics at http://%s:%d/metrics", *self.server_address[:2])
+        return self
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,313 @@
+"""
+The collector as a long-running pipeline of stages, each in its own thread, joined by bounded queues:
+
+    fetch (stations, then bikes) -> parse (`Bike.from_dict`) -> diff (`SnapshotDiff`) -> write (`DatabaseWriter`)
+
+so that the network, the CPU and the disk work overlap, and so that a slow stage makes the previous ones wait
+(back-pressure) instead of piling up fetched snapshots in memory. A station fetched `UNCHANGED` (see
+`component.raw_archive`) is neither parsed nor diffed.
+
+The end of each scan cycle goes down the pipeline as a marker: once the diff stage sees it, all the bikes
+evolutions of the cycle are flushed, and the progress is checkpointed on disk. On a restart, the stations of an
+interrupted cycle are fetched first, and the scheduler remembers when each station was last fetched.
+"""
+import datetime
+import json
+import logging
+import os
+import pathlib
+import queue
+import threading
+import time
+from typing import Any, Callable, NamedTuple
+
+from component.database import Database, OUTPUT_PATH
+from component.database_writer import DatabaseWriter
+from component.metrics import metrics, record_cycle_metrics
+from component.profiling import CycleProfiler
+from component.raw_archive import UNCHANGED
+from component.scanner import StationScanner
+from component.scheduler import AdaptivePollScheduler
+from component.snapshot_diff import SnapshotDiff
+from model.bike_api import BikeBatch
+from model.station_api import Station
+
+log = logging.getLogger(__name__)
+
+# The fields of the bikes decoded by the parse stage, the other ones are skipped
+TRACKED_BIKE_FIELDS = ('id',)
+
+
+class _Snapshot(NamedTuple):
+    cycle: int
+    station: Station
+    # stations.rowid
+    station_id: int
+    # The raw bikes from the API, then their ids once parsed
+    bikes: list[Any]
+    at: datetime.datetime
+
+
+class _EndOfCycle(NamedTuple):
+    cycle: int
+    started_at: float
+    selected: list[int]
+    # The selected stations not fetched, when stopping in the middle of the cycle
+    not_fetched: list[int]
+
+
+# Goes down the pipeline once the fetch stage is stopped
+_STOP = "stop"
+
+
+class PipelineProgress:
+    """The progress of the pipeline, checkpointed on disk at the end of each cycle (atomic replace)"""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+
+    def load(self) -> dict[str, Any]:
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Ignoring the corrupted progress at path=%s", self.path)
+            return {}
+
+    def save(self, progress: dict[str, Any]) -> None:
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(progress))
+        os.replace(tmp_path, self.path)
+
+
+class CollectorPipeline:
+    """
+    Runs the scan cycles continuously, starting a cycle every `scan_interval` seconds, until `stop` is called
+    (e.g. on SIGTERM). The stop is graceful: no new station is fetched, but the snapshots already fetched go
+    through the whole pipeline, and are committed.
+
+    The write stage is the given `db_writer`, which stays open once the pipeline is stopped.
+    `on_cycle` is called by the diff stage with the stats of each cycle, once its bikes evolutions are committed.
+    `on_stations` is called by the fetch stage with each poll of the stations, and their rowid by number.
+    The cycles selected by the `profiler` are profiled in all the stages, see `CycleProfiler`.
+    """
+
+    def __init__(
+            self,
+            fetch_stations: Callable[[], list[dict[str, Any]]],
+            scanner: StationScanner,
+            db_writer: DatabaseWriter,
+            snapshot_diff: SnapshotDiff,
+            scheduler: AdaptivePollScheduler | None = None,
+            scan_budget: int | None = None,
+            scan_interval: float = 60.0,
+            max_queue_size: int = 1000,
+            progress_path: pathlib.Path | None = None,
+            on_cycle: Callable[[dict[str, Any]], None] | None = None,
+            on_stations: Callable[[list[Station], dict[int, int]], None] | None = None,
+            profiler: CycleProfiler | None = None,
+    ) -> None:
+        self.fetch_stations = fetch_stations
+        self.scanner = scanner
+        self.db_writer = db_writer
+        self.snapshot_diff = snapshot_diff
+        self.scheduler = scheduler or AdaptivePollScheduler()
+        self.scan_budget = scan_budget
+        self.scan_interval = scan_interval
+        self.progress = PipelineProgress(progress_path or OUTPUT_PATH / "pipeline_progress.json")
+        self.on_cycle = on_cycle
+        self.on_stations = on_stations
+        # Profiling nothing, unless armed
+        self.profiler = profiler or CycleProfiler()
+        self._parse_queue: queue.Queue[_Snapshot | _EndOfCycle | str] = queue.Queue(maxsize=max_queue_size)
+        self._diff_queue: queue.Queue[_Snapshot | _EndOfCycle | str] = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+        self._cycle = 0
+        # The stations of the interrupted cycle, fetched first
+        self._resumed: list[int] = []
+
+    def stop(self) -> None:
+        """Asks the pipeline to stop, once the snapshots in flight are written. Safe to call from a signal handler."""
+        self._stop.set()
+
+    def _put(self, stage_queue: queue.Queue, item: Any) -> None:
+        while True:
+            if self._error is not None:
+                raise RuntimeError("A stage of the pipeline failed, see the cause") from self._error
+            try:
+                # Waiting for free space in the queue, but never forever if the next stage dies
+                stage_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run_stage(self, name: str, stage: Callable[[], None]) -> threading.Thread:
+        def run() -> None:
+            try:
+                stage()
+            except BaseException as e:
+                log.exception("The stage=%s of the pipeline failed", name)
+                if self._error is None:
+                    self._error = e
+                self._stop.set()
+
+        thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def _select(self, stations: list[Station]) -> list[int]:
+        numbers = {station.number for station in stations}
+        resumed = [number for number in self._resumed if number in numbers]
+        self._resumed = []
+        if self.scanner.bulk_available:
+            # A single request for all the stations, no need to choose
+            return [station.number for station in stations]
+        selected = self.scheduler.select(stations, budget=self.scan_budget)
+        if resumed:
+            log.info("Resuming the fetch of count=%d stations of the interrupted cycle", len(resumed))
+            resumed_numbers = set(resumed)
+            selected = resumed + [number for number in selected if number not in resumed_numbers]
+            if self.scan_budget is not None:
+                selected = selected[:max(self.scan_budget, len(resumed))]
+        return selected
+
+    def _fetch_stage(self) -> None:
+        # For the rowids of the stations, this thread cannot share the connection of another one
+        db = Database(self.db_writer.file_name)
+        try:
+            while not self._stop.is_set():
+                started_at = time.monotonic()
+                self.profiler.enter(self._cycle + 1)
+                try:
+                    raw_stations = self.fetch_stations()
+                    with metrics.timer("decode_seconds", model="station"):
+                        stations = [Station.from_dict(station) for station in raw_stations]
+                except Exception:
+                    log.exception("Failed to fetch the stations, retrying in %.0fs", self.scan_interval)
+                    self._stop.wait(self.scan_interval)
+                    continue
+                self._cycle += 1
+                cycle = self._cycle
+                self.db_writer.save_stations([{
+                    "number": st.number,
+                    "name": st.name,
+                    "address": st.address,
+                    "latitude": st.position.latitude,
+                    "longitude": st.position.longitude,
+                    "total_stand_capacity": st.totalStands.capacity,
+                } for st in stations])
+                # The new stations must be in the database to get their rowid
+                self.db_writer.flush()
+                internal_station_ids = {station["number"]: station["rowid"] for station in db.find_all_stations()}
+                stations_by_number = {station.number: station for station in stations}
+                if self.on_stations is not None:
+                    self.on_stations(stations, internal_station_ids)
+
+                selected = self._select(stations)
+                log.info("Scanning count=%d stations in cycle=%d", len(selected), cycle)
+                fetched: set[int] = set()
+                scan = self.scanner.scan_all(selected)
+                try:
+                    for number, raw_bikes in scan:
+                        fetched.add(number)
+                        if raw_bikes is not None:
+                            self._put(self._parse_queue, _Snapshot(
+                                cycle, stations_by_number[number], internal_station_ids[number], raw_bikes, datetime.datetime.now(),
+                            ))
+                        if self._stop.is_set():
+                            break
+                finally:
+                    # Cancels the fetches not started yet
+                    scan.close()
+                self.profiler.exit(cycle)
+                self._put(self._parse_queue, _EndOfCycle(
+                    cycle, started_at, selected, [number for number in selected if number not in fetched],
+                ))
+                self._stop.wait(max(0.0, self.scan_interval - (time.monotonic() - started_at)))
+            self._put(self._parse_queue, _STOP)
+        finally:
+            db.close()
+
+    def _parse_stage(self) -> None:
+        while True:
+            item = self._parse_queue.get()
+            if isinstance(item, (_Snapshot, _EndOfCycle)):
+                self.profiler.enter(item.cycle)
+            if isinstance(item, _Snapshot) and item.bikes is not UNCHANGED:
+                # Only the ids are needed to diff the snapshots
+                with metrics.timer("decode_seconds", model="bike_batch"):
+                    item = item._replace(bikes=BikeBatch.from_dicts(item.bikes, TRACKED_BIKE_FIELDS).column('id'))
+            elif isinstance(item, _EndOfCycle):
+                self.profiler.exit(item.cycle)
+            self._put(self._diff_queue, item)
+            if item is _STOP:
+                return
+
+    def _diff_stage(self) -> None:
+        evolutions_count = 0
+        while True:
+            item = self._diff_queue.get()
+            if isinstance(item, (_Snapshot, _EndOfCycle)):
+                self.profiler.enter(item.cycle)
+            if isinstance(item, _Snapshot) and item.bikes is UNCHANGED:
+                # Same response as at the previous fetch of the station: no arrival, nor departure
+                self.scheduler.record_fetch(item.station, 0)
+                continue
+            if isinstance(item, _Snapshot):
+                # Only the real arrivals and departures since the previous snapshot are saved
+                bikes_evolutions = self.snapshot_diff.diff(station_id=item.station_id, bike_ids=item.bikes, at=item.at)
+                self.scheduler.record_fetch(item.station, len(bikes_evolutions))
+                if bikes_evolutions:
+                    self.db_writer.save_bikes_evolutions(bikes_evolutions)
+                    evolutions_count += len(bikes_evolutions)
+                continue
+            if item is _STOP:
+                return
+
+            self.db_writer.flush()
+            # Only once the bikes evolutions of the cycle are committed
+            self.progress.save({
+                "cycle": item.cycle,
+                "not_fetched": item.not_fetched,
+                "scheduler": self.scheduler.dump_state(),
+            })
+            stats = {
+                "cycle": item.cycle,
+                "stations": len(item.selected) - len(item.not_fetched),
+                "evolutions": evolutions_count,
+                "cycle_duration": time.monotonic() - item.started_at,
+            }
+            log.info("Done cycle=%d: count=%d stations fetched, count=%d bikes evolutions in %.1fs",
+                     stats["cycle"], stats["stations"], stats["evolutions"], stats["cycle_duration"])
+            record_cycle_metrics(stats)
+            self.profiler.finish(item.cycle, stats)
+            evolutions_count = 0
+            if self.on_cycle is not None:
+                self.on_cycle(stats)
+
+    def run(self) -> None:
+        """Runs the pipeline until `stop` is called, or until one of its stages fails (then raises)."""
+        progress = self.progress.load()
+        if "scheduler" in progress:
+            self.scheduler.restore_state(progress["scheduler"])
+        self._cycle = progress.get("cycle", 0)
+        self._resumed = progress.get("not_fetched", [])
+
+        stages = [
+            self._run_stage("fetch", self._fetch_stage),
+            self._run_stage("parse", self._parse_stage),
+            self._run_stage("diff", self._diff_stage),
+        ]
+        for stage in stages:
+            # Joining with a timeout, so that the signals are handled by the main thread meanwhile
+            while stage.is_alive() and self._error is None:
+                stage.join(timeout=1)
+        # The profiles of the cycles interrupted, if any
+        self.profiler.abort_all()
+        if self._error is not None:
+            raise RuntimeError("A stage of the pipeline failed, see the cause") from self._error
+        self.db_writer.flush()
+        log.info("The pipeline is stopped")
@@ -0,0 +1,249 @@
+"""
+On-demand profiling of the scan cycles, in the running collector.
+
+A profiled cycle is run under cProfile (in each thread taking part in it, merged into a single pstats file), under
+tracemalloc, and under a sampler of the stacks of all the threads (e.g. the fetches of the scanner), written as
+collapsed stacks, ready for `flamegraph.pl` or speedscope. The files are named after the cycle id and the number
+of stations of the cycle.
+
+Which cycles are profiled is set by the environment variable `VILLO_PROFILE`, e.g. `cycles=3` (the next 3 ones),
+`every=60` (one cycle in every 60) or `cycles=1,every=60`, and the files go to `VILLO_PROFILE_DIR` (default:
+~/output/profiles). SIGUSR1 profiles the next cycles (as many as `cycles`, at least one) without any restart.
+"""
+import collections
+import cProfile
+import json
+import logging
+import os
+import pathlib
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any
+
+from component.database import OUTPUT_PATH
+
+log = logging.getLogger(__name__)
+
+PROFILE_ENV = "VILLO_PROFILE"
+PROFILE_DIR_ENV = "VILLO_PROFILE_DIR"
+DEFAULT_PROFILE_DIR = OUTPUT_PATH / "profiles"
+
+# Frames kept by tracemalloc for each allocation, and lines listed in the report
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 30
+
+
+class StackSampler:
+    """Counts the stacks of all the threads (but its own), every `interval` seconds, in a background thread"""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> 'StackSampler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write_collapsed(self, path: pathlib.Path) -> None:
+        with path.open("w") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
+
+
+class _CycleProfile:
+    def __init__(self, cycle: int) -> None:
+        self.cycle = cycle
+        self.started_at = time.monotonic()
+        self.profiles: list[cProfile.Profile] = []
+        self.sampler = StackSampler().start()
+
+
+class CycleProfiler:
+    """
+    Profiles the selected scan cycles, see the module documentation.
+
+    Each thread taking part in a cycle calls `enter(cycle)` when it starts working on it, and `exit(cycle)` when
+    done; the thread finishing the cycle calls `finish(cycle, stats)` instead, which writes the files, or
+    `abort(cycle)` if the cycle failed. These calls cost a dict lookup for the cycles not profiled.
+    """
+
+    def __init__(self, output_dir: pathlib.Path = DEFAULT_PROFILE_DIR, cycles: int = 0, every: int = 0) -> None:
+        self.output_dir = output_dir
+        self.cycles = cycles
+        self.every = every
+        self._remaining = cycles
+        # The cycles asked by `arm`, added to `_remaining` when the next cycle starts: appending to a deque takes no
+        # lock, which matters in a signal handler
+        self._armed: collections.deque[int] = collections.deque()
+        self._lock = threading.Lock()
+        # Whether each cycle seen so far is profiled
+        self._selected: dict[int, _CycleProfile | None] = {}
+        self._local = threading.local()
+        # tracemalloc is shared by the cycles profiled at the same time, and only stopped if started here
+        self._tracemalloc_users = 0
+        self._started_tracemalloc = False
+
+    @classmethod
+    def from_env(cls, name: str | None = None) -> 'CycleProfiler':
+        """The profiler set up by `VILLO_PROFILE` (profiling nothing if not set), in the `name` subdirectory if any"""
+        settings = {}
+        for setting in filter(None, os.environ.get(PROFILE_ENV, "").split(",")):
+            key, _, value = setting.partition("=")
+            if key.strip() not in ("cycles", "every"):
+                raise ValueError(f"Unknown setting={setting} in {PROFILE_ENV}, expecting cycles=N and/or every=K")
+            settings[key.strip()] = int(value)
+        output_dir = pathlib.Path(os.environ.get(PROFILE_DIR_ENV, DEFAULT_PROFILE_DIR)).expanduser()
+        return cls(output_dir / name if name else output_dir, **settings)
+
+    def arm(self, cycles: int | None = None) -> None:
+        """Profiles the next cycles (by default, as many as set by `cycles`, at least one)"""
+        self._armed.append(cycles or self.cycles or 1)
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR1) -> None:
+        """To be called from the main thread"""
+        signal.signal(signum, lambda *_: self.arm())
+
+    def _profile_of(self, cycle: int) -> _CycleProfile | None:
+        with self._lock:
+            if cycle in self._selected:
+                return self._selected[cycle]
+            # First time this cycle is seen, by any thread
+            while self._armed:
+                armed = self._armed.popleft()
+                self._remaining += armed
+                log.info("Profiling the next count=%d cycles, in path=%s", armed, self.output_dir)
+            selected = self._remaining > 0 or (self.every > 0 and cycle % self.every == 0)
+            if self._remaining > 0:
+                self._remaining -= 1
+            # Forgetting the old cycles not profiled (the profiled ones are removed once finished)
+            self._selected = {
+                seen: profile for seen, profile in self._selected.items() if profile is not None or seen >= cycle - 1
+            }
+            profile = self._selected[cycle] = _CycleProfile(cycle) if selected else None
+            if profile is not None:
+                if not self._tracemalloc_users and not tracemalloc.is_tracing():
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                    self._started_tracemalloc = True
+                self._tracemalloc_users += 1
+                tracemalloc.reset_peak()
+        if profile is not None:
+            log.info("Profiling cycle=%d", cycle)
+        return profile
+
+    def enter(self, cycle: int) -> None:
+        if getattr(self._local, "cycle", None) == cycle:
+            return
+        self._local.cycle = cycle
+        if self._profile_of(cycle) is None:
+            self._local.profile = None
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12, a single cProfile at a time in a process: the stacks sampled cover this thread
+            log.debug("Another profiler is active, not running cProfile in thread=%s", threading.current_thread().name)
+            profile = None
+        self._local.profile = profile
+
+    def exit(self, cycle: int) -> None:
+        if getattr(self._local, "cycle", None) != cycle:
+            return
+        self._local.cycle = None
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            return
+        profile.disable()
+        self._local.profile = None
+        with self._lock:
+            cycle_profile = self._selected.get(cycle)
+            if cycle_profile is not None:
+                cycle_profile.profiles.append(profile)
+
+    def finish(self, cycle: int, stats: dict[str, Any]) -> None:
+        """Ends the given cycle in this thread, and writes its profile if it was profiled, tagged with its stats"""
+        self.exit(cycle)
+        with self._lock:
+            cycle_profile = self._selected.pop(cycle, None)
+        if cycle_profile is not None:
+            self._write(cycle_profile, stats)
+
+    def abort(self, cycle: int) -> None:
+        """Ends the given cycle in this thread, without writing its profile (e.g. as it failed)"""
+        self.exit(cycle)
+        with self._lock:
+            cycle_profile = self._selected.pop(cycle, None)
+        if cycle_profile is None:
+            return
+        cycle_profile.sampler.stop()
+        with self._lock:
+            self._release_tracemalloc()
+        log.info("Profile of cycle=%d discarded, the cycle did not finish", cycle)
+
+    def abort_all(self) -> None:
+        """Aborts all the profiled cycles not finished, e.g. when the pipeline fails"""
+        with self._lock:
+            cycles = [cycle for cycle, cycle_profile in self._selected.items() if cycle_profile is not None]
+        for cycle in cycles:
+            self.abort(cycle)
+
+    def _release_tracemalloc(self) -> None:
+        """Once a profiled cycle is over, with the lock held"""
+        self._tracemalloc_users -= 1
+        if not self._tracemalloc_users and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _write(self, cycle_profile: _CycleProfile, stats: dict[str, Any]) -> None:
+        cycle_profile.sampler.stop()
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot()
+            current_memory, peak_memory = tracemalloc.get_traced_memory()
+            self._release_tracemalloc()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = f"cycle-{cycle_profile.cycle:06d}-stations-{stats.get('stations', 0)}-pid-{os.getpid()}"
+        if cycle_profile.profiles:
+            merged = pstats.Stats(cycle_profile.profiles[0])
+            for profile in cycle_profile.profiles[1:]:
+                merged.add(profile)
+            merged.dump_stats(self.output_dir / f"{prefix}.pstats")
+        cycle_profile.sampler.write_collapsed(self.output_dir / f"{prefix}.collapsed")
+        with (self.output_dir / f"{prefix}.tracemalloc.txt").open("w") as memory_file:
+            memory_file.write(f"current={current_memory} peak={peak_memory} bytes\n")
+            for statistic in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                memory_file.write(f"{statistic}\n")
+        (self.output_dir / f"{prefix}.json").write_text(json.dumps({
+            **stats,
+            "cycle": cycle_profile.cycle,
+            "profiled_duration": time.monotonic() - cycle_profile.started_at,
+            "threads_profiled": len(cycle_profile.profiles),
+            "stack_samples": sum(cycle_profile.sampler.stacks.values()),
+            "tracemalloc_peak": peak_memory,
+        }, indent=1))
+        log.info("Profile of cycle=%d written in path=%s", cycle_profile.cycle, self.output_dir / f"{prefix}.*")
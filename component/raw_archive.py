@@ -0,0 +1,238 @@
+"""
+Append-only archive of the raw API responses, content-addressed, so that its size grows with the actual changes
+of the responses, not with the polling frequency.
+
+Each distinct payload is stored once, compressed (zlib), in segment files appended to, and rotated once bigger than
+`segment_size`. It is addressed by its SHA-256. The index (an SQLite database next to the segments) keeps:
+  * `blobs`: the hash of each payload -> its segment, offset and length in the segment;
+  * `responses`: for each (endpoint, station), the successive distinct payloads, each one with the time it was
+    first received and the time it was last received (e.g. a station unchanged for an hour is a single row).
+
+The responses covering the whole contract (the stations, and the bikes in bulk) are archived station by station, as
+canonical JSON (see `CommercialBikeClient`): they are not kept byte for byte, but a station unchanged is not stored
+again when another one changes. The bikes of a single station are kept as received, so switching between the bulk
+and the per-station fetches counts as one change of each station.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any
+
+from component.database import from_epoch, to_epoch
+from component.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Given instead of the bikes of a station when its response is the same as at its previous fetch: nothing to parse,
+# nor to diff
+UNCHANGED = "unchanged"
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+# On the fetch path: on the bikes of a whole contract, 6 takes twice the time for 15% less bytes
+COMPRESSION_LEVEL = 3
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS blobs
+    (
+        hash    BLOB PRIMARY KEY,   -- SHA-256 of the payload
+        segment INTEGER NOT NULL,   -- number of the segment file
+        offset  INTEGER NOT NULL,   -- in the segment file
+        length  INTEGER NOT NULL,   -- compressed
+        size    INTEGER NOT NULL    -- uncompressed
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS responses
+    (
+        endpoint TEXT    NOT NULL,  -- e.g. stations, bikes
+        station  INTEGER,           -- the station number
+        first_at INTEGER NOT NULL,  -- epoch seconds
+        last_at  INTEGER NOT NULL,
+        hash     BLOB    NOT NULL REFERENCES blobs (hash)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS responses_by_endpoint_station ON responses (endpoint, station, first_at)",
+]
+
+# (endpoint, station)
+ResponseKey = tuple[str, int | None]
+
+
+class RawResponseArchive:
+    """
+    See the module documentation. Thread-safe: the responses are archived by the fetching threads.
+
+    The index is committed every `commit_interval` seconds (and by `flush`), after the segments are flushed, so that
+    it never refers to payloads not on disk.
+    """
+
+    def __init__(self, path: pathlib.Path, segment_size: int = SEGMENT_SIZE, commit_interval: float = 5.0) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path / "index.db", check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+        segments = sorted(path.glob("segment-*.bin"))
+        self._segment = int(segments[-1].stem.split("-")[1]) if segments else 0
+        self._segment_file = self._open_segment()
+        self._committed_at = time.monotonic()
+
+        # The latest response of each key: its rowid in `responses`, and its hash
+        self._latest: dict[ResponseKey, tuple[int, bytes]] = {}
+        for endpoint, station, rowid, digest in self.connection.execute(
+                """
+                SELECT endpoint, station, MAX(rowid), hash
+                FROM responses
+                GROUP BY endpoint, station
+                """):
+            self._latest[(endpoint, station)] = (rowid, digest)
+        # The keys received at least once by this process: the first response of each one is always a change, as
+        # what was done with the previous one (before a restart) is not known here
+        self._seen: set[ResponseKey] = set()
+        # rowid -> last_at, of the responses received again since the last commit
+        self._pending_last_at: dict[int, int] = {}
+
+    def _open_segment(self):
+        return (self.path / f"segment-{self._segment:06d}.bin").open("ab")
+
+    def store(self, endpoint: str, station: int | None, payload: bytes, at: datetime.datetime | None = None) -> bool:
+        """
+        Archives the given response, and returns whether it changed since the previous response of the same
+        endpoint and station received by this process.
+        """
+        digest = hashlib.sha256(payload).digest()
+        key = (endpoint, station)
+        at_epoch = to_epoch(at or datetime.datetime.now())
+        with self._lock:
+            changed = key not in self._seen
+            self._seen.add(key)
+            latest = self._latest.get(key)
+            if latest is not None and latest[1] == digest:
+                # Only its last time of reception changes
+                self._pending_last_at[latest[0]] = at_epoch
+            else:
+                changed = True
+                self._store_blob(digest, payload)
+                rowid = self.connection.execute(
+                    "INSERT INTO responses (endpoint, station, first_at, last_at, hash) VALUES (?, ?, ?, ?, ?)",
+                    (endpoint, station, at_epoch, at_epoch, digest),
+                ).lastrowid
+                self._latest[key] = (rowid, digest)
+            if time.monotonic() - self._committed_at >= self.commit_interval:
+                self._commit()
+        metrics.inc("raw_archive_responses_total", endpoint=endpoint, changed="true" if changed else "false")
+        return changed
+
+    def _store_blob(self, digest: bytes, payload: bytes) -> None:
+        """Appends the payload to the current segment, unless already archived"""
+        if self.connection.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone():
+            return
+        compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+        if self._segment_file.tell() + len(compressed) > self.segment_size and self._segment_file.tell():
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = self._open_segment()
+            log.info("Archiving the raw responses in segment=%d", self._segment)
+        offset = self._segment_file.tell()
+        self._segment_file.write(compressed)
+        self.connection.execute(
+            "INSERT INTO blobs (hash, segment, offset, length, size) VALUES (?, ?, ?, ?, ?)",
+            (digest, self._segment, offset, len(compressed), len(payload)),
+        )
+        metrics.inc("raw_archive_bytes_total", len(compressed))
+
+    def _commit(self) -> None:
+        self._segment_file.flush()
+        os.fsync(self._segment_file.fileno())
+        self.connection.executemany(
+            "UPDATE responses SET last_at = ? WHERE rowid = ?",
+            [(last_at, rowid) for rowid, last_at in self._pending_last_at.items()],
+        )
+        self._pending_last_at.clear()
+        self.connection.commit()
+        self._committed_at = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._commit()
+            self._segment_file.close()
+            self.connection.close()
+
+    def read(self, digest: bytes) -> bytes:
+        """The payload of the given hash"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT segment, offset, length FROM blobs WHERE hash = ?", (digest,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(digest.hex())
+            # What was just appended may still be in the buffer
+            self._segment_file.flush()
+        segment, offset, length = row
+        with (self.path / f"segment-{segment:06d}.bin").open("rb") as segment_file:
+            segment_file.seek(offset)
+            return zlib.decompress(segment_file.read(length))
+
+    def find_responses(
+            self,
+            endpoint: str,
+            station: int | None = None,
+            since: datetime.datetime | None = None,
+            until: datetime.datetime | None = None,
+    ) -> list[dict[str, Any]]:
+        """
+        The distinct successive responses of the given endpoint and station, received between `since` and `until`,
+        in chronological order: their hash, and when each one was first and last received.
+        """
+        clauses, params = ["endpoint = ?", "station IS ?"], [endpoint, station]
+        if since is not None:
+            clauses.append("last_at >= ?")
+            params.append(to_epoch(since))
+        if until is not None:
+            clauses.append("first_at < ?")
+            params.append(to_epoch(until))
+        with self._lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT rowid, first_at, last_at, hash
+                FROM responses
+                WHERE {" AND ".join(clauses)}
+                ORDER BY first_at
+                """, params).fetchall()
+            pending_last_at = dict(self._pending_last_at)
+        return [{
+            "first_at": from_epoch(first_at),
+            "last_at": from_epoch(pending_last_at.get(rowid, last_at)),
+            "hash": digest,
+        } for rowid, first_at, last_at, digest in rows]
+
+    def response_at(self, endpoint: str, station: int | None, at: datetime.datetime) -> bytes | None:
+        """The payload of the latest response of the given endpoint and station received at or before `at`"""
+        with self._lock:
+            row = self.connection.execute(
+                """
+                SELECT hash
+                FROM responses
+                WHERE endpoint = ? AND station IS ? AND first_at <= ?
+                ORDER BY first_at DESC
+                LIMIT 1
+                """, (endpoint, station, to_epoch(at))).fetchone()
+        return self.read(row[0]) if row else None
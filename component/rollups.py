@@ -0,0 +1,111 @@
+"""
+Per-station occupancy rollups: the bikes evolutions pre-aggregated by buckets of time, at several resolutions.
+
+For each station, and each bucket, we keep the number of arrivals and departures, and the number of bikes at the
+station after each of these events (min, max, and after the last one). The current number of bikes of each station
+is kept in `station_occupancy`, to continue the count with the next events.
+
+Buckets are aligned on the epoch, i.e. the daily buckets start at midnight UTC.
+"""
+import logging
+import sqlite3
+from typing import Iterable
+
+log = logging.getLogger(__name__)
+
+# The length of the buckets, in seconds: 5 minutes, 1 hour and 1 day
+ROLLUP_RESOLUTIONS = (300, 3600, 86400)
+
+# A bike evolution, as stored in bikes_evolution: (at, station_id, action)
+EncodedEvolution = tuple[int, int, int]
+
+
+def apply_to_rollups(cursor: sqlite3.Cursor, evolutions: Iterable[EncodedEvolution]) -> None:
+    """
+    Adds the given bikes evolutions to the rollups, in the current transaction of the cursor.
+
+    The evolutions of a station must be given after the ones already applied for this station (i.e. in
+    chronological order), as they continue its count of bikes.
+    """
+    by_station: dict[int, list[tuple[int, int]]] = {}
+    for at, station_id, action in evolutions:
+        by_station.setdefault(station_id, []).append((at, action))
+    if not by_station:
+        return
+
+    occupancy: dict[int, int] = dict(cursor.execute(
+        f"SELECT station_id, bikes FROM station_occupancy WHERE station_id IN ({','.join('?' * len(by_station))})",
+        list(by_station),
+    ).fetchall())
+
+    # (resolution, station_id, bucket) -> [arrivals, departures, min_bikes, max_bikes, last_bikes]
+    buckets: dict[tuple[int, int, int], list[int]] = {}
+    last_at: dict[int, int] = {}
+    for station_id, station_evolutions in by_station.items():
+        bikes = occupancy.get(station_id, 0)
+        station_evolutions.sort(key=lambda evolution: evolution[0])  # stable: keeps the order of a same second
+        for at, action in station_evolutions:
+            bikes += 1 if action else -1
+            for resolution in ROLLUP_RESOLUTIONS:
+                key = (resolution, station_id, at - at % resolution)
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [1 if action else 0, 0 if action else 1, bikes, bikes, bikes]
+                else:
+                    bucket[0 if action else 1] += 1
+                    bucket[2] = min(bucket[2], bikes)
+                    bucket[3] = max(bucket[3], bikes)
+                    bucket[4] = bikes
+        occupancy[station_id] = bikes
+        last_at[station_id] = station_evolutions[-1][0]
+
+    cursor.executemany(
+        """
+        INSERT INTO station_rollups (resolution, station_id, bucket, arrivals, departures, min_bikes, max_bikes, last_bikes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (resolution, station_id, bucket) DO UPDATE SET arrivals   = arrivals + excluded.arrivals,
+                                                                   departures = departures + excluded.departures,
+                                                                   min_bikes  = min(min_bikes, excluded.min_bikes),
+                                                                   max_bikes  = max(max_bikes, excluded.max_bikes),
+                                                                   last_bikes = excluded.last_bikes
+        """, [(*key, *bucket) for key, bucket in buckets.items()])
+    cursor.executemany(
+        """
+        INSERT INTO station_occupancy (station_id, bikes, last_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (station_id) DO UPDATE SET bikes   = excluded.bikes,
+                                               last_at = excluded.last_at
+        """, [(station_id, occupancy[station_id], last_at[station_id]) for station_id in by_station])
+
+
+def rebuild_rollups(connection: sqlite3.Connection, chunk_size: int = 100_000) -> int:
+    """
+    Rebuilds all the rollups from the whole history of bikes_evolution, committing every `chunk_size` evolutions.
+    Returns the number of evolutions read.
+
+    The collector must NOT be running meanwhile. If interrupted, the rebuild has to be run again from the start.
+    """
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM station_rollups")
+    cursor.execute("DELETE FROM station_occupancy")
+    last_rowid, count = 0, 0
+    while True:
+        # The rowids are allocated in chronological order, by the collector
+        rows = cursor.execute(
+            """
+            SELECT rowid, at, station_id, action
+            FROM bikes_evolution
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?
+            """, (last_rowid, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        apply_to_rollups(cursor, [(row[1], row[2], row[3]) for row in rows])
+        connection.commit()
+        last_rowid = rows[-1][0]
+        count += len(rows)
+        log.info("Rebuilt the rollups up to count=%d bikes evolutions", count)
+    connection.commit()
+    return count
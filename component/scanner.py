@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Iterable, Iterator
+
+log = logging.getLogger(__name__)
+
+# The statuses of a bulk request meaning that the API does not allow it, as opposed to a transient failure
+BULK_REFUSED_STATUSES = {400, 403, 404}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    `rate` tokens are added every second, up to `capacity` tokens. Each request consumes one token, so `rate`
+    is the sustained number of requests per second, and `capacity` the size of the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: int | None = None) -> None:
+        if rate <= 0:
+            raise ValueError("The rate of the token bucket must be strictly positive")
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        """Blocks until a token is available, and consumes it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_for = (1 - self._tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class StationScanner:
+    """
+    Fetches the bikes of many stations at once, using a pool of threads.
+
+    The number of in-flight requests is bounded by `max_workers`, and the requests rate (all workers combined)
+    is bounded by `requests_per_second`, so that we stay within what the operator tolerates.
+    """
+
+    def __init__(
+            self,
+            fetch_bikes: Callable[[Any], list[dict[str, Any]]],
+            max_workers: int = 8,
+            requests_per_second: float = 5.0,
+            burst: int | None = None,
+            fetch_bikes_by_station: Callable[[list[Any]], dict[Any, list[dict[str, Any]]]] | None = None,
+    ) -> None:
+        self.fetch_bikes = fetch_bikes
+        # Optional bulk mode, fetching the bikes of all the given stations at once
+        self.fetch_bikes_by_station = fetch_bikes_by_station
+        self.bulk_refused = False
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(rate=requests_per_second, capacity=burst)
+
+    @property
+    def bulk_available(self) -> bool:
+        """Whether `scan_all` fetches the bikes of all the stations at once, as far as we know"""
+        return self.fetch_bikes_by_station is not None and not self.bulk_refused
+
+    def _fetch(self, station_id: Any) -> list[dict[str, Any]]:
+        self.rate_limiter.acquire()
+        return self.fetch_bikes(station_id)
+
+    def scan(self, station_ids: Iterable[Any]) -> Iterator[tuple[Any, list[dict[str, Any]] | None]]:
+        """
+        Yields `(station_id, bikes)` tuples, as soon as each station has been fetched (i.e. NOT in the input order).
+
+        A station that failed to be fetched is yielded with `None` as bikes, and the error is logged,
+        so that one failing station does not abort the whole pass.
+
+        Closing the iterator early cancels the fetches not started yet.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="scanner")
+        try:
+            futures = {executor.submit(self._fetch, station_id): station_id for station_id in station_ids}
+            for future in as_completed(futures):
+                station_id = futures[future]
+                try:
+                    yield station_id, future.result()
+                except Exception:
+                    log.exception("Failed to fetch the bikes at station=%s", station_id)
+                    yield station_id, None
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def scan_all(self, station_ids: Iterable[Any]) -> Iterator[tuple[Any, list[dict[str, Any]] | None]]:
+        """
+        Same as `scan`, but tries first to fetch the bikes of all the stations in a single bulk request.
+
+        If the API refuses the bulk request (see `BULK_REFUSED_STATUSES`), we fall back to one request per station,
+        and do not try the bulk request again for the lifetime of this scanner. If the bulk request fails otherwise
+        (e.g. a timeout, a 503, or a truncated response), we fall back to one request per station for this scan
+        only.
+        """
+        if self.fetch_bikes_by_station is None or self.bulk_refused:
+            yield from self.scan(station_ids)
+            return
+
+        station_ids = list(station_ids)
+        try:
+            self.rate_limiter.acquire()
+            bikes_by_station = self.fetch_bikes_by_station(station_ids)
+        except urllib.error.HTTPError as e:
+            if e.code in BULK_REFUSED_STATUSES:
+                log.warning("Bulk fetch of the bikes refused with status=%s, falling back to per-station fetches",
+                            e.code)
+                self.bulk_refused = True
+            else:
+                log.warning("Bulk fetch of the bikes failed with status=%s, falling back to per-station fetches "
+                            "for this scan", e.code)
+            yield from self.scan(station_ids)
+            return
+        except (OSError, ValueError):
+            # Connection errors and timeouts are OSError, invalid JSON is a ValueError
+            log.warning("Bulk fetch of the bikes failed, falling back to per-station fetches for this scan",
+                        exc_info=True)
+            yield from self.scan(station_ids)
+            return
+        if not bikes_by_station:
+            # Would make all the bikes leave their station, most likely the API ignored the request
+            log.warning("Bulk fetch of the bikes returned no bike, falling back to per-station fetches")
+            yield from self.scan(station_ids)
+            return
+
+        for station_id in station_ids:
+            # A station absent from the bulk response has no bike docked
+            yield station_id, bikes_by_station.get(station_id, [])
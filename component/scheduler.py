@@ -0,0 +1,84 @@
+import datetime
+import logging
+import time
+from typing import Any
+
+from model.station_api import Station
+
+log = logging.getLogger(__name__)
+
+
+class AdaptivePollScheduler:
+    """
+    Chooses which stations are worth fetching the bikes of, from the cheap list of all the stations.
+
+    A station is selected when its `lastUpdate` or its availabilities changed since its bikes were last fetched, or
+    when its bikes were not fetched for `max_staleness`. The stale stations go first (so that the staleness bound
+    holds), then the changed ones, busiest first: the business of a station (its churn) is the exponential moving
+    average of the number of bikes evolutions found at each fetch.
+    """
+
+    def __init__(
+            self,
+            max_staleness: datetime.timedelta = datetime.timedelta(minutes=15),
+            churn_smoothing: float = 0.3,
+    ) -> None:
+        self.max_staleness = max_staleness
+        self.churn_smoothing = churn_smoothing
+        # By station number
+        self._fetched_signatures: dict[int, tuple] = {}
+        self._fetched_at: dict[int, float] = {}
+        self._churn: dict[int, float] = {}
+
+    @staticmethod
+    def _signature(station: Station) -> tuple:
+        availabilities = station.totalStands.availabilities
+        return station.lastUpdate, availabilities.bikes, availabilities.stands
+
+    def select(self, stations: list[Station], budget: int | None = None) -> list[int]:
+        """Returns the numbers of the stations to fetch the bikes of, by priority, at most `budget` of them."""
+        now = time.monotonic()
+        stale, changed = [], []
+        for station in stations:
+            fetched_at = self._fetched_at.get(station.number)
+            if fetched_at is None or now - fetched_at >= self.max_staleness.total_seconds():
+                stale.append((fetched_at or 0, station.number))
+            elif self._fetched_signatures.get(station.number) != self._signature(station):
+                changed.append((-self._churn.get(station.number, 0), station.number))
+
+        selected = [number for _, number in sorted(stale)] + [number for _, number in sorted(changed)]
+        if budget is not None:
+            selected = selected[:budget]
+        log.info("Selected count=%d stations to fetch (stale=%d, changed=%d, unchanged=%d)",
+                 len(selected), len(stale), len(changed), len(stations) - len(stale) - len(changed))
+        return selected
+
+    def record_fetch(self, station: Station, bikes_evolutions_count: int) -> None:
+        """To be called once the bikes of the given station were fetched and diffed."""
+        self._fetched_signatures[station.number] = self._signature(station)
+        self._fetched_at[station.number] = time.monotonic()
+        previous_churn = self._churn.get(station.number, bikes_evolutions_count)
+        self._churn[station.number] = (
+                self.churn_smoothing * bikes_evolutions_count + (1 - self.churn_smoothing) * previous_churn
+        )
+
+    def dump_state(self) -> dict[str, Any]:
+        """The state of the scheduler as JSON-serializable values, to restore it after a restart"""
+        now = time.monotonic()
+        return {
+            "saved_at": time.time(),
+            "stations": [
+                [number, list(signature), now - self._fetched_at[number], self._churn.get(number, 0.0)]
+                for number, signature in self._fetched_signatures.items()
+            ],
+        }
+
+    def restore_state(self, state: dict[str, Any]) -> None:
+        # The monotonic clock does not survive a restart: the time spent down is added to the ages
+        downtime = max(0.0, time.time() - state["saved_at"])
+        now = time.monotonic()
+        for number, signature, age, churn in state["stations"]:
+            self._fetched_signatures[number] = tuple(signature)
+            self._fetched_at[number] = now - age - downtime
+            self._churn[number] = churn
+        log.info("Restored the fetch history of count=%d stations", len(state["stations"]))
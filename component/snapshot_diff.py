@@ -0,0 +1,56 @@
+import datetime
+import logging
+from typing import Any, Iterable
+
+from component.database import Database
+
+log = logging.getLogger(__name__)
+
+
+class SnapshotDiff:
+    """
+    Keeps, in memory, the last known set of bike ids at each station, and turns each new snapshot of a station
+    (i.e. the result of `get_bikes_at_station`) into the real IN/OUT bike evolutions since the previous snapshot.
+
+    Stations are identified by their internal id (i.e. `stations.rowid`), same as in `bikes_evolution`.
+    """
+
+    def __init__(self) -> None:
+        self.bikes_by_station: dict[int, set[str]] = {}
+
+    @classmethod
+    def from_database(cls, db: Database) -> 'SnapshotDiff':
+        """
+        Rebuild the last known bikes at each station, from the bikes evolutions already saved in the database: from
+        the latest checkpoint of each station, through the index (not the whole history).
+        """
+        snapshot_diff = cls()
+        for station_id, bike_ids in db.find_bikes_at_all_stations().items():
+            if bike_ids:
+                snapshot_diff.bikes_by_station[station_id] = bike_ids
+        log.info("Rebuilt the last known bikes of count=%d stations from the database",
+                 len(snapshot_diff.bikes_by_station))
+        return snapshot_diff
+
+    def diff(self, station_id: int, bike_ids: Iterable[str], at: datetime.datetime) -> list[dict[str, Any]]:
+        """
+        Returns the bikes evolutions (arrivals and departures) at the given station, and remembers the given bikes
+        as the new last known state of this station.
+        """
+        current = set(bike_ids)
+        previous = self.bikes_by_station.get(station_id, set())
+        self.bikes_by_station[station_id] = current
+
+        bikes_evolutions = [{
+            "at": at,
+            "station_id": station_id,
+            "bike_id": bike_id,
+            "action": "I",  # I for IN, O for OUT
+        } for bike_id in current - previous]
+        bikes_evolutions.extend({
+            "at": at,
+            "station_id": station_id,
+            "bike_id": bike_id,
+            "action": "O",
+        } for bike_id in previous - current)
+        return bikes_evolutions
@@ -0,0 +1,237 @@
+"""
+In-memory spatial index of the stations, for the nearest stations and radius queries, optionally filtered by
+their live availabilities.
+
+The stations are bucketed in a grid of square cells of `cell_size` meters, in an equirectangular projection
+around the latitude of the city: a query only looks at the cells around its point, then computes the exact
+(haversine) distances of the few stations found there.
+"""
+import heapq
+import logging
+import math
+from typing import Any, Iterable, NamedTuple
+
+from component.database import Database
+from model.station_api import Station
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6_371_000  # meters
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """The distance between the two points, in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class NearbyStation(NamedTuple):
+    # stations.rowid
+    station_id: int
+    number: int
+    distance: float  # meters
+
+
+class StationIndex:
+    """
+    Grid index of the stations, by their `stations.rowid`.
+
+    `sync` (re)builds it from the rows of `Database.find_all_stations`, only touching the stations added, moved or
+    removed since the previous sync. `update_availabilities` keeps the latest availabilities of the stations, for
+    the `min_bikes` and `min_stands` filters of the queries.
+    """
+
+    def __init__(self, cell_size: float = 250.0) -> None:
+        self.cell_size = cell_size
+        # Fixed at the first sync, the projection is accurate enough at the scale of a city
+        self._cos_latitude: float | None = None
+        self._cells: dict[tuple[int, int], set[int]] = {}
+        # By station id
+        self._positions: dict[int, tuple[float, float]] = {}
+        self._cell_of: dict[int, tuple[int, int]] = {}
+        self._numbers: dict[int, int] = {}
+        self._bikes: dict[int, int] = {}
+        self._stands: dict[int, int] = {}
+        # The bounds of the occupied cells, not to look further
+        self._bounds: tuple[int, int, int, int] | None = None
+
+    @classmethod
+    def from_database(cls, db: Database, cell_size: float = 250.0) -> 'StationIndex':
+        station_index = cls(cell_size)
+        station_index.sync(db.find_all_stations())
+        return station_index
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        x = math.radians(longitude) * EARTH_RADIUS * self._cos_latitude
+        y = math.radians(latitude) * EARTH_RADIUS
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _remove(self, station_id: int) -> None:
+        cell = self._cell_of.pop(station_id)
+        self._cells[cell].discard(station_id)
+        if not self._cells[cell]:
+            del self._cells[cell]
+        del self._positions[station_id]
+
+    def sync(self, rows: Iterable[Any]) -> int:
+        """
+        Syncs the index with the given stations (rows of `Database.find_all_stations`), and returns how many stations
+        were added, moved or removed. The stations without a position are left out.
+        """
+        rows = list(rows)
+        positions = {
+            row["rowid"]: (row["latitude"], row["longitude"])
+            for row in rows if row["latitude"] is not None and row["longitude"] is not None
+        }
+        self._numbers = {row["rowid"]: row["number"] for row in rows}
+        if self._cos_latitude is None:
+            if not positions:
+                return 0
+            self._cos_latitude = math.cos(math.radians(sum(lat for lat, _ in positions.values()) / len(positions)))
+
+        changes = 0
+        for station_id in [station_id for station_id in self._positions if station_id not in positions]:
+            self._remove(station_id)
+            changes += 1
+        for station_id, position in positions.items():
+            if self._positions.get(station_id) == position:
+                continue
+            if station_id in self._positions:
+                self._remove(station_id)
+            cell = self._cell(*position)
+            self._cells.setdefault(cell, set()).add(station_id)
+            self._cell_of[station_id] = cell
+            self._positions[station_id] = position
+            changes += 1
+
+        if changes:
+            xs = [x for x, _ in self._cells]
+            ys = [y for _, y in self._cells]
+            self._bounds = (min(xs), max(xs), min(ys), max(ys)) if self._cells else None
+            log.debug("Synced the spatial index with count=%d changes, count=%d stations", changes, len(self))
+        return changes
+
+    def sync_stations(self, stations: list[Station], ordinals: dict[int, int]) -> int:
+        """Same as `sync` with a poll of the stations from the API, `ordinals` are their rowid by number"""
+        return self.sync({
+            "rowid": ordinals[station.number],
+            "number": station.number,
+            "latitude": station.position.latitude,
+            "longitude": station.position.longitude,
+        } for station in stations if station.number in ordinals)
+
+    def update_availabilities(self, stations: Iterable[Station], ordinals: dict[int, int]) -> None:
+        """Keeps the latest availabilities of the given stations, `ordinals` are their rowid by number"""
+        for station in stations:
+            station_id = ordinals.get(station.number)
+            if station_id is None:
+                continue
+            availabilities = station.totalStands.availabilities
+            self._bikes[station_id] = availabilities.bikes
+            self._stands[station_id] = availabilities.stands
+
+    def _matches(self, station_id: int, min_bikes: int, min_stands: int) -> bool:
+        # A station without known availabilities only matches when no availability is asked for
+        if min_bikes and (self._bikes.get(station_id) or 0) < min_bikes:
+            return False
+        if min_stands and (self._stands.get(station_id) or 0) < min_stands:
+            return False
+        return True
+
+    def _ring(self, center: tuple[int, int], radius: int) -> Iterable[tuple[int, int]]:
+        """The cells at exactly `radius` cells from the center (Chebyshev distance), within the occupied bounds"""
+        cx, cy = center
+        min_x, max_x, min_y, max_y = self._bounds
+        if radius == 0:
+            yield center
+            return
+        x_from, x_to = max(cx - radius, min_x), min(cx + radius, max_x)
+        for y in (cy - radius, cy + radius):
+            if min_y <= y <= max_y:
+                for x in range(x_from, x_to + 1):
+                    yield x, y
+        y_from, y_to = max(cy - radius + 1, min_y), min(cy + radius - 1, max_y)
+        for x in (cx - radius, cx + radius):
+            if min_x <= x <= max_x:
+                for y in range(y_from, y_to + 1):
+                    yield x, y
+
+    def _rings(self, center: tuple[int, int], max_distance: float | None) -> range:
+        """The rings of cells around the center which may hold stations (e.g. none when far from the city)"""
+        min_x, max_x, min_y, max_y = self._bounds
+        cx, cy = center
+        first = max(0, min_x - cx, cx - max_x, min_y - cy, cy - max_y)
+        last = max(abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y))
+        if max_distance is not None:
+            last = min(last, math.ceil(max_distance / self.cell_size))
+        return range(first, last + 1)
+
+    def _nearby(self, station_id: int, latitude: float, longitude: float) -> NearbyStation:
+        return NearbyStation(station_id, self._numbers.get(station_id), haversine(latitude, longitude, *self._positions[station_id]))
+
+    def within(
+            self,
+            latitude: float,
+            longitude: float,
+            radius: float,
+            min_bikes: int = 0,
+            min_stands: int = 0,
+    ) -> list[NearbyStation]:
+        """The stations within `radius` meters of the given point, nearest first"""
+        if not self._cells:
+            return []
+        center = self._cell(latitude, longitude)
+        found = []
+        for ring in self._rings(center, radius):
+            for cell in self._ring(center, ring):
+                for station_id in self._cells.get(cell, ()):
+                    if not self._matches(station_id, min_bikes, min_stands):
+                        continue
+                    nearby = self._nearby(station_id, latitude, longitude)
+                    if nearby.distance <= radius:
+                        found.append(nearby)
+        found.sort(key=lambda nearby: nearby.distance)
+        return found
+
+    def nearest(
+            self,
+            latitude: float,
+            longitude: float,
+            count: int = 1,
+            min_bikes: int = 0,
+            min_stands: int = 0,
+            max_distance: float | None = None,
+    ) -> list[NearbyStation]:
+        """
+        The `count` nearest stations of the given point, nearest first, e.g. the 5 nearest stations with at least a
+        bike with `nearest(lat, lon, 5, min_bikes=1)`.
+        """
+        if not self._cells or count <= 0:
+            return []
+        center = self._cell(latitude, longitude)
+        # Max-heap of the best ones so far: (-distance, station_id)
+        best: list[tuple[float, int]] = []
+        for ring in self._rings(center, max_distance):
+            for cell in self._ring(center, ring):
+                for station_id in self._cells.get(cell, ()):
+                    if not self._matches(station_id, min_bikes, min_stands):
+                        continue
+                    distance = haversine(latitude, longitude, *self._positions[station_id])
+                    if max_distance is not None and distance > max_distance:
+                        continue
+                    if len(best) < count:
+                        heapq.heappush(best, (-distance, station_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, station_id))
+            # Any station beyond this ring is at least this far
+            if len(best) == count and -best[0][0] <= ring * self.cell_size:
+                break
+        return sorted(
+            (NearbyStation(station_id, self._numbers.get(station_id), -distance) for distance, station_id in best),
+            key=lambda nearby: nearby.distance,
+        )
@@ -0,0 +1,204 @@
+import datetime
+import logging
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import pathlib
+import queue
+import signal
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from component.database import Database
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CityConfig:
+    name: str
+    baseurl: str
+    db_file_name: str
+    requests_per_second: float = 5.0
+    # Time between the start of two scans of the city, in seconds
+    scan_interval: float = 60.0
+    # Port of the metrics of the worker process, if any, see `component.metrics`
+    metrics_port: int | None = None
+    # File where the worker process dumps its metrics as JSON after each scan cycle, if any
+    metrics_json: pathlib.Path | None = None
+
+
+# The function run by each worker process: it collects the given city until the event is set, and puts a health
+# report (a dict) in the queue after each scan. It starts with the `handled_signals` of the supervisor blocked, and
+# unblocks them once it has installed its handlers.
+CityWorker = Callable[[CityConfig, multiprocessing.Queue, multiprocessing.synchronize.Event], None]
+
+
+@dataclass
+class _WorkerState:
+    config: CityConfig
+    process: multiprocessing.Process | None = None
+    restarts: int = 0
+    next_start_at: float = 0.0
+    started_at: float = 0.0
+    last_report: dict[str, Any] = field(default_factory=dict)
+
+
+class CitySupervisor:
+    """
+    Runs one worker process per city, each with its own API client, database file and requests budget, so that a
+    slow (or crashing) city never holds back the other ones, and so that the collection uses several cores.
+
+    A crashed worker is restarted, after a delay doubling at each consecutive crash (up to `max_restart_delay`).
+    A worker running fine for `stable_after` seconds is considered recovered, and its delay is reset.
+
+    The `handled_signals` (forwarded by `signal_workers`) are blocked in the workers until they install their
+    handlers: delivered before, their default action would kill the worker. Only the signal mask inherited by the
+    process started does this, not the forkserver start method.
+    """
+
+    def __init__(
+            self,
+            cities: list[CityConfig],
+            worker: CityWorker,
+            min_restart_delay: float = 1.0,
+            max_restart_delay: float = 300.0,
+            stable_after: float = 600.0,
+            handled_signals: tuple[int, ...] = (signal.SIGUSR1,),
+    ) -> None:
+        self.worker = worker
+        self.handled_signals = handled_signals
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self._workers = {city.name: _WorkerState(config=city) for city in cities}
+        self._reports: multiprocessing.Queue = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+
+    def _start_worker(self, state: _WorkerState) -> None:
+        state.process = multiprocessing.Process(
+            target=self.worker,
+            args=(state.config, self._reports, self._stop),
+            name=f"collector-{state.config.name}",
+        )
+        # Inherited by the worker process, and pending until it unblocks them
+        previous_mask = signal.pthread_sigmask(signal.SIG_BLOCK, self.handled_signals)
+        try:
+            state.process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous_mask)
+        state.started_at = time.monotonic()
+        log.info("Started the worker of city=%s with pid=%s", state.config.name, state.process.pid)
+
+    def _drain_reports(self) -> None:
+        while True:
+            try:
+                report = self._reports.get_nowait()
+            except queue.Empty:
+                return
+            state = self._workers.get(report.get("city"))
+            if state is not None:
+                state.last_report = report
+
+    def check_workers(self) -> None:
+        """Collects the health reports, and (re)starts the workers which are due."""
+        self._drain_reports()
+        now = time.monotonic()
+        for state in self._workers.values():
+            if state.process is not None and state.process.is_alive():
+                continue
+            if state.process is not None:
+                # Crashed, as we were not stopping
+                uptime = now - state.started_at
+                if uptime >= self.stable_after:
+                    state.restarts = 0
+                delay = min(self.max_restart_delay, self.min_restart_delay * 2 ** state.restarts)
+                log.error("The worker of city=%s exited with code=%s after %.0fs, restarting it in %.0fs",
+                          state.config.name, state.process.exitcode, uptime, delay)
+                state.process.close()
+                state.process = None
+                state.restarts += 1
+                state.next_start_at = now + delay
+            if now >= state.next_start_at:
+                self._start_worker(state)
+
+    def health(self) -> dict[str, dict[str, Any]]:
+        """The health of each city: whether its worker is alive, its restarts, and its latest report."""
+        self._drain_reports()
+        return {
+            name: {
+                "alive": state.process is not None and state.process.is_alive(),
+                "pid": state.process.pid if state.process is not None else None,
+                "restarts": state.restarts,
+                **state.last_report,
+            }
+            for name, state in self._workers.items()
+        }
+
+    def signal_workers(self, signum: int) -> None:
+        """Sends the given signal to the running workers (e.g. SIGUSR1, see `component.profiling`)"""
+        for state in self._workers.values():
+            if state.process is not None and state.process.pid is not None:
+                try:
+                    os.kill(state.process.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def request_stop(self) -> None:
+        """Asks all the workers to stop gracefully. Safe to call from a signal handler."""
+        self._stop.set()
+
+    def run(self, check_interval: float = 1.0, health_log_interval: float = 60.0, stop_timeout: float = 60.0) -> None:
+        """
+        Runs the workers until `request_stop` is called, then waits for them to stop, killing the ones
+        still running after `stop_timeout` seconds.
+        """
+        health_logged_at = time.monotonic()
+        while not self._stop.is_set():
+            self.check_workers()
+            if time.monotonic() - health_logged_at >= health_log_interval:
+                log.info("Health of the cities: %s", self.health())
+                health_logged_at = time.monotonic()
+            self._stop.wait(check_interval)
+
+        deadline = time.monotonic() + stop_timeout
+        for state in self._workers.values():
+            if state.process is None:
+                continue
+            state.process.join(max(0.0, deadline - time.monotonic()))
+            if state.process.is_alive():
+                log.warning("The worker of city=%s did not stop in time, killing it", state.config.name)
+                state.process.kill()
+                state.process.join()
+
+
+class CityReader:
+    """Reads the databases of several cities, returning the result of a same query for each city."""
+
+    def __init__(self, cities: list[CityConfig]) -> None:
+        self.cities = cities
+        self._databases: dict[str, Database] = {}
+
+    def _get_database(self, city: CityConfig) -> Database:
+        if city.name not in self._databases:
+            self._databases[city.name] = Database(city.db_file_name)
+        return self._databases[city.name]
+
+    def query(self, read: Callable[[Database], Any]) -> dict[str, Any]:
+        """E.g. `reader.query(lambda db: db.find_trips_between(since, until))`"""
+        return {city.name: read(self._get_database(city)) for city in self.cities}
+
+    def find_all_stations(self) -> dict[str, list[dict[str, Any]]]:
+        return self.query(lambda db: db.find_all_stations())
+
+    def find_bikes_at_all_stations(self, at: datetime.datetime) -> dict[str, dict[int, set[str]]]:
+        return self.query(lambda db: db.find_bikes_at_all_stations(at))
+
+    def find_trips_between(self, since: datetime.datetime, until: datetime.datetime) -> dict[str, list[dict[str, Any]]]:
+        return self.query(lambda db: db.find_trips_between(since, until))
+
+    def close(self) -> None:
+        for db in self._databases.values():
+            db.close()
+        self._databases.clear()
@@ -0,0 +1,161 @@
+"""
+Reconstruction of the trips of the bikes from their evolutions: a trip is an OUT of a bike at a station, followed
+by the next IN of the same bike (at any station).
+
+The time of an evolution is the time its station was fetched, and the stations are not all fetched at once (the
+scheduler may leave one up to 15 minutes): the IN of a bike at its destination may well be detected before its OUT
+at its origin. Such an IN is kept, and paired with the next OUT of the bike at another station, if detected
+within `max_detection_lag`.
+
+The bikes evolutions are read in a single pass, in chronological order, keeping in memory only the departures not
+arrived yet, and the arrivals not departed yet. Each run resumes from where the previous one stopped (its
+high-water mark), along with the departures and arrivals still unmatched at that time.
+"""
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TripBuilder:
+    """
+    Builds the `trips` table from the bikes evolutions, incrementally.
+
+    Missing or duplicated evolutions are handled as follows:
+      * an IN without any open departure of this bike (e.g. its first sighting, a missed OUT, or an OUT detected
+        late) is kept for `max_detection_lag` seconds: an OUT of the bike at another station meanwhile ends the trip
+        there, with an unknown duration (recorded as 0, the trip starting when it ends);
+      * an OUT while a departure of this bike is already open (i.e. a missed IN) replaces the open departure;
+      * a trip longer than `max_trip_duration` seconds (e.g. a bike taken away for repairs) is discarded, and a
+        departure open for longer is forgotten.
+
+    The evolutions of the last `settle_duration` seconds are left for the next run, as evolutions of this same
+    time may still be in flight to the database.
+    """
+
+    def __init__(
+            self,
+            connection: sqlite3.Connection,
+            chunk_size: int = 100_000,
+            max_trip_duration: int = 24 * 3600,
+            settle_duration: int = 300,
+            # The max staleness of a station for the scheduler, and a scan cycle
+            max_detection_lag: int = 16 * 60,
+    ) -> None:
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.max_trip_duration = max_trip_duration
+        self.settle_duration = settle_duration
+        self.max_detection_lag = max_detection_lag
+
+    def _load_events(self, table: str) -> dict[int, tuple[int, int]]:
+        """bike_id -> (station_id, at)"""
+        return {
+            bike_id: (station_id, at)
+            for bike_id, station_id, at in self.connection.execute(f"SELECT bike_id, station_id, at FROM {table}")
+        }
+
+    def _save_events(self, table: str, events: dict[int, tuple[int, int]]) -> None:
+        self.connection.execute(f"DELETE FROM {table}")
+        self.connection.executemany(
+            f"INSERT INTO {table} (bike_id, station_id, at) VALUES (?, ?, ?)",
+            [(bike_id, station_id, at) for bike_id, (station_id, at) in events.items()],
+        )
+
+    def _load_state(self) -> tuple[tuple[int, int, int], dict[int, tuple[int, int]], dict[int, tuple[int, int]]]:
+        progress = self.connection.execute("SELECT last_at, last_action, last_rowid FROM trips_progress").fetchone()
+        return (
+            tuple(progress) if progress else (-1, -1, -1),
+            self._load_events("trips_open_departures"),
+            self._load_events("trips_unmatched_arrivals"),
+        )
+
+    def _save_state(
+            self,
+            high_water_mark: tuple[int, int, int],
+            open_departures: dict[int, tuple[int, int]],
+            unmatched_arrivals: dict[int, tuple[int, int]],
+    ) -> None:
+        self.connection.execute("DELETE FROM trips_progress")
+        self.connection.execute(
+            "INSERT INTO trips_progress (last_at, last_action, last_rowid) VALUES (?, ?, ?)", high_water_mark
+        )
+        self._save_events("trips_open_departures", open_departures)
+        self._save_events("trips_unmatched_arrivals", unmatched_arrivals)
+
+    @staticmethod
+    def _expire(events: dict[int, tuple[int, int]], oldest_at: int) -> int:
+        """Forgets the events older than `oldest_at`, and returns how many"""
+        expired = [bike_id for bike_id, (_, at) in events.items() if at < oldest_at]
+        for bike_id in expired:
+            del events[bike_id]
+        return len(expired)
+
+    def run(self) -> int:
+        """Builds the trips since the previous run, and returns how many were built."""
+        high_water_mark, open_departures, unmatched_arrivals = self._load_state()
+        latest_at = self.connection.execute("SELECT max(at) FROM bikes_evolution").fetchone()[0]
+        if latest_at is None:
+            return 0
+        until = latest_at - self.settle_duration
+        log.info("Building the trips from high_water_mark=%s with count=%d open departures",
+                 high_water_mark, len(open_departures))
+
+        trips_count, discarded_count, started_at = 0, 0, time.monotonic()
+        while True:
+            # Chronological order. For a same time (e.g. a bulk fetch of all the stations at once), the OUT (0)
+            # go before the IN (1), so that a bike seen leaving a station and arriving at another one in the
+            # same scan makes a trip.
+            rows = self.connection.execute(
+                """
+                SELECT at, action, rowid, station_id, bike_id
+                FROM bikes_evolution
+                WHERE (at, action, rowid) > (?, ?, ?) AND at <= ?
+                ORDER BY at, action, rowid
+                LIMIT ?
+                """, (*high_water_mark, until, self.chunk_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            trips = []
+            for at, action, _, station_id, bike_id in rows:
+                if not action:
+                    arrival = unmatched_arrivals.pop(bike_id, None)
+                    if arrival is not None and arrival[0] != station_id and at - arrival[1] <= self.max_detection_lag:
+                        # Arrived before its departure was detected
+                        end_station_id, end_at = arrival
+                        trips.append((bike_id, station_id, end_at, end_station_id, end_at, 0))
+                    else:
+                        open_departures[bike_id] = (station_id, at)
+                    continue
+                departure = open_departures.pop(bike_id, None)
+                if departure is None or at - departure[1] > self.max_trip_duration:
+                    if departure is not None:
+                        discarded_count += 1
+                    # Its departure may not be detected yet
+                    unmatched_arrivals[bike_id] = (station_id, at)
+                    continue
+                unmatched_arrivals.pop(bike_id, None)
+                start_station_id, start_at = departure
+                trips.append((bike_id, start_station_id, start_at, station_id, at, at - start_at))
+
+            high_water_mark = tuple(rows[-1][:3])
+            # E.g. the bikes taken away for repairs, never seen again
+            discarded_count += self._expire(open_departures, high_water_mark[0] - self.max_trip_duration)
+            self._expire(unmatched_arrivals, high_water_mark[0] - self.max_detection_lag)
+            self.connection.executemany(
+                """
+                INSERT INTO trips (bike_id, start_station_id, start_at, end_station_id, end_at, duration)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """, trips)
+            # Same transaction: the trips and the high-water mark are always in sync, whenever the run stops
+            self._save_state(high_water_mark, open_departures, unmatched_arrivals)
+            self.connection.commit()
+            trips_count += len(trips)
+            log.info("Built count=%d trips so far, up to at=%s", trips_count, high_water_mark[0])
+
+        log.info("Built count=%d trips (discarded count=%d too long) in %.1fs, count=%d bikes still in trip",
+                 trips_count, discarded_count, time.monotonic() - started_at, len(open_departures))
+        return trips_count
@@ -5,19 +5,29 @@ Written by Le Chat, from Mistral AI.
 from dataclasses import dataclass, field
 from typing import Any
 
-@dataclass
+@dataclass(slots=True)
 class Rating:
     count: int | None = None
     lastRatingDateTime: str | None = None
     value: float | None = None
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'Rating':
+        get = data.get
+        return cls(get('count'), get('lastRatingDateTime'), get('value'))
+
+@dataclass(slots=True)
 class Battery:
     level: int | None = None
     percentage: int | None = None
     type: str | None = None
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'Battery':
+        get = data.get
+        return cls(get('level'), get('percentage'), get('type'))
+
+@dataclass(slots=True)
 class Bike:
     bikeBatteryMv: int | None = None
     checked: bool | None = None
@@ -48,46 +58,74 @@ class Bike:
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]) -> 'Bike':
-        rating_data = data.get('rating', {})
-        battery_data = data.get('battery', {})
-
+        # Called for every bike of every scan: positional arguments, in the order of the fields above
+        get = data.get
         return cls(
-            bikeBatteryMv=data.get('bikeBatteryMv'),
-            checked=data.get('checked'),
-            contractName=data.get('contractName'),
-            createdAt=data.get('createdAt'),
-            energySource=data.get('energySource'),
-            frameId=data.get('frameId'),
-            hasBattery=data.get('hasBattery'),
-            hasLock=data.get('hasLock'),
-            id=data.get('id'),
-            isReserved=data.get('isReserved'),
-            number=data.get('number'),
-            standNumber=data.get('standNumber'),
-            stationNumber=data.get('stationNumber'),
-            status=data.get('status'),
-            statusLabel=data.get('statusLabel'),
-            type=data.get('type'),
-            updatedAt=data.get('updatedAt'),
-            lastDataFrameDate=data.get('lastDataFrameDate'),
-            bikeTopHwVersion=data.get('bikeTopHwVersion'),
-            bikeTopSwVersion=data.get('bikeTopSwVersion'),
-            bmsSwVersion=data.get('bmsSwVersion'),
-            motorControllerHwVersion=data.get('motorControllerHwVersion'),
-            motorControllerSwVersion=data.get('motorControllerSwVersion'),
-            zedSwVersion=data.get('zedSwVersion'),
-            rating=Rating(
-                count=rating_data.get('count'),
-                lastRatingDateTime=rating_data.get('lastRatingDateTime'),
-                value=rating_data.get('value')
-            ),
-            battery=Battery(
-                level=battery_data.get('level'),
-                percentage=battery_data.get('percentage'),
-                type=battery_data.get('type')
-            )
+            get('bikeBatteryMv'),
+            get('checked'),
+            get('contractName'),
+            get('createdAt'),
+            get('energySource'),
+            get('frameId'),
+            get('hasBattery'),
+            get('hasLock'),
+            get('id'),
+            get('isReserved'),
+            get('number'),
+            get('standNumber'),
+            get('stationNumber'),
+            get('status'),
+            get('statusLabel'),
+            get('type'),
+            get('updatedAt'),
+            get('lastDataFrameDate'),
+            get('bikeTopHwVersion'),
+            get('bikeTopSwVersion'),
+            get('bmsSwVersion'),
+            get('motorControllerHwVersion'),
+            get('motorControllerSwVersion'),
+            get('zedSwVersion'),
+            Rating.from_dict(get('rating') or {}),
+            Battery.from_dict(get('battery') or {}),
         )
 
+class BikeBatch:
+    """
+    Projection of some fields of many bikes, as a struct of arrays: one list (column) per projected field, in the
+    order of the bikes. Only the projected fields are decoded, the full `Bike` objects are built on demand only.
+    """
+    __slots__ = ('fields', 'columns', '_raw_bikes', '_bikes')
+
+    def __init__(self, fields: tuple[str, ...], columns: dict[str, list[Any]], raw_bikes: list[dict[str, Any]]) -> None:
+        self.fields = fields
+        self.columns = columns
+        self._raw_bikes = raw_bikes
+        self._bikes: dict[int, Bike] = {}
+
+    @classmethod
+    def from_dicts(cls, raw_bikes: list[dict[str, Any]], fields: tuple[str, ...]) -> 'BikeBatch':
+        """E.g. `BikeBatch.from_dicts(raw_bikes, ('id', 'stationNumber', 'standNumber'))`"""
+        return cls(fields, {name: [bike.get(name) for bike in raw_bikes] for name in fields}, raw_bikes)
+
+    def __len__(self) -> int:
+        return len(self._raw_bikes)
+
+    def column(self, name: str) -> list[Any]:
+        return self.columns[name]
+
+    def tuples(self) -> list[tuple]:
+        """One light tuple per bike, with the projected fields in the order of `fields`"""
+        return list(zip(*(self.columns[name] for name in self.fields)))
+
+    def bike(self, index: int) -> Bike:
+        bike = self._bikes.get(index)
+        if bike is None:
+            bike = self._bikes[index] = Bike.from_dict(self._raw_bikes[index])
+        return bike
+
+    def bikes(self) -> list[Bike]:
+        return [self.bike(index) for index in range(len(self))]
+
 class BikeCSVSerializer:
     @staticmethod
     def get_header() -> list[str]:
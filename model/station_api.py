@@ -1,12 +1,17 @@
 from dataclasses import dataclass, field
 from typing import Any
 
-@dataclass
+@dataclass(slots=True)
 class Position:
     latitude: float | None = None
     longitude: float | None = None
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'Position':
+        get = data.get
+        return cls(get('latitude'), get('longitude'))
+
+@dataclass(slots=True)
 class Availabilities:
     bikes: int | None = None
     electricalBikes: int | None = None
@@ -15,12 +20,29 @@ class Availabilities:
     mechanicalBikes: int | None = None
     stands: int | None = None
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'Availabilities':
+        get = data.get
+        return cls(
+            get('bikes'),
+            get('electricalBikes'),
+            get('electricalInternalBatteryBikes'),
+            get('electricalRemovableBatteryBikes'),
+            get('mechanicalBikes'),
+            get('stands'),
+        )
+
+@dataclass(slots=True)
 class Stands:
     availabilities: Availabilities = field(default_factory=Availabilities)
     capacity: int | None = None
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'Stands':
+        get = data.get
+        return cls(Availabilities.from_dict(get('availabilities') or {}), get('capacity'))
+
+@dataclass(slots=True)
 class Station:
     address: str | None = None
     banking: bool | None = None
@@ -40,49 +62,24 @@ class Station:
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]) -> 'Station':
-        position_data = data.get('position', {})
-        main_stands_data = data.get('mainStands', {})
-        total_stands_data = data.get('totalStands', {})
-
+        # Each nested object is looked up once. Positional arguments, in the order of the fields above
+        get = data.get
         return cls(
-            address=data.get('address'),
-            banking=data.get('banking'),
-            bonus=data.get('bonus'),
-            connected=data.get('connected'),
-            contractName=data.get('contractName'),
-            lastUpdate=data.get('lastUpdate'),
-            name=data.get('name'),
-            number=data.get('number'),
-            overflow=data.get('overflow'),
-            overflowStands=data.get('overflowStands'),
-            shape=data.get('shape'),
-            status=data.get('status'),
-            position=Position(
-                latitude=position_data.get('latitude'),
-                longitude=position_data.get('longitude')
-            ),
-            mainStands=Stands(
-                availabilities=Availabilities(
-                    bikes=main_stands_data.get('availabilities', {}).get('bikes'),
-                    electricalBikes=main_stands_data.get('availabilities', {}).get('electricalBikes'),
-                    electricalInternalBatteryBikes=main_stands_data.get('availabilities', {}).get('electricalInternalBatteryBikes'),
-                    electricalRemovableBatteryBikes=main_stands_data.get('availabilities', {}).get('electricalRemovableBatteryBikes'),
-                    mechanicalBikes=main_stands_data.get('availabilities', {}).get('mechanicalBikes'),
-                    stands=main_stands_data.get('availabilities', {}).get('stands')
-                ),
-                capacity=main_stands_data.get('capacity')
-            ),
-            totalStands=Stands(
-                availabilities=Availabilities(
-                    bikes=total_stands_data.get('availabilities', {}).get('bikes'),
-                    electricalBikes=total_stands_data.get('availabilities', {}).get('electricalBikes'),
-                    electricalInternalBatteryBikes=total_stands_data.get('availabilities', {}).get('electricalInternalBatteryBikes'),
-                    electricalRemovableBatteryBikes=total_stands_data.get('availabilities', {}).get('electricalRemovableBatteryBikes'),
-                    mechanicalBikes=total_stands_data.get('availabilities', {}).get('mechanicalBikes'),
-                    stands=total_stands_data.get('availabilities', {}).get('stands')
-                ),
-                capacity=total_stands_data.get('capacity')
-            )
+            get('address'),
+            get('banking'),
+            get('bonus'),
+            get('connected'),
+            get('contractName'),
+            get('lastUpdate'),
+            get('name'),
+            get('number'),
+            get('overflow'),
+            get('overflowStands'),
+            get('shape'),
+            get('status'),
+            Position.from_dict(get('position') or {}),
+            Stands.from_dict(get('mainStands') or {}),
+            Stands.from_dict(get('totalStands') or {}),
         )
 
 class StationCSVSerializer:
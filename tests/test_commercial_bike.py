@@ -0,0 +1,59 @@
+import pathlib
+import tempfile
+import unittest
+
+from component.commercial_bike import CommercialBikeClient
+from component.discovery_cache import DiscoveryCache
+from component.raw_archive import UNCHANGED, RawResponseArchive
+from utils.fake_api_server import FakeApiServer, SyntheticCity
+
+
+class BulkArchiveTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = pathlib.Path(tmp_dir.name)
+        self.city = SyntheticCity(stations=3, bikes=6, churn=0)
+        self.server = FakeApiServer(city=self.city).start()
+        self.addCleanup(self.server.close)
+        self.archive = RawResponseArchive(self.tmp_path / "archive")
+        self.addCleanup(self.archive.close)
+        self.client = CommercialBikeClient(
+            self.server.base_url, cache=DiscoveryCache(self.tmp_path / "cache.json"), archive=self.archive,
+        )
+        self.addCleanup(self.client.close)
+
+    def fetch(self) -> dict:
+        return self.client.get_bikes_by_station([1, 2, 3], skip_unchanged=True)
+
+    def bike_ids(self, bikes) -> set[str]:
+        return {bike["id"] for bike in bikes}
+
+    def test_unchanged_stations_are_skipped_one_by_one(self):
+        first = self.fetch()
+        self.assertNotIn(UNCHANGED, first.values())
+        # A bike moving from station 1 to 2 leaves station 3 unchanged
+        bike_id, bike = next(iter(self.city._bikes_at[1].items()))
+        self.city._bikes_at[2][bike_id] = self.city._bikes_at[1].pop(bike_id)
+        second = self.fetch()
+        self.assertEqual(second[3], UNCHANGED)
+        self.assertIn(bike_id, self.bike_ids(second[2]))
+        self.assertNotIn(bike_id, self.bike_ids(second[1]))
+
+    def test_station_emptied_then_refilled_is_a_change(self):
+        bikes_at_1 = dict(self.city._bikes_at[1])
+        self.assertTrue(bikes_at_1)
+        self.assertEqual(self.bike_ids(self.fetch()[1]), set(bikes_at_1))
+
+        # Absent from the bulk response: no bike docked
+        self.city._bikes_at[1].clear()
+        self.assertEqual(self.fetch()[1], [])
+        self.assertEqual(self.fetch()[1], UNCHANGED)
+
+        # The same bikes back at the station
+        self.city._bikes_at[1].update(bikes_at_1)
+        self.assertEqual(self.bike_ids(self.fetch()[1]), set(bikes_at_1))
+
+
+if __name__ == "__main__":
+    unittest.main()
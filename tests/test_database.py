@@ -0,0 +1,100 @@
+import datetime
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from component.database import MIGRATIONS, Database
+from component.snapshot_diff import SnapshotDiff
+
+T0 = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name) / "bikes.db"
+        self.db = Database(str(self.path))
+        self.addCleanup(self.db.close)
+
+    def test_query_plans_use_the_indexes(self):
+        self.db.verify_query_plans()
+
+    def test_missing_index_fails_the_query_plans(self):
+        self.db.connection.execute("DROP INDEX bikes_evolution_station_id_at")
+        self.db.connection.commit()
+        # Not the connection of the statements already explained, cached with their plan
+        db = Database(str(self.path))
+        self.addCleanup(db.close)
+        with self.assertRaisesRegex(RuntimeError, "does not use index=bikes_evolution_station_id_at"):
+            db.verify_query_plans()
+
+    def test_snapshot_diff_rebuilt_from_the_latest_evolutions(self):
+        snapshot_diff = SnapshotDiff()
+        for minutes, bikes_at_stations in enumerate([
+            {1: {"b1", "b2"}, 2: {"b3"}},
+            {1: {"b2"}, 2: {"b3", "b1"}},
+            {1: set(), 2: {"b3", "b1", "b2"}},
+        ]):
+            for station_id, bike_ids in bikes_at_stations.items():
+                at = T0 + datetime.timedelta(minutes=minutes)
+                self.db.save_bikes_evolutions(snapshot_diff.diff(station_id, bike_ids, at))
+        self.db.save_stations([{
+            "number": number, "name": f"{number}", "address": "", "latitude": 0.0, "longitude": 0.0,
+            "total_stand_capacity": 10,
+        } for number in (1, 2)])
+
+        rebuilt = SnapshotDiff.from_database(Database(str(self.path)))
+        self.assertEqual(rebuilt.bikes_by_station, {2: {"b1", "b2", "b3"}})
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name) / "old.db"
+
+    def test_initial_schema_migrated_with_its_rows(self):
+        old_db = Database.__new__(Database)
+        old_db.file_name = str(self.path)
+        old_db._create_tables()
+        connection = sqlite3.connect(self.path)
+        connection.execute("INSERT INTO stations (number, name) VALUES (34, 'station 34')")
+        # As written before the migrations: local naive ISO dates, UUIDs and I/O actions
+        connection.executemany(
+            "INSERT INTO bikes_evolution (at, station_id, bike_id, action) VALUES (?, ?, ?, ?)", [
+                ("2024-05-01 08:00:00", 1, "uuid-a", "I"),
+                ("2024-05-01 08:00:00", 1, "uuid-b", "I"),
+                ("2024-05-01 08:05:30", 1, "uuid-a", "O"),
+            ])
+        connection.commit()
+        self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0], 0)
+        connection.close()
+
+        db = Database(str(self.path))
+        self.addCleanup(db.close)
+        self.assertEqual(db.get_schema_version(), len(MIGRATIONS))
+        self.assertEqual(db.find_all_bikes_evolutions_by_station_id(1), [
+            {"at": T0, "station_id": 1, "bike_id": "uuid-a", "action": "I"},
+            {"at": T0, "station_id": 1, "bike_id": "uuid-b", "action": "I"},
+            {"at": T0 + datetime.timedelta(minutes=5, seconds=30), "station_id": 1, "bike_id": "uuid-a", "action": "O"},
+        ])
+        self.assertEqual(db.connection.execute("SELECT at FROM bikes_evolution WHERE rowid = 1").fetchone()[0],
+                         int(T0.timestamp()))
+        self.assertEqual(db.find_bikes_at_station(1, T0 + datetime.timedelta(hours=1)), {"uuid-b"})
+        db.verify_query_plans()
+        # The new rows go on from the migrated ones
+        db.save_bikes_evolutions([{"at": T0 + datetime.timedelta(hours=1), "station_id": 1, "bike_id": "uuid-a",
+                                   "action": "I"}])
+        self.assertEqual(db.get_bike_ids(["uuid-a"]), {"uuid-a": 1})
+
+    def test_migrations_applied_once(self):
+        Database(str(self.path)).close()
+        db = Database(str(self.path))
+        self.addCleanup(db.close)
+        self.assertEqual(db.get_schema_version(), len(MIGRATIONS))
+
+
+if __name__ == "__main__":
+    unittest.main()
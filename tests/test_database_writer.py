@@ -0,0 +1,56 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+from component.database import Database
+from component.database_writer import DatabaseWriter
+
+T0 = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+class DatabaseWriterTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.file_name = str(pathlib.Path(tmp_dir.name) / "bikes.db")
+        self.db = Database(self.file_name)
+        self.addCleanup(self.db.close)
+
+    def evolutions_count(self) -> int:
+        return self.db.connection.execute("SELECT count(*) FROM bikes_evolution").fetchone()[0]
+
+    def test_rows_committed_by_flush_and_close(self):
+        # Never committed on their own, within the test
+        writer = DatabaseWriter(self.file_name, batch_size=1000, batch_interval=3600)
+        writer.save_bikes_evolutions([{"at": T0, "station_id": 1, "bike_id": "b1", "action": "I"}])
+        writer.flush()
+        self.assertEqual(self.evolutions_count(), 1)
+        writer.save_bikes_evolutions([{"at": T0, "station_id": 1, "bike_id": "b2", "action": "I"}])
+        writer.close()
+        self.assertEqual(self.evolutions_count(), 2)
+
+    def test_failure_raised_by_flush_close_and_the_next_saves(self):
+        writer = DatabaseWriter(self.file_name)
+        # No action: fails in the writer thread
+        writer.save_bikes_evolutions([{"at": T0, "station_id": 1, "bike_id": "b1"}])
+        with self.assertRaisesRegex(RuntimeError, "failed") as raised:
+            writer.flush()
+        self.assertIsInstance(raised.exception.__cause__, KeyError)
+        with self.assertRaises(RuntimeError):
+            writer.save_bikes_evolutions([{"at": T0, "station_id": 1, "bike_id": "b1", "action": "I"}])
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+    def test_close_does_not_block_on_a_dead_writer_with_a_full_queue(self):
+        writer = DatabaseWriter(self.file_name, max_queue_size=1)
+        writer.save_bikes_evolutions([{"at": T0, "station_id": 1, "bike_id": "b1"}])
+        writer._thread.join(timeout=5)
+        # Only possible as the thread died: nothing drains the queue anymore
+        writer._queue.put(("bikes_evolutions", []))
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import http.server
+import threading
+import unittest
+
+from component.http_session import HttpSession
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self):
+        self.server.requests.append(self.command)
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+        # Closed without telling the client, as a server dropping its idle connections
+        self.close_connection = self.server.drop_connections
+
+    do_GET = _reply
+    do_POST = _reply
+
+
+class HttpSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.session = HttpSession(timeout=7)
+        self.addCleanup(self.session.close)
+        self.netloc = f"127.0.0.1:{self.server.server_address[1]}"
+        self.url = f"http://{self.netloc}/"
+
+    def idle_connections(self):
+        return list(self.session._get_pool("http", self.netloc)._idle.queue)
+
+    def test_stale_connection_retried_for_get(self):
+        self.server.drop_connections = True
+        self.session.get(self.url)
+        self.session.get(self.url)
+        self.assertEqual(self.server.requests, ["GET", "GET"])
+
+    def test_post_never_sent_twice(self):
+        self.server.drop_connections = True
+        self.session.get(self.url)
+        # Not on the (stale) kept-alive connection
+        self.session.post_json(self.url, {"grant_type": "refresh_token"})
+        self.assertEqual(self.server.requests, ["GET", "POST"])
+
+    def test_request_timeout_not_kept_by_the_pool(self):
+        self.session.get(self.url, timeout=60)
+        [connection] = self.idle_connections()
+        self.assertEqual(connection.timeout, 7)
+        self.assertEqual(connection.sock.gettimeout(), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+from component.raw_archive import RawResponseArchive
+
+T0 = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+def minutes(count: int) -> datetime.datetime:
+    return T0 + datetime.timedelta(minutes=count)
+
+
+class RawResponseArchiveTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name) / "archive"
+
+    def open(self, **settings) -> RawResponseArchive:
+        archive = RawResponseArchive(self.path, **settings)
+        self.addCleanup(archive.connection.close)
+        return archive
+
+    def test_only_the_changes_are_stored(self):
+        archive = self.open()
+        self.assertTrue(archive.store("bikes", 1, b'[{"id":"b1"}]', minutes(0)))
+        self.assertFalse(archive.store("bikes", 1, b'[{"id":"b1"}]', minutes(1)))
+        # Another station, with the same payload: stored once, but a response of its own
+        self.assertTrue(archive.store("bikes", 2, b'[{"id":"b1"}]', minutes(1)))
+        self.assertTrue(archive.store("bikes", 1, b'[]', minutes(2)))
+        self.assertTrue(archive.store("bikes", 1, b'[{"id":"b1"}]', minutes(3)))
+
+        responses = archive.find_responses("bikes", 1)
+        self.assertEqual([(response["first_at"], response["last_at"]) for response in responses], [
+            (minutes(0), minutes(1)), (minutes(2), minutes(2)), (minutes(3), minutes(3)),
+        ])
+        self.assertEqual(archive.read(responses[1]["hash"]), b'[]')
+        self.assertEqual(archive.connection.execute("SELECT count(*) FROM blobs").fetchone()[0], 2)
+
+    def test_response_at(self):
+        archive = self.open()
+        archive.store("bikes", 1, b'[{"id":"b1"}]', minutes(0))
+        archive.store("bikes", 1, b'[]', minutes(5))
+        self.assertIsNone(archive.response_at("bikes", 1, minutes(-1)))
+        self.assertEqual(archive.response_at("bikes", 1, minutes(4)), b'[{"id":"b1"}]')
+        self.assertEqual(archive.response_at("bikes", 1, minutes(5)), b'[]')
+
+    def test_first_response_after_a_restart_is_a_change(self):
+        archive = self.open()
+        archive.store("stations", 1, b'{"number":1}', minutes(0))
+        archive.close()
+
+        archive = self.open()
+        # What was done with the previous one is not known: given again, but not stored again
+        self.assertTrue(archive.store("stations", 1, b'{"number":1}', minutes(1)))
+        self.assertFalse(archive.store("stations", 1, b'{"number":1}', minutes(2)))
+        archive.flush()
+        [response] = archive.find_responses("stations", 1)
+        self.assertEqual((response["first_at"], response["last_at"]), (minutes(0), minutes(2)))
+
+    def test_segments_rotated_and_readable(self):
+        archive = self.open(segment_size=64)
+        payloads = [bytes(range(256)) * (index + 1) for index in range(3)]
+        for index, payload in enumerate(payloads):
+            archive.store("bikes", 1, payload, minutes(index))
+        self.assertEqual(len(list(self.path.glob("segment-*.bin"))), 3)
+        for response, payload in zip(archive.find_responses("bikes", 1), payloads):
+            self.assertEqual(archive.read(response["hash"]), payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import io
+import socket
+import unittest
+import urllib.error
+
+from component.scanner import StationScanner
+
+
+def http_error(status: int) -> urllib.error.HTTPError:
+    return urllib.error.HTTPError("http://api/bikes", status, "error", {}, io.BytesIO())
+
+
+class BulkScanTest(unittest.TestCase):
+    def make_scanner(self, bulk_error: BaseException) -> StationScanner:
+        self.bulk_calls = 0
+
+        def fetch_bikes_by_station(station_ids):
+            self.bulk_calls += 1
+            if self.bulk_calls == 1:
+                raise bulk_error
+            return {1: [{"id": "bike-bulk"}]}
+
+        return StationScanner(
+            fetch_bikes=lambda station_id: [{"id": f"bike-{station_id}"}],
+            requests_per_second=1000,
+            fetch_bikes_by_station=fetch_bikes_by_station,
+        )
+
+    def test_refused_bulk_is_never_tried_again(self):
+        for status in (400, 403, 404):
+            scanner = self.make_scanner(http_error(status))
+            self.assertEqual(dict(scanner.scan_all([1, 2])), {1: [{"id": "bike-1"}], 2: [{"id": "bike-2"}]})
+            self.assertTrue(scanner.bulk_refused)
+            self.assertEqual(dict(scanner.scan_all([1, 2])), {1: [{"id": "bike-1"}], 2: [{"id": "bike-2"}]})
+            self.assertEqual(self.bulk_calls, 1)
+
+    def test_transient_failure_falls_back_for_one_scan_only(self):
+        for error in (http_error(429), http_error(503), socket.timeout("timed out"), TimeoutError(),
+                      urllib.error.URLError("unreachable"), ConnectionResetError(), ValueError("invalid JSON")):
+            scanner = self.make_scanner(error)
+            self.assertEqual(dict(scanner.scan_all([1, 2])), {1: [{"id": "bike-1"}], 2: [{"id": "bike-2"}]})
+            self.assertFalse(scanner.bulk_refused)
+            # The bulk request is tried again at the next scan
+            self.assertEqual(dict(scanner.scan_all([1, 2])), {1: [{"id": "bike-bulk"}], 2: []})
+            self.assertEqual(self.bulk_calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import datetime
+import unittest
+
+from component.snapshot_diff import SnapshotDiff
+
+T0 = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+def actions(bikes_evolutions) -> set[tuple[str, str]]:
+    return {(evolution["bike_id"], evolution["action"]) for evolution in bikes_evolutions}
+
+
+class SnapshotDiffTest(unittest.TestCase):
+    def test_first_snapshot_is_all_arrivals(self):
+        self.assertEqual(actions(SnapshotDiff().diff(1, ["b1", "b2"], T0)), {("b1", "I"), ("b2", "I")})
+
+    def test_only_the_changes_since_the_previous_snapshot(self):
+        snapshot_diff = SnapshotDiff()
+        snapshot_diff.diff(1, ["b1", "b2"], T0)
+        bikes_evolutions = snapshot_diff.diff(1, ["b2", "b3"], T0 + datetime.timedelta(minutes=1))
+        self.assertEqual(actions(bikes_evolutions), {("b3", "I"), ("b1", "O")})
+        self.assertEqual({evolution["station_id"] for evolution in bikes_evolutions}, {1})
+        self.assertEqual(snapshot_diff.diff(1, ["b3", "b2"], T0 + datetime.timedelta(minutes=2)), [])
+
+    def test_stations_are_independent(self):
+        snapshot_diff = SnapshotDiff()
+        snapshot_diff.diff(1, ["b1"], T0)
+        # Seen at station 2 before station 1 is fetched again
+        self.assertEqual(actions(snapshot_diff.diff(2, ["b1"], T0)), {("b1", "I")})
+        self.assertEqual(actions(snapshot_diff.diff(1, [], T0)), {("b1", "O")})
+
+    def test_emptied_then_refilled_station(self):
+        snapshot_diff = SnapshotDiff()
+        snapshot_diff.diff(1, ["b1"], T0)
+        self.assertEqual(actions(snapshot_diff.diff(1, [], T0)), {("b1", "O")})
+        self.assertEqual(actions(snapshot_diff.diff(1, ["b1"], T0)), {("b1", "I")})
+
+
+if __name__ == "__main__":
+    unittest.main()
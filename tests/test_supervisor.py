@@ -0,0 +1,64 @@
+import sys
+import threading
+import time
+import unittest
+
+from component.supervisor import CityConfig, CitySupervisor
+
+
+def crashing_worker(city, reports, stop):
+    sys.exit(3)
+
+
+def reporting_worker(city, reports, stop):
+    reports.put({"city": city.name, "cycle": 1})
+    stop.wait()
+
+
+class CitySupervisorTest(unittest.TestCase):
+    def make_supervisor(self, worker) -> CitySupervisor:
+        return CitySupervisor(
+            [CityConfig("city", "http://localhost", "city.db")], worker=worker,
+            min_restart_delay=0.2, max_restart_delay=0.4,
+        )
+
+    def wait_for_exit(self, supervisor: CitySupervisor) -> None:
+        supervisor._workers["city"].process.join(timeout=10)
+
+    def test_crashed_worker_restarted_with_a_doubling_delay(self):
+        supervisor = self.make_supervisor(crashing_worker)
+        supervisor.check_workers()
+        delays = []
+        for _ in range(3):
+            self.wait_for_exit(supervisor)
+            supervisor.check_workers()
+            state = supervisor._workers["city"]
+            self.assertIsNone(state.process)
+            delays.append(state.next_start_at - time.monotonic())
+            time.sleep(max(0.0, delays[-1]) + 0.05)
+            supervisor.check_workers()
+            self.assertIsNotNone(state.process)
+        for delay, expected in zip(delays, [0.2, 0.4, 0.4]):
+            self.assertAlmostEqual(delay, expected, delta=0.1)
+        self.assertEqual(supervisor.health()["city"]["restarts"], 3)
+        self.wait_for_exit(supervisor)
+
+    def test_reports_and_graceful_stop(self):
+        supervisor = self.make_supervisor(reporting_worker)
+        runner = threading.Thread(target=supervisor.run, kwargs={"check_interval": 0.05})
+        runner.start()
+        deadline = time.monotonic() + 10
+        while supervisor.health()["city"].get("cycle") != 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        health = supervisor.health()["city"]
+        self.assertTrue(health["alive"])
+        self.assertEqual(health["cycle"], 1)
+        supervisor.request_stop()
+        runner.join(timeout=10)
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(supervisor._workers["city"].process.exitcode, 0)
+        self.assertEqual(supervisor.health()["city"]["restarts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
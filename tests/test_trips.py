@@ -0,0 +1,68 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+from component.database import Database
+from component.trips import TripBuilder
+
+T0 = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+class TripBuilderTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.db = Database(str(pathlib.Path(tmp_dir.name) / "trips.db"))
+        self.addCleanup(self.db.close)
+
+    def save(self, *evolutions: tuple[int, int, str, str]) -> None:
+        """(seconds after T0, station_id, bike, action)"""
+        self.db.save_bikes_evolutions([{
+            "at": T0 + datetime.timedelta(seconds=seconds), "station_id": station_id, "bike_id": bike, "action": action,
+        } for seconds, station_id, bike, action in evolutions])
+
+    def build(self, **settings) -> list[tuple]:
+        TripBuilder(self.db.connection, settle_duration=0, **settings).run()
+        return [
+            (trip["bike_id"], trip["start_station_id"], trip["end_station_id"], trip["duration"])
+            for trip in self.db.find_trips_between(T0 - datetime.timedelta(days=1), T0 + datetime.timedelta(days=10))
+        ]
+
+    def test_departure_detected_before_arrival(self):
+        self.save((0, 1, "b1", "O"), (600, 2, "b1", "I"))
+        self.assertEqual(self.build(), [("b1", 1, 2, 600)])
+
+    def test_arrival_detected_before_departure(self):
+        # The origin was fetched 5 minutes after the destination
+        self.save((60, 2, "b1", "I"), (360, 1, "b1", "O"))
+        self.assertEqual(self.build(), [("b1", 1, 2, 0)])
+        # The next trip of the bike is not paired with the late OUT
+        self.save((3600, 2, "b1", "O"), (4200, 3, "b1", "I"))
+        self.assertEqual(self.build(), [("b1", 1, 2, 0), ("b1", 2, 3, 600)])
+
+    def test_arrival_kept_between_runs(self):
+        self.save((60, 2, "b1", "I"))
+        self.assertEqual(self.build(), [])
+        self.save((360, 1, "b1", "O"))
+        self.assertEqual(self.build(), [("b1", 1, 2, 0)])
+
+    def test_departure_too_late_after_arrival(self):
+        self.save((0, 2, "b1", "I"), (3600, 1, "b1", "O"), (4000, 3, "b1", "I"))
+        self.assertEqual(self.build(), [("b1", 1, 3, 400)])
+
+    def test_departure_from_the_station_arrived_at(self):
+        # Docked, then taken again: not a trip on its own
+        self.save((0, 2, "b1", "I"), (300, 2, "b1", "O"), (900, 3, "b1", "I"))
+        self.assertEqual(self.build(), [("b1", 2, 3, 600)])
+
+    def test_departures_never_arrived_are_forgotten(self):
+        self.save((0, 1, "b1", "O"), (3600, 1, "b2", "O"))
+        self.build(max_trip_duration=1800)
+        open_bikes = [row[0] for row in self.db.connection.execute(
+            "SELECT b.uuid FROM trips_open_departures d JOIN bikes b ON b.id = d.bike_id")]
+        self.assertEqual(open_bikes, ["b2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,305 @@
+"""
+End-to-end benchmarks of the collection and storage hot paths, with a single entry point:
+
+    python -m utils.benchmark [--rows 1000000 10000000] [--only parse storage ...]
+
+Each benchmark runs in its own process (so that its peak memory is its own), and reports its throughput, latency
+percentiles and peak memory. The results are written as JSON, and compared with the baseline committed next to
+this module (`benchmark_baseline.json`): a metric worse than the baseline by more than `--tolerance` is a regression,
+and makes the command fail. After an intended change of performance, update it with `--save-baseline` and commit it
+(its metadata tell the machine it was measured on).
+
+The metrics are named after their unit and direction: `*_per_s` are better when higher, the others (`*_ms`,
+`*_kb`) when lower.
+"""
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import pathlib
+import platform
+import random
+import resource
+import runpy
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Iterator
+
+from component.database import OUTPUT_PATH
+from component.discovery_cache import DiscoveryCache
+from model.bike_api import Bike, BikeCSVSerializer
+from model.station_api import Station, StationCSVSerializer
+from utils.fake_api_server import FakeApiServer, SyntheticCity
+
+ROOT_PATH = pathlib.Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE_PATH = pathlib.Path(__file__).resolve().with_name("benchmark_baseline.json")
+DEFAULT_RESULTS_PATH = OUTPUT_PATH / "benchmark_results.json"
+
+# Objects parsed (or serialized) per measured batch
+PARSE_BATCH_SIZE = 1000
+# Bikes evolutions saved per call of `save_bikes_evolutions`, as the DatabaseWriter does
+INSERT_BATCH_SIZE = 10_000
+STORAGE_STATIONS = 350
+STORAGE_BIKES = 5000
+QUERIES_COUNT = 100
+
+Results = dict[str, dict[str, float]]
+
+
+def _percentiles(latencies: list[float], prefix: str = "") -> dict[str, float]:
+    """p50, p95 and p99 of the given latencies (in seconds), in milliseconds"""
+    if len(latencies) < 2:
+        latencies = latencies * 2
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        f"{prefix}p50_ms": quantiles[49] * 1e3,
+        f"{prefix}p95_ms": quantiles[94] * 1e3,
+        f"{prefix}p99_ms": quantiles[98] * 1e3,
+    }
+
+
+def _measure(batches: Iterator[Any], run: Callable[[Any], int]) -> tuple[float, list[float]]:
+    """Runs each batch, and returns the throughput (items per second) and the latency of each batch"""
+    latencies, items = [], 0
+    for batch in batches:
+        started_at = time.perf_counter()
+        items += run(batch)
+        latencies.append(time.perf_counter() - started_at)
+    return items / sum(latencies), latencies
+
+
+def _in_batches(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bench_parse(work_dir: pathlib.Path, args: argparse.Namespace) -> Results:
+    city = SyntheticCity(stations=STORAGE_STATIONS * 10, bikes=STORAGE_BIKES * 10, seed=1)
+    raw_bikes, raw_stations = city.bikes_payload(), city.stations_payload()
+    results = {}
+    for name, from_dict, payloads in (("bike", Bike.from_dict, raw_bikes), ("station", Station.from_dict, raw_stations)):
+        throughput, latencies = _measure(
+            _in_batches(payloads, PARSE_BATCH_SIZE),
+            lambda batch: len([from_dict(payload) for payload in batch]),
+        )
+        results[f"parse_{name}"] = {"objects_per_s": throughput, **_percentiles(latencies, "batch_")}
+    return results
+
+
+def bench_csv(work_dir: pathlib.Path, args: argparse.Namespace) -> Results:
+    city = SyntheticCity(stations=STORAGE_STATIONS * 10, bikes=STORAGE_BIKES * 10, seed=1)
+    bikes = [Bike.from_dict(bike) for bike in city.bikes_payload()]
+    stations = [Station.from_dict(station) for station in city.stations_payload()]
+    results = {}
+    for name, serializer, objects in (("bike", BikeCSVSerializer, bikes), ("station", StationCSVSerializer, stations)):
+        def write(batch: list) -> int:
+            writer = csv.writer(io.StringIO(), dialect=csv.unix_dialect, quoting=csv.QUOTE_ALL)
+            writer.writerow(serializer.get_header())
+            for obj in batch:
+                writer.writerow(serializer.get_row(obj))
+            return len(batch)
+
+        throughput, latencies = _measure(_in_batches(objects, PARSE_BATCH_SIZE), write)
+        results[f"csv_{name}"] = {"rows_per_s": throughput, **_percentiles(latencies, "batch_")}
+    return results
+
+
+def _bikes_evolutions(count: int, seed: int = 1) -> Iterator[list[dict[str, Any]]]:
+    """
+    Batches of realistic bikes evolutions: each bike leaves its station (OUT), then arrives at another one (IN),
+    one evolution per second.
+    """
+    rng = random.Random(seed)
+    bike_ids = [f"00000000-0000-4000-8000-{index:012d}" for index in range(STORAGE_BIKES)]
+    station_of = {bike_id: rng.randint(1, STORAGE_STATIONS) for bike_id in bike_ids}
+    in_trip: dict[str, bool] = {}
+    at = datetime.datetime(2024, 1, 1)
+    batch = []
+    for _ in range(count):
+        bike_id = rng.choice(bike_ids)
+        if in_trip.get(bike_id):
+            station_of[bike_id] = rng.randint(1, STORAGE_STATIONS)
+        in_trip[bike_id] = not in_trip.get(bike_id)
+        at += datetime.timedelta(seconds=1)
+        batch.append({"at": at, "station_id": station_of[bike_id], "bike_id": bike_id,
+                      "action": "O" if in_trip[bike_id] else "I"})
+        if len(batch) == INSERT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bench_storage(work_dir: pathlib.Path, args: argparse.Namespace, rows: int) -> Results:
+    from component.database import Database
+
+    db = Database(str(work_dir / f"benchmark_{rows}.db"))
+    db.save_stations([{
+        "number": number, "name": f"{number}", "address": "", "latitude": 50.8, "longitude": 4.3,
+        "total_stand_capacity": 20,
+    } for number in range(1, STORAGE_STATIONS + 1)])
+
+    def save(batch: list[dict[str, Any]]) -> int:
+        db.save_bikes_evolutions(batch)
+        return len(batch)
+
+    throughput, latencies = _measure(_bikes_evolutions(rows), save)
+    results = {f"storage_insert_{rows}": {"rows_per_s": throughput, **_percentiles(latencies, "batch_")}}
+
+    rng = random.Random(2)
+    station_ids = [row["rowid"] for row in db.find_all_stations()]
+    throughput, latencies = _measure(
+        (rng.choice(station_ids) for _ in range(QUERIES_COUNT)),
+        lambda station_id: len(db.find_all_bikes_evolutions_by_station_id(station_id)),
+    )
+    results[f"storage_query_by_station_{rows}"] = {
+        "rows_per_s": throughput,
+        "queries_per_s": QUERIES_COUNT / sum(latencies),
+        **_percentiles(latencies),
+    }
+    db.close()
+    return results
+
+
+def bench_scan_cycle(work_dir: pathlib.Path, args: argparse.Namespace) -> Results:
+    # The app lives in the `__main__.py` of the project
+    app_class = runpy.run_path(str(ROOT_PATH / "__main__.py"), run_name="benchmarked_app")["VilloTrackerApp"]
+    results = {}
+    for mode, refuse_bulk in (("bulk", False), ("per_station", True)):
+        server = FakeApiServer(
+            city=SyntheticCity(stations=args.scan_stations, bikes=args.scan_bikes, churn=0.05, seed=1),
+            refuse_bulk=refuse_bulk,
+        ).start()
+        try:
+            app = app_class(
+                baseurl=server.base_url,
+                db_file_name=str(work_dir / f"scan_cycle_{mode}.db"),
+                # Not to measure the rate limiter
+                requests_per_second=10_000,
+                cache=DiscoveryCache(work_dir / f"discovery_cache_{mode}.json"),
+            )
+            latencies, evolutions = [], 0
+            for _ in range(args.scan_cycles + 1):
+                stats = app.run_cycle()
+                latencies.append(stats["cycle_duration"])
+                evolutions += stats["evolutions"]
+            app.close()
+        finally:
+            server.close()
+        # The first cycle is the cold one: discovery, then all the bikes evolving from nowhere
+        results[f"scan_cycle_{mode}"] = {
+            "cold_cycle_ms": latencies[0] * 1e3,
+            "cycles_per_s": len(latencies[1:]) / sum(latencies[1:]),
+            **_percentiles(latencies[1:], "cycle_"),
+        }
+    return results
+
+
+def _run_in_child(benchmark: Callable[..., Results], *benchmark_args: Any) -> Results:
+    # The debug logs of the app would be most of what is measured (whatever the level its modules set up)
+    logging.disable(logging.INFO)
+    results = benchmark(*benchmark_args)
+    # In kilobytes on Linux
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {name: {**metrics, "peak_rss_kb": peak_kb} for name, metrics in results.items()}
+
+
+def _metadata() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_PATH, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(results: Results, baseline: Results, tolerance: float) -> list[str]:
+    """Returns the regressions of the results, compared with the baseline"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if not reference:
+                continue
+            higher_is_better = metric.endswith("_per_s")
+            change = (value - reference) / reference
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name}.{metric}: {reference:.4g} -> {value:.4g} ({change:+.1%})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the collection and storage hot paths, compared with a stored baseline. "
+                    "To be run from the root of the project, with `python -m utils.benchmark`.")
+    parser.add_argument("--only", nargs="+", choices=["parse", "csv", "storage", "scan_cycle"], default=None,
+                        help="Runs only these benchmarks (default: all of them)")
+    parser.add_argument("--rows", nargs="+", type=int, default=[1_000_000, 10_000_000],
+                        help="Sizes of the bikes_evolution table of the storage benchmarks, e.g. 1000000 10000000")
+    parser.add_argument("--scan-stations", type=int, default=350, help="Stations of the fake API of the scan cycles")
+    parser.add_argument("--scan-bikes", type=int, default=5000, help="Bikes of the fake API of the scan cycles")
+    parser.add_argument("--scan-cycles", type=int, default=5, help="Scan cycles measured, after the cold one")
+    parser.add_argument("--output", type=pathlib.Path, default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--baseline", type=pathlib.Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Saves these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative change of a metric, beyond which it is a regression")
+    parser.add_argument("--work-dir", type=pathlib.Path, default=None,
+                        help="Where the databases are created (default: a temporary directory, deleted at the end)")
+    args = parser.parse_args()
+
+    benchmarks: list[tuple[str, Callable[..., Results], tuple]] = [
+        ("parse", bench_parse, ()),
+        ("csv", bench_csv, ()),
+        *(("storage", bench_storage, (rows,)) for rows in args.rows),
+        ("scan_cycle", bench_scan_cycle, ()),
+    ]
+    results: Results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as tmp_dir:
+        work_dir = args.work_dir or pathlib.Path(tmp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        for kind, benchmark, benchmark_args in benchmarks:
+            if args.only and kind not in args.only:
+                continue
+            print(f"Running {benchmark.__name__}{benchmark_args or ''}...", file=sys.stderr)
+            # A fresh process per benchmark, for its peak memory
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                results.update(executor.submit(_run_in_child, benchmark, work_dir, args, *benchmark_args).result())
+
+    report = {"metadata": _metadata(), "results": results}
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2))
+    for name, metrics in results.items():
+        print(f"{name:>36}: " + ", ".join(f"{metric}={value:.4g}" for metric, value in metrics.items()))
+    print(f"Results written in {args.output}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Saved as the baseline in {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline["results"], args.tolerance)
+        print(f"Compared with the baseline of commit={baseline['metadata'].get('commit')}: "
+              f"count={len(regressions)} regressions beyond {args.tolerance:.0%}")
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+    else:
+        print(f"No baseline in {args.baseline}, save one with --save-baseline")
@@ -0,0 +1,155 @@
+import argparse
+import gc
+import json
+import subprocess
+import sys
+import timeit
+import tracemalloc
+import types
+from typing import Any, Callable
+
+from component.http_session import json_loads, orjson
+from model import bike_api, station_api
+
+
+def _bike_payload(i: int) -> dict[str, Any]:
+    # As returned by the bikes endpoint of the API
+    return {
+        "id": f"6b2c7a4e-{i:04x}-4c1d-9f2a-3e8d5b7c1a{i % 100:02d}",
+        "frameId": f"FR{i:08d}",
+        "number": i,
+        "standNumber": i % 40,
+        "stationNumber": i % 350,
+        "contractName": "bruxelles",
+        "createdAt": "2023-03-01T10:00:00Z",
+        "updatedAt": "2024-05-01T10:00:00Z",
+        "lastDataFrameDate": "2024-05-01T09:59:00Z",
+        "bikeBatteryMv": 36000,
+        "checked": True,
+        "energySource": 1,
+        "hasBattery": True,
+        "hasLock": True,
+        "isReserved": False,
+        "status": "AVAILABLE",
+        "statusLabel": "Available",
+        "type": "ELECTRICAL",
+        "rating": {"count": 12, "lastRatingDateTime": "2024-04-30T18:00:00Z", "value": 4.5},
+        "battery": {"level": 3, "percentage": 78, "type": "REMOVABLE"},
+        "bikeTopHwVersion": "1.2", "bikeTopSwVersion": "3.4.5", "bmsSwVersion": "2.0",
+        "motorControllerHwVersion": "1.0", "motorControllerSwVersion": "1.1", "zedSwVersion": "0.9",
+    }
+
+
+def _station_payload(i: int) -> dict[str, Any]:
+    # As returned by the stations endpoint of the API
+    availabilities = {
+        "bikes": i % 20, "stands": 20 - i % 20, "mechanicalBikes": i % 7, "electricalBikes": i % 20 - i % 7,
+        "electricalInternalBatteryBikes": 0, "electricalRemovableBatteryBikes": i % 20 - i % 7,
+    }
+    return {
+        "number": i, "contractName": "bruxelles", "name": f"{i:03d} - STATION", "address": "Rue de la Loi",
+        "position": {"latitude": 50.84 + i / 10_000, "longitude": 4.35 + i / 10_000},
+        "banking": True, "bonus": False, "status": "OPEN", "lastUpdate": "2024-05-01T10:00:00Z",
+        "connected": True, "overflow": False, "shape": None, "overflowStands": None,
+        "totalStands": {"availabilities": availabilities, "capacity": 20},
+        "mainStands": {"availabilities": availabilities, "capacity": 20},
+    }
+
+
+def _load_module_at(ref: str, path: str) -> types.ModuleType:
+    """Loads the given module, as it was at the given git revision"""
+    source = subprocess.run(["git", "show", f"{ref}:{path}"], check=True, capture_output=True, text=True).stdout
+    name = f"baseline_{path.replace('/', '_').removesuffix('.py')}"
+    module = types.ModuleType(name)
+    # The dataclasses look their module up
+    sys.modules[name] = module
+    exec(compile(source, f"{ref}:{path}", "exec"), module.__dict__)
+    return module
+
+
+def _parse_cost(from_dict: Callable[[dict], Any], payloads: list[dict], repeat: int) -> float:
+    """Best time to parse one object, in microseconds"""
+    timer = timeit.Timer(lambda: [from_dict(payload) for payload in payloads])
+    return min(timer.repeat(repeat=repeat, number=1)) / len(payloads) * 1e6
+
+
+def _memory_per_instance(from_dict: Callable[[dict], Any], payloads: list[dict]) -> float:
+    """Memory taken by one object (nested objects included, but not the shared values), in bytes"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [from_dict(payload) for payload in payloads]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Minus the list holding them
+    return (after - before - sys.getsizeof(objects)) / len(objects)
+
+
+def _json_cost(loads: Callable[[bytes], Any], body: bytes, repeat: int) -> float:
+    """Best time to decode the body, in milliseconds"""
+    return min(timeit.Timer(lambda: loads(body)).repeat(repeat=repeat, number=1)) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of the decoding of the bikes and stations of the API: parse cost and memory per "
+                    "object, of the current models and of the models at a baseline git revision. To be run from the "
+                    "root of the project, with `python -m utils.benchmark_models`.")
+    parser.add_argument("--baseline-ref", default=None,
+                        help="Git revision of the baseline models (default: the first commit)")
+    parser.add_argument("--count", type=int, default=10_000, help="Number of objects parsed per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best one is kept")
+    parser.add_argument("--json", action="store_true", help="Prints the results as JSON")
+    args = parser.parse_args()
+
+    baseline_ref = args.baseline_ref or subprocess.run(
+        ["git", "rev-list", "--max-parents=0", "HEAD"], check=True, capture_output=True, text=True
+    ).stdout.split()[0]
+    baseline_bike_api = _load_module_at(baseline_ref, "model/bike_api.py")
+    baseline_station_api = _load_module_at(baseline_ref, "model/station_api.py")
+
+    bike_payloads = [_bike_payload(i) for i in range(args.count)]
+    station_payloads = [_station_payload(i) for i in range(args.count)]
+    cases = {
+        "bike": (bike_payloads, baseline_bike_api.Bike.from_dict, bike_api.Bike.from_dict),
+        "station": (station_payloads, baseline_station_api.Station.from_dict, station_api.Station.from_dict),
+    }
+    results: dict[str, Any] = {"baseline_ref": baseline_ref, "count": args.count}
+    for name, (payloads, baseline_from_dict, from_dict) in cases.items():
+        results[name] = {
+            "baseline_parse_us": _parse_cost(baseline_from_dict, payloads, args.repeat),
+            "parse_us": _parse_cost(from_dict, payloads, args.repeat),
+            "baseline_bytes": _memory_per_instance(baseline_from_dict, payloads),
+            "bytes": _memory_per_instance(from_dict, payloads),
+        }
+
+    # What the collector decodes of each bike: its id only
+    project_ids = lambda _: bike_api.BikeBatch.from_dicts(bike_payloads, ("id",))
+    results["bike_projection"] = {
+        "batch_parse_us": _parse_cost(project_ids, [None], args.repeat) / args.count,
+        "batch_bytes": _memory_per_instance(project_ids, [None]) / args.count,
+    }
+
+    body = json.dumps(bike_payloads).encode('utf-8')
+    results["json"] = {
+        "body_bytes": len(body),
+        "json_ms": _json_cost(json.loads, body, args.repeat),
+        "backend": "orjson" if orjson is not None else "json",
+        "backend_ms": _json_cost(json_loads, body, args.repeat),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"Baseline models at {baseline_ref[:10]}, count={args.count} objects")
+        for name in cases:
+            r = results[name]
+            print(f"{name:>8}: parse {r['baseline_parse_us']:.2f}us -> {r['parse_us']:.2f}us per object "
+                  f"(x{r['baseline_parse_us'] / r['parse_us']:.2f}), "
+                  f"memory {r['baseline_bytes']:.0f}B -> {r['bytes']:.0f}B per object")
+        r = results["bike_projection"]
+        print(f"    bike: projection of the id only, {r['batch_parse_us']:.2f}us and {r['batch_bytes']:.0f}B per bike "
+              f"in a batch of count={args.count}")
+        r = results["json"]
+        print(f"    json: decoding {r['body_bytes'] / 1e6:.1f}MB of bikes in {r['json_ms']:.1f}ms with json, "
+              f"{r['backend_ms']:.1f}ms with the backend={r['backend']}")
@@ -0,0 +1,18 @@
+import argparse
+import logging
+
+from component.database import Database
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Builds the trips of the bikes from their evolutions, resuming from the previous build. "
+                    "To be run from the root of the project, with `python -m utils.build_trips`.")
+    parser.add_argument("file_name", nargs="?", default=None,
+                        help="Name of the database file in ~/output/ (default: commercial_bike.db)")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+
+    db = Database(args.file_name)
+    count = db.build_trips()
+    db.close()
+    print(f"Built count={count} new trips")
@@ -0,0 +1,414 @@
+"""
+Local stand-in for a JCDecaux website and its APIs, to run the collector offline (load tests, profiling, benchmarks).
+
+It serves everything the client needs, under a single base URL: the `/fr/mapping` page, its JS chunks (one holding
+the OAuth2, contract and stations configurations, pointing back to this server), the `client_tokens` and
+`access_tokens` endpoints (issuing fake DEF-compressed JWTs), the stations, and the bikes of the contract.
+
+Its data is either:
+  * a synthetic city of N stations and M bikes, of which a fraction moves every minute (the churn);
+  * or the exchanges recorded by `RecordingHttpSession`, replayed in order.
+
+To be run from the root of the project, e.g. with `python -m utils.fake_api_server --stations 3500 --bikes 50000`,
+then the collector pointed at it with `python . --baseurl http://127.0.0.1:8080`.
+"""
+import argparse
+import base64
+import collections
+import gzip
+import http.server
+import json
+import logging
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from typing import Any
+
+log = logging.getLogger(__name__)
+
+CONTRACT_NAME = "bruxelles"
+ENVIRONMENT = "fake"
+CLIENT_CODE = "fake-client-code"
+CLIENT_KEY = "fake-client-key"
+STATIONS_API_KEY = "fake-api-key"
+CHUNKS_COUNT = 6
+# Bodies smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
+
+def fake_jwt(expires_at: float) -> str:
+    """A JWT with a DEF-compressed payload, as issued by the real API (not signed)"""
+    header = base64.urlsafe_b64encode(json.dumps({"zip": "DEF", "alg": "none"}).encode()).decode().rstrip("=")
+    payload = base64.urlsafe_b64encode(zlib.compress(json.dumps({"exp": int(expires_at)}).encode())).decode().rstrip("=")
+    return f"{header}.{payload}.fake-signature"
+
+
+def jwt_expires_at(token: str) -> float:
+    _, payload, _ = token.split(".")
+    return json.loads(zlib.decompress(base64.urlsafe_b64decode(payload + "==")))["exp"]
+
+
+class SyntheticCity:
+    """
+    N stations around Brussels, and M bikes docked at them. `churn` is the fraction of the bikes moving to another
+    station every minute, applied continuously (as time passes, on each request).
+    """
+
+    def __init__(self, stations: int = 350, bikes: int = 5000, churn: float = 0.01, seed: int = 42) -> None:
+        self.churn = churn
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        side = max(1, int(stations ** 0.5))
+        self.stations: dict[int, dict[str, Any]] = {}
+        for index in range(stations):
+            number = index + 1
+            self.stations[number] = {
+                "number": number,
+                "contractName": CONTRACT_NAME,
+                "name": f"{number:03d} - STATION {number}",
+                "address": f"Rue {number}",
+                "position": {
+                    # ~300m between two stations
+                    "latitude": 50.80 + (index // side) * 0.0027,
+                    "longitude": 4.30 + (index % side) * 0.0042,
+                },
+                "banking": index % 3 == 0,
+                "bonus": False,
+                "status": "OPEN",
+                "lastUpdate": "",
+                "connected": True,
+                "overflow": False,
+                "shape": None,
+                "overflowStands": None,
+                "capacity": max(10, 2 * bikes // stations + self._random.randint(0, 10)),
+            }
+        self._bikes_at: dict[int, dict[str, dict[str, Any]]] = {number: {} for number in self.stations}
+        numbers = list(self.stations)
+        for index in range(bikes):
+            number = self._random.choice(numbers)
+            while len(self._bikes_at[number]) >= self.stations[number]["capacity"]:
+                number = self._random.choice(numbers)
+            bike_id = str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+            self._bikes_at[number][bike_id] = self._new_bike(bike_id, index + 1)
+        self._updated_at = {number: time.time() for number in self.stations}
+        self._advanced_at = time.monotonic()
+        self._pending_moves = 0.0
+
+    def _new_bike(self, bike_id: str, bike_number: int) -> dict[str, Any]:
+        electrical = bike_number % 2 == 0
+        return {
+            "id": bike_id,
+            "frameId": f"FR{bike_number:08d}",
+            "number": bike_number,
+            "contractName": CONTRACT_NAME,
+            "type": "ELECTRICAL" if electrical else "MECHANICAL",
+            "status": "AVAILABLE",
+            "statusLabel": "Available",
+            "checked": True,
+            "isReserved": False,
+            "hasLock": True,
+            "hasBattery": electrical,
+            "energySource": 1 if electrical else 0,
+            "bikeBatteryMv": 36000 if electrical else None,
+            "battery": {"level": 3, "percentage": 80, "type": "REMOVABLE"} if electrical else {},
+            "rating": {"count": 10, "lastRatingDateTime": "2024-01-01T00:00:00Z", "value": 4.5},
+            "createdAt": "2023-01-01T00:00:00Z",
+            "updatedAt": "2024-01-01T00:00:00Z",
+            "lastDataFrameDate": "2024-01-01T00:00:00Z",
+            "bikeTopHwVersion": "1.0", "bikeTopSwVersion": "1.0", "bmsSwVersion": "1.0",
+            "motorControllerHwVersion": "1.0", "motorControllerSwVersion": "1.0", "zedSwVersion": "1.0",
+        }
+
+    def advance(self) -> None:
+        """Moves the bikes due to move since the previous call"""
+        with self._lock:
+            now = time.monotonic()
+            bikes_count = sum(len(bikes) for bikes in self._bikes_at.values())
+            self._pending_moves += (now - self._advanced_at) / 60 * self.churn * bikes_count
+            self._advanced_at = now
+            moves, self._pending_moves = int(self._pending_moves), self._pending_moves % 1
+            numbers = list(self.stations)
+            for _ in range(moves):
+                source, target = self._random.choice(numbers), self._random.choice(numbers)
+                bikes = self._bikes_at[source]
+                if not bikes or len(self._bikes_at[target]) >= self.stations[target]["capacity"]:
+                    continue
+                bike_id = next(iter(bikes))
+                self._bikes_at[target][bike_id] = bikes.pop(bike_id)
+                self._updated_at[source] = self._updated_at[target] = time.time()
+
+    def _stands(self, bikes: int, capacity: int) -> dict[str, Any]:
+        return {
+            "availabilities": {
+                "bikes": bikes,
+                "stands": capacity - bikes,
+                "mechanicalBikes": bikes // 2,
+                "electricalBikes": bikes - bikes // 2,
+                "electricalInternalBatteryBikes": 0,
+                "electricalRemovableBatteryBikes": bikes - bikes // 2,
+            },
+            "capacity": capacity,
+        }
+
+    def stations_payload(self) -> list[dict[str, Any]]:
+        self.advance()
+        with self._lock:
+            payload = []
+            for number, station in self.stations.items():
+                bikes = len(self._bikes_at[number])
+                capacity = station["capacity"]
+                payload.append({
+                    **{key: value for key, value in station.items() if key != "capacity"},
+                    "lastUpdate": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self._updated_at[number])),
+                    "totalStands": self._stands(bikes, capacity),
+                    "mainStands": self._stands(bikes, capacity),
+                })
+            return payload
+
+    def bikes_payload(self, station_number: int | None = None) -> list[dict[str, Any]]:
+        self.advance()
+        with self._lock:
+            numbers = list(self.stations) if station_number is None else [station_number]
+            payload = []
+            for number in numbers:
+                for stand_number, bike in enumerate(self._bikes_at.get(number, {}).values(), start=1):
+                    payload.append({**bike, "stationNumber": number, "standNumber": stand_number})
+            return payload
+
+
+class FixtureReplay:
+    """
+    The exchanges recorded by `RecordingHttpSession`, by (method, path and query). The successive responses to a
+    same request are replayed in order, the last one being repeated.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.exchanges: dict[tuple[str, str], list[dict[str, Any]]] = collections.defaultdict(list)
+        self.origins: set[str] = set()
+        self._served: collections.Counter = collections.Counter()
+        self._lock = threading.Lock()
+        for fixture_path in sorted(path.glob("*.json")):
+            exchange = json.loads(fixture_path.read_text())
+            parsed = urllib.parse.urlsplit(exchange["url"])
+            self.origins.add(f"{parsed.scheme}://{parsed.netloc}")
+            self.exchanges[(exchange["method"], self.key(parsed.path, parsed.query))].append(exchange)
+        log.info("Loaded count=%d recorded exchanges from path=%s", sum(map(len, self.exchanges.values())), path)
+
+    @staticmethod
+    def key(path: str, query: str) -> str:
+        # The order of the query parameters does not matter
+        return path + "?" + urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query)))
+
+    def next_exchange(self, method: str, path: str, query: str) -> dict[str, Any] | None:
+        key = (method, self.key(path, query))
+        exchanges = self.exchanges.get(key)
+        if not exchanges:
+            return None
+        with self._lock:
+            index = min(self._served[key], len(exchanges) - 1)
+            self._served[key] += 1
+        return exchanges[index]
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: 'FakeApiServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug("%s - %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: Any, content_type: str = "application/json", headers: dict[str, str] | None = None) -> None:
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = dict(headers or {})
+        if len(body) >= GZIP_MIN_SIZE and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(self.command, urllib.parse.urlsplit(self.path).path, len(body))
+
+    def _read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def _authorized(self) -> bool:
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Taknv1 "):
+            return False
+        try:
+            return jwt_expires_at(authorization.removeprefix("Taknv1 ")) > time.time()
+        except ValueError:
+            return False
+
+    def _tokens(self) -> dict[str, str]:
+        self.server.tokens_issued += 1
+        return {"accessToken": fake_jwt(time.time() + self.server.token_lifetime), "refreshToken": uuid.uuid4().hex}
+
+    def do_GET(self) -> None:
+        parsed = urllib.parse.urlsplit(self.path)
+        if self.server.replay is not None:
+            return self._replay("GET", parsed)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        base_url = self.server.base_url
+
+        if parsed.path == "/fr/mapping":
+            etag = '"fake-mapping-v1"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", headers={"ETag": etag})
+            links = "".join(f'<link rel="modulepreload" href="chunk-{index}.js">' for index in range(CHUNKS_COUNT))
+            return self._send(200, f"<html><body>{links}</body></html>", "text/html", {"ETag": etag})
+        if parsed.path.startswith("/chunk-") and parsed.path.endswith(".js"):
+            padding = "var x=0;" * 20_000
+            if parsed.path == f"/chunk-{CHUNKS_COUNT - 2}.js":
+                config = (f',oAuth:{{authHost:"{base_url}",env:"{ENVIRONMENT}",clientCode:"{CLIENT_CODE}",'
+                          f'clientKey:"{CLIENT_KEY}"}},contract:{{name:"{CONTRACT_NAME}"}},'
+                          f'stations:{{url:"{base_url}/stations",apiKey:"{STATIONS_API_KEY}"}}')
+                return self._send(200, padding + config + padding, "text/javascript")
+            return self._send(200, padding, "text/javascript")
+
+        if parsed.path == "/stations":
+            if query.get("apiKey") != STATIONS_API_KEY or query.get("contract") != CONTRACT_NAME:
+                return self._send(403, {"error": "Invalid apiKey or contract"})
+            return self._send(200, self.server.city.stations_payload())
+        if parsed.path == f"/contracts/{CONTRACT_NAME}/bikes":
+            if not self._authorized():
+                return self._send(401, {"error": "Invalid or expired token"})
+            if "stationNumber" not in query:
+                if self.server.refuse_bulk:
+                    return self._send(400, {"error": "stationNumber is required"})
+                return self._send(200, self.server.city.bikes_payload())
+            return self._send(200, self.server.city.bikes_payload(int(query["stationNumber"])))
+        self._send(404, {"error": "Not found"})
+
+    def do_POST(self) -> None:
+        parsed = urllib.parse.urlsplit(self.path)
+        body = self._read_json()
+        if self.server.replay is not None:
+            return self._replay("POST", parsed)
+        if parsed.path == f"/environments/{ENVIRONMENT}/client_tokens":
+            if body != {"code": CLIENT_CODE, "key": CLIENT_KEY}:
+                return self._send(403, {"error": "Invalid client"})
+            return self._send(200, self._tokens())
+        if parsed.path == "/access_tokens":
+            if not (body or {}).get("refreshToken"):
+                return self._send(401, {"error": "Invalid refresh token"})
+            return self._send(200, self._tokens())
+        self._send(404, {"error": "Not found"})
+
+    def _replay(self, method: str, parsed: urllib.parse.SplitResult) -> None:
+        exchange = self.server.replay.next_exchange(method, parsed.path, parsed.query)
+        if exchange is None:
+            return self._send(404, {"error": "Not recorded"})
+        headers = {name: value for name, value in exchange["headers"].items() if name.lower() != "content-type"}
+        if exchange["status"] == 200 and headers.get("ETag") and self.headers.get("If-None-Match") == headers["ETag"]:
+            return self._send(304, b"", headers={"ETag": headers["ETag"]})
+        body = exchange["body"] if "body" in exchange else bytes.fromhex(exchange["body_hex"])
+        if isinstance(body, str):
+            # The recorded hosts are all served by this server
+            for origin in self.server.replay.origins:
+                body = body.replace(origin, self.server.base_url)
+            if parsed.path.endswith(("/client_tokens", "/access_tokens")):
+                # The recorded tokens are long expired
+                body = json.dumps({**json.loads(body), **self._tokens()})
+        self._send(exchange["status"], body, exchange["headers"].get("Content-Type", "application/json"), headers)
+
+
+class FakeApiServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            city: SyntheticCity | None = None,
+            replay: FixtureReplay | None = None,
+            latency: float = 0.0,
+            token_lifetime: float = 2 * 3600,
+            refuse_bulk: bool = False,
+    ) -> None:
+        super().__init__((host, port), FakeApiHandler)
+        self.replay = replay
+        self.city = city if city is not None or replay is not None else SyntheticCity()
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+        self.refuse_bulk = refuse_bulk
+        self.tokens_issued = 0
+        # (method, path) -> [requests, bytes sent]
+        self.stats: dict[tuple[str, str], list[int]] = collections.defaultdict(lambda: [0, 0])
+        self._stats_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, method: str, path: str, size: int) -> None:
+        if path.startswith("/contracts/"):
+            path = "/contracts/{name}/bikes"
+        with self._stats_lock:
+            stats = self.stats[(method, path)]
+            stats[0] += 1
+            stats[1] += size
+
+    def start(self) -> 'FakeApiServer':
+        """Serves in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-api-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for a JCDecaux website and its APIs, serving a synthetic city or replaying "
+                    "recorded exchanges. To be run from the root of the project, with `python -m utils.fake_api_server`.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--stations", type=int, default=350, help="Number of stations of the synthetic city")
+    parser.add_argument("--bikes", type=int, default=5000, help="Number of bikes of the synthetic city")
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="Fraction of the bikes moving to another station every minute")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency", type=float, default=0.0, help="Added to every response, in seconds")
+    parser.add_argument("--token-lifetime", type=float, default=2 * 3600, help="Of the access tokens, in seconds")
+    parser.add_argument("--refuse-bulk", action="store_true",
+                        help="Refuses to list the bikes without a station number, as the real API may do")
+    parser.add_argument("--replay", type=pathlib.Path, default=None,
+                        help="Directory of the exchanges recorded with `python . --record DIR`, to replay instead")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+
+    server = FakeApiServer(
+        host=args.host,
+        port=args.port,
+        city=None if args.replay else SyntheticCity(args.stations, args.bikes, args.churn, args.seed),
+        replay=FixtureReplay(args.replay) if args.replay else None,
+        latency=args.latency,
+        token_lifetime=args.token_lifetime,
+        refuse_bulk=args.refuse_bulk,
+    )
+    print(f"Serving on {server.base_url}, point the collector at it with `python . --baseurl {server.base_url}`")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
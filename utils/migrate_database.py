@@ -0,0 +1,27 @@
+import argparse
+
+from component.database import Database, MIGRATIONS, OUTPUT_PATH
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Brings an existing database up to the latest schema (e.g. the compact storage of the bikes "
+                    "evolutions), then compacts its file. To be run from the root of the project, with "
+                    "`python -m utils.migrate_database`.")
+    parser.add_argument("file_name", nargs="?", default=None,
+                        help="Name of the database file in ~/output/ (default: commercial_bike.db)")
+    parser.add_argument("--no-vacuum", action="store_true", help="Do not rebuild the database file afterwards")
+    args = parser.parse_args()
+
+    # Before opening it, as opening a database applies the pending migrations
+    db_path = OUTPUT_PATH / (args.file_name or "commercial_bike.db")
+    size_before = db_path.stat().st_size if db_path.exists() else 0
+    db = Database(args.file_name)
+    print(f"Database at path={db.get_db_path()} is at schema version={db.get_schema_version()} "
+          f"(latest={len(MIGRATIONS)})")
+    if not args.no_vacuum:
+        # The space freed by the migrations is only given back to the filesystem by a VACUUM
+        print("Vacuuming the database, this can take a while on big databases")
+        db.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.connection.execute("VACUUM")
+    db.close()
+    print(f"Database file size went from {size_before} to {db.get_db_path().stat().st_size} bytes")
@@ -0,0 +1,19 @@
+import argparse
+import time
+
+from component.database import Database
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Rebuilds the per-station occupancy rollups from the whole history of the bikes evolutions "
+                    "(e.g. to backfill them on a database collected before they existed). The collector must NOT be "
+                    "running meanwhile. To be run from the root of the project, with `python -m utils.rebuild_rollups`.")
+    parser.add_argument("file_name", nargs="?", default=None,
+                        help="Name of the database file in ~/output/ (default: commercial_bike.db)")
+    args = parser.parse_args()
+
+    db = Database(args.file_name)
+    started_at = time.monotonic()
+    count = db.rebuild_rollups()
+    db.close()
+    print(f"Rebuilt the rollups from count={count} bikes evolutions in {time.monotonic() - started_at:.1f}s")